@@ -0,0 +1,341 @@
+"""Asyncio based runtime.
+
+The AsyncPyromancer works with the same packages, settings, commands and
+timers as the Pyromancer, but every command and timer is run as a separate
+task, so one slow command does not hold up the processing of other lines.
+Commands and timers can be defined as coroutine functions with the regular
+decorators; plain functions are called in the default executor of the loop.
+Offloaded commands run in the worker pool, with the same limits and reply
+order as with the Pyromancer.
+"""
+import asyncio
+import inspect
+import threading
+import time
+from types import GeneratorType
+
+from pyromancer.objects import Connection, LineBuffer, Pyromancer, \
+    WriteQueue, MIN_READ_SIZE, PRIORITY_NORMAL
+from pyromancer.workers import replay, reply_key
+
+
+class AsyncPyromancer(Pyromancer):
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.tasks = set()
+        self.wakeup = asyncio.Event()
+        self.limits = {}
+        self.replies = {}
+
+        await self.connect()
+        await self.listen()
+
+    async def connect(self):
+        self.connections = []
+
+        for settings in self.settings.networks_settings():
+            connection = AsyncConnection(settings.host, settings.port,
+                                         settings.encoding, settings.ssl)
+            await connection.open()
+            self.register(connection, settings)
+
+        self.connection = self.connections[0]
+        self.schedule_timers()
+        self.start_workers()
+        self.start_metrics()
+        self.start_message_log()
+
+    async def listen(self):
+        self.online = True
+        timers = asyncio.ensure_future(self.run_timers())
+
+        try:
+            await asyncio.gather(*[self.read(connection) for connection in
+                                   self.connections])
+        finally:
+            timers.cancel()
+
+            if self.tasks:
+                await asyncio.wait(self.tasks)
+
+            self.workers.shutdown()
+
+            if self.message_log is not None:
+                self.message_log.close()
+
+    async def read(self, connection):
+        try:
+            while not connection.closed:
+                await connection.read()
+                limit = connection.settings.lines_per_cycle
+                lines = connection.buffer.lines(limit)
+
+                while lines:
+                    self.metrics.lines_in += len(lines)
+
+                    for line in lines:
+                        self.process(line, connection)
+
+                    # Let timers, commands and other connections run during
+                    # a burst.
+                    await asyncio.sleep(0)
+                    lines = connection.buffer.lines(limit)
+
+                # Processing lines may have added timers.
+                self.wakeup.set()
+        finally:
+            await connection.close()
+            self.disconnect(connection)
+
+    async def run_timers(self):
+        while self.online:
+            self.timers.run(self.fire)
+            self.metrics.report()
+            self.wakeup.clear()
+
+            if self.message_log is not None:
+                self.message_log.check()
+
+            timeouts = [t for t in (self.timers.timeout(),
+                                    self.metrics.timeout(),
+                                    self.message_log and
+                                    self.message_log.timeout())
+                        if t is not None]
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(),
+                                       min(timeouts) if timeouts else None)
+            except asyncio.TimeoutError:
+                pass
+
+    def reload_commands(self):
+        # Synchronous commands run in an executor, but the commands and
+        # timers are only replaced from the event loop.
+        if threading.get_ident() == self.connection.thread:
+            return Pyromancer.reload_commands(self)
+
+        async def reload():
+            return Pyromancer.reload_commands(self)
+
+        return asyncio.run_coroutine_threadsafe(
+            reload(), self.connection.loop).result()
+
+    def invoke(self, handler, match):
+        if handler.function is None:
+            handler.call(match, self.timers)
+            return
+
+        task = asyncio.ensure_future(self.call(handler, match))
+        self.tasks.add(task)
+        task.add_done_callback(self.finish)
+
+    async def call(self, handler, match):
+        start = time.perf_counter()
+        error = True
+
+        try:
+            await self.run_handler(handler, match)
+            error = False
+        finally:
+            self.metrics.ran(handler, time.perf_counter() - start, error)
+
+    async def run_handler(self, handler, match):
+        function = handler.function
+
+        if self.workers.executor_of(handler):
+            await self.offload(handler, match)
+            return
+
+        if inspect.iscoroutinefunction(function):
+            error = True
+
+            try:
+                result = await function(match)
+                await match.finish_async()
+                error = False
+            finally:
+                if error:
+                    await match.finish_async(error)
+        else:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                None, self.call_sync, function, match)
+
+        handler.respond(result, match, self.timers)
+
+    async def offload(self, handler, match):
+        loop = asyncio.get_running_loop()
+        key = reply_key(match)
+        previous = self.replies.get(key)
+        turn = self.replies[key] = loop.create_future()
+
+        limit = handler.max_concurrency
+        if limit and handler not in self.limits:
+            self.limits[handler] = asyncio.Semaphore(limit)
+        semaphore = self.limits.get(handler)
+
+        try:
+            if semaphore is not None:
+                await semaphore.acquire()
+
+            try:
+                function, args = self.workers.task(handler, match)
+                future = loop.run_in_executor(
+                    self.workers.executor(handler), function, *args)
+
+                try:
+                    result, lines = await asyncio.wait_for(
+                        asyncio.shield(future), handler.timeout)
+                except asyncio.TimeoutError:
+                    # Let the next replies through, but keep the slot until
+                    # the command really finishes.
+                    turn.set_result(None)
+                    await asyncio.wait([future])
+
+                    if not future.cancelled():
+                        future.exception()
+                    return
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+
+            if previous is not None:
+                await previous
+
+            replay(lines, match.connection)
+            handler.respond(result, match, self.timers)
+        finally:
+            if not turn.done():
+                turn.set_result(None)
+
+            if self.replies.get(key) is turn:
+                del self.replies[key]
+
+    @staticmethod
+    def call_sync(function, match):
+        error = True
+
+        try:
+            result = function(match)
+
+            # Generators would otherwise run on the loop when sending the
+            # messages, so exhaust them in the executor as well.
+            if isinstance(result, GeneratorType):
+                result = list(result)
+
+            match.finish()
+            error = False
+        finally:
+            if error:
+                match.finish(error)
+
+        return result
+
+    def finish(self, task):
+        self.tasks.discard(task)
+        self.wakeup.set()
+
+        if not task.cancelled() and task.exception() is not None:
+            asyncio.get_running_loop().call_exception_handler({
+                'message': 'Exception in command or timer',
+                'exception': task.exception(),
+                'task': task,
+            })
+
+
+class AsyncConnection(Connection):
+
+    def __init__(self, host, port, encoding='utf8', use_ssl=False):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.reader = None
+        self.writer = None
+
+        self.encoding = encoding
+        self.buffer = LineBuffer(self.encoding)
+        self.read_size = MIN_READ_SIZE
+        self.queue = WriteQueue()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.closed = False
+        self.reset()
+
+    async def open(self):
+        self.loop = asyncio.get_running_loop()
+        self.thread = threading.get_ident()
+        self.queued = asyncio.Event()
+
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port,
+            ssl=self.ssl_context() if self.use_ssl else None)
+        self.sender = asyncio.ensure_future(self.send())
+
+    async def close(self):
+        self.closed = True
+        self.sender.cancel()
+        self.writer.close()
+
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+    def write(self, data, priority=PRIORITY_NORMAL):
+        data = '{}\n'.format(data).encode(self.encoding)
+
+        # Synchronous commands run in an executor and may write from there.
+        if threading.get_ident() == self.thread:
+            self.enqueue(data, priority)
+        else:
+            self.loop.call_soon_threadsafe(self.enqueue, data, priority)
+
+    def enqueue(self, data, priority):
+        self.queue.put(data, priority)
+        self.queued.set()
+
+    async def send(self):
+        """Send queued lines as fast as the flood limit allows."""
+        while True:
+            self.queued.clear()
+            lines = self.queue.take()
+
+            if lines:
+                data = b''.join(lines)
+                self.writer.write(data)
+                self.bytes_out += len(data)
+
+                try:
+                    await self.writer.drain()
+                except (ConnectionError, OSError):
+                    # The read finds out the connection is gone.
+                    return
+
+            if len(self.queue):
+                timeout = self.queue.delay()
+            else:
+                timeout = None
+
+            try:
+                await asyncio.wait_for(self.queued.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def read(self):
+        try:
+            data = await self.reader.read(self.read_size)
+        except (ConnectionError, OSError):
+            # Only this network is lost, the others keep running.
+            self.closed = True
+            return
+
+        if not data:
+            self.closed = True
+            return
+
+        self.bytes_in += len(data)
+        self.adapt_read_size(len(data))
+        self.buffer.feed(data)
@@ -0,0 +1,243 @@
+"""Benchmark of the handling of received lines.
+
+Lines are parsed, matched against the commands and replied to exactly as
+in a running bot, but against a connection which only keeps the lines sent
+to it in memory. Besides a number of generated commands, the track commands
+are installed, so joins, parts and nick changes update the users and
+channels as well.
+
+Run it with `python -m pyromancer.benchmark`, or with `--help` to see the
+options. The traffic is generated from a seed, so runs are comparable, or is
+read from a file with one raw IRC line per line. For every combination of
+command count and channel size, the number of lines handled per second, the
+median and 99th percentile time to handle a line, and the number of memory
+blocks still allocated per line afterwards are reported.
+"""
+import argparse
+import gc
+import importlib
+import json
+import random
+import sys
+import time
+
+from pyromancer import utils
+from pyromancer.decorators import command
+from pyromancer.dispatch import CommandIndex
+from pyromancer.metrics import Metrics
+from pyromancer.objects import Connection, NetworkSettings, Pyromancer, \
+    Scheduler, WriteQueue
+
+NICK = 'Pyro'
+WORDS = ('the', 'quick', 'brown', 'fox', 'jumps', 'over', 'lazy', 'dog',
+         'irc', 'bot', 'hello', 'world', 'python', 'channel', 'server')
+
+
+class MemoryConnection(Connection):
+    """Connection which keeps the lines sent to it in memory."""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.encoding = settings.encoding
+        self.queue = WriteQueue()
+        self.outgoing = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.closed = False
+        self.reset()
+        self.me.nick = settings.nick
+
+    def flush(self):
+        self.queue.take()
+
+
+def make_command(number):
+    @command(r'cmd{} (\w+)'.format(number))
+    def reply(match):
+        return 'Done {m[1]}'
+
+    return reply
+
+
+def make_bot(count):
+    commands = [make_command(i) for i in range(count)]
+
+    utils.find_functions(['pyromancer'], commands, 'commands',
+                         when=lambda f: hasattr(f, 'command'))
+
+    bot = Pyromancer.__new__(Pyromancer)
+    bot.settings = NetworkSettings(
+        importlib.import_module('pyromancer.settings'),
+        {'nick': NICK, 'command_prefix': '!'})
+    bot.commands = commands
+    bot.index = CommandIndex(commands)
+    bot.timers = Scheduler()
+    bot.metrics = Metrics(bot)
+    return bot
+
+
+def generate(lines, commands, channel_size, channels=3, seed=0):
+    """Generate traffic for a number of channels of a size.
+
+    The bot joins the channels first, and then receives mostly messages,
+    some of which trigger commands, next to joins, parts, quits, nick
+    changes and PINGs.
+    """
+    rand = random.Random(seed)
+    names = ['#chan{}'.format(i) for i in range(channels)]
+    members = dict((name, ['user{}'.format(i) for i in
+                           range(channel_size)]) for name in names)
+    serial = [channel_size]
+    traffic = []
+
+    def prefix(nick):
+        return '{0}!~{0}@host-{1}.example.org'.format(nick, len(nick))
+
+    def new_nick():
+        serial[0] += 1
+        return 'user{}'.format(serial[0])
+
+    for name in names:
+        traffic.append(':{} JOIN {}'.format(prefix(NICK), name))
+
+        for start in range(0, channel_size, 50):
+            traffic.append(':irc.example.org 353 {} = {} :{}'.format(
+                NICK, name, ' '.join(members[name][start:start + 50])))
+
+        traffic.append(':irc.example.org 366 {} {} :End of /NAMES list.'
+                       .format(NICK, name))
+
+    while len(traffic) < lines:
+        name = rand.choice(names)
+        users = members[name]
+        kind = rand.random()
+
+        if not users or kind < 0.05:
+            nick = new_nick()
+            users.append(nick)
+            traffic.append(':{} JOIN {}'.format(prefix(nick), name))
+        elif kind < 0.1:
+            nick = users.pop(rand.randrange(len(users)))
+            traffic.append(':{} PART {} :Bye'.format(prefix(nick), name))
+        elif kind < 0.12:
+            index = rand.randrange(len(users))
+            nick = users[index]
+            users[index] = new_nick()
+            traffic.append(':{} NICK :{}'.format(prefix(nick), users[index]))
+        elif kind < 0.15:
+            traffic.append('PING :irc.example.org')
+        elif kind < 0.3 and commands:
+            traffic.append(':{} PRIVMSG {} :!cmd{} {}'.format(
+                prefix(rand.choice(users)), name, rand.randrange(commands),
+                rand.choice(WORDS)))
+        else:
+            traffic.append(':{} PRIVMSG {} :{}'.format(
+                prefix(rand.choice(users)), name,
+                ' '.join(rand.choice(WORDS) for _ in range(8))))
+
+    return traffic
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(bot, traffic):
+    """Handle every line once and return the statistics."""
+    connection = MemoryConnection(bot.settings)
+    timings = []
+
+    for line in traffic:
+        start = time.perf_counter()
+        bot.process(line, connection)
+        timings.append(time.perf_counter() - start)
+        connection.flush()
+
+    # Memory which is left after handling the lines, such as the users and
+    # channels which are tracked, or caches.
+    connection = MemoryConnection(bot.settings)
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+
+    for line in traffic:
+        bot.process(line, connection)
+        connection.flush()
+
+    gc.collect()
+    blocks = sys.getallocatedblocks() - blocks
+
+    timings.sort()
+    return {
+        'lines': len(traffic),
+        'lines_per_second': len(traffic) / sum(timings),
+        'p50_us': percentile(timings, 0.5) * 1e6,
+        'p99_us': percentile(timings, 0.99) * 1e6,
+        'blocks_per_line': blocks / len(traffic),
+    }
+
+
+def benchmark(command_counts, channel_sizes, lines, recorded=None, seed=0):
+    results = []
+
+    for count in command_counts:
+        bot = make_bot(count)
+
+        for size in channel_sizes if recorded is None else [None]:
+            if recorded is None:
+                traffic = generate(lines, count, size, seed=seed)
+            else:
+                traffic = recorded
+
+            # Warm up the caches of the bot.
+            run(bot, traffic[:1000])
+
+            result = run(bot, traffic)
+            result.update(commands=count, channel_size=size)
+            results.append(result)
+
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pyromancer.benchmark',
+        description='Measure how fast Pyromancer handles received lines.')
+    parser.add_argument('--commands', default='10,100,1000',
+                        help='comma separated numbers of commands')
+    parser.add_argument('--channel-size', default='10,1000',
+                        help='comma separated numbers of users per channel')
+    parser.add_argument('--lines', type=int, default=20000,
+                        help='number of lines to generate')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--replay', metavar='FILE',
+                        help='file with raw IRC lines to use instead of '
+                             'generated traffic')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args(args)
+
+    recorded = None
+    if args.replay:
+        with open(args.replay, encoding='utf8', errors='replace') as f:
+            recorded = [line.rstrip('\r\n') for line in f if line.strip()]
+
+    results = benchmark([int(c) for c in args.commands.split(',')],
+                        [int(s) for s in args.channel_size.split(',')],
+                        args.lines, recorded, args.seed)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print('{:>8} {:>8} {:>12} {:>9} {:>9} {:>12}'.format(
+        'commands', 'users', 'lines/s', 'p50 us', 'p99 us', 'blocks/line'))
+
+    for r in results:
+        print('{:>8} {:>8} {:>12.0f} {:>9.1f} {:>9.1f} {:>12.2f}'.format(
+            r['commands'], '-' if r['channel_size'] is None else
+            r['channel_size'], r['lines_per_second'], r['p50_us'],
+            r['p99_us'], r['blocks_per_line']))
+
+
+if __name__ == '__main__':
+    main()
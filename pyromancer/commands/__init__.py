@@ -1 +1 @@
-from pyromancer.commands import track  # noqa
+from pyromancer.commands import reload, stats, track  # noqa
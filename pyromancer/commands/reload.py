@@ -0,0 +1,15 @@
+from pyromancer.decorators import command
+
+
+@command(r'^reload$', admins=True, offload=False)
+def reload(match):
+    """Import the command and timer modules which changed again."""
+    reloaded, errors = match.connection.bot.reload_commands()
+
+    if reloaded:
+        yield 'Reloaded {}', ', '.join(reloaded)
+    elif not errors:
+        yield 'Nothing changed'
+
+    for name, e in errors:
+        yield 'Could not reload {}: {}', name, e
@@ -0,0 +1,27 @@
+from pyromancer.decorators import command
+
+
+@command(r'^stats(?: (\S+))?$', admins=True, offload=False)
+def stats(match):
+    """Show the handlers which took the most time, or the statistics of the
+    handlers whose name contains the given text."""
+    snapshot = match.connection.bot.metrics.snapshot()
+    handlers = sorted(snapshot['handlers'].items(),
+                      key=lambda item: item[1]['seconds'], reverse=True)
+
+    if match[1]:
+        handlers = [h for h in handlers if match[1] in h[0]]
+
+    for name, h in handlers[:5]:
+        yield ('{}: {} hits of {} attempts, {} errors, {:.1f} ms in total, '
+               'p99 under {} ms', name, h['hits'], h['attempts'], h['errors'],
+               h['seconds'] * 1000, h['p99'] * 1000)
+
+    if not match[1]:
+        networks = snapshot['networks'].values()
+        yield ('{} lines in, {} bytes in, {} bytes out, {} lines queued, '
+               'timer lag p99 under {} ms', snapshot['lines_in'],
+               sum(n['bytes_in'] for n in networks),
+               sum(n['bytes_out'] for n in networks),
+               sum(n['queue'] for n in networks),
+               snapshot['timer_lag_p99'] * 1000)
@@ -1,41 +1,89 @@
 from pyromancer.decorators import command
-from pyromancer.objects import User, Channel
+from pyromancer.objects import User, Channel, PRIORITY_LOW
+
+# Token to recognize the replies to our own WHOX requests.
+WHOX_TOKEN = '152'
+
+
+def request_account(connection, user):
+    """Ask for the account of a user, unless it is known or asked already."""
+    if user.auth:
+        return
+
+    nick = connection.lower(user.nick)
+
+    if nick not in connection.whois_requested:
+        connection.whois_requested.add(nick)
+        connection.write('WHOIS {}'.format(user.nick), PRIORITY_LOW)
+
+
+def set_account(user, account):
+    user.auth = None if account in ('*', '0') else account
 
 
 @command(command='PART')
 def part(match):
-    chan = match.line.channel
-    user = match.line.sender
-    user.channels.remove(chan)
-    chan.users.remove(user)
+    match.connection.part(match.line.sender, match.line.channel)
 
 
 @command(command='NICK')
 def nick(match):
-    match.line.sender.nick = match.line[2].lstrip(':')
+    match.connection.rename(match.line.sender, match.line[2].lstrip(':'))
 
 
 @command(command='KICK')
 def kick(match):
     user = User.get(match.line[3], match)
-    match.line.channel.users.remove(user)
+
+    if user:
+        match.connection.part(user, match.line.channel)
 
 
 @command(command='JOIN')
 def join(match):
     chan = match.line.channel
     user = match.line.sender
-    chan.users.append(user)
-    user.channels.append(chan)
+    match.connection.join(user, chan)
+
+    # With extended-join, the account and real name are sent along.
+    if 'extended-join' in match.connection.caps and \
+            len(match.line.params) > 1:
+        set_account(user, match.line.params[1])
+
+    if user is match.connection.me:
+        # Find out the hosts and accounts of everyone in the channel with a
+        # single WHO request, in the background.
+        if 'WHOX' in match.connection.isupport:
+            match.connection.write('WHO {} %tuhnfa,{}'.format(
+                chan.name, WHOX_TOKEN), PRIORITY_LOW)
+        else:
+            match.connection.write('WHO {}'.format(chan.name), PRIORITY_LOW)
+    elif 'extended-join' not in match.connection.caps:
+        # Otherwise, the account was sent along already.
+        request_account(match.connection, user)
 
-    if not user.auth:
-        match.connection.write('WHOIS {}'.format(user.nick))
+
+@command(command='ACCOUNT')
+def account(match):
+    set_account(match.line.sender, match.line.params[0])
 
 
 @command(command='QUIT')
 def quit(match):
-    for chan in match.line.sender.channels:
-        chan.users.remove(match.line.sender)
+    match.connection.quit(match.line.sender)
+
+
+@command(code=5)
+def isupport(match):
+    for token in match.line[3:]:
+        if token.startswith(':'):
+            break
+
+        key, _, value = token.partition('=')
+        match.connection.isupport[key] = value
+
+        if key == 'CASEMAPPING':
+            match.connection.set_casemapping(value)
 
 
 @command(code=353)
@@ -52,20 +100,66 @@ def names(match):
         if not user:
             user = User(nick)
 
-        chan.users.append(user)
-        user.channels.append(chan)
+        match.connection.join(user, chan)
+
+
+@command(code=352)
+def who(match):
+    # :server 352 me #chan user host server nick flags :hopcount realname
+    user = User.get(match.line.params[5], match)
+
+    if user:
+        user.name = match.line.params[2]
+        user.host = match.line.params[3]
+
+
+@command(code=354)
+def whox(match):
+    # :server 354 me token user host nick flags account
+    params = match.line.params
+
+    if len(params) < 7 or params[1] != WHOX_TOKEN:
+        return
+
+    user = User.get(params[4], match)
 
-        if not user.auth:
-            match.connection.write('WHOIS {}'.format(nick))
+    if user:
+        user.name = params[2]
+        user.host = params[3]
+        set_account(user, params[6])
+
+
+@command(code=315)
+def who_end(match):
+    # Without WHOX, the accounts of the users in the channel are unknown.
+    if 'WHOX' in match.connection.isupport:
+        return
+
+    chan = Channel.get(match.line.params[1], match)
+
+    if chan:
+        for user in chan.users:
+            if user is not match.connection.me:
+                request_account(match.connection, user)
 
 
 @command(code=311)
 def whois_host_and_name(match):
     user = User.get(match.line[3], match)
-    user.host = match.line[5]
+
+    if user:
+        user.host = match.line[5]
 
 
 @command(code=330)
 def whois_auth(match):
     user = User.get(match.line[3], match)
-    user.auth = match.line[4]
+
+    if user:
+        user.auth = match.line[4]
+
+
+@command(code=318)
+def whois_end(match):
+    match.connection.whois_requested.discard(
+        match.connection.lower(match.line.params[1]))
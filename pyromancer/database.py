@@ -1,5 +1,254 @@
-from sqlalchemy.ext.declarative import declarative_base
+"""Database support, with SQLAlchemy.
+
+Commands and timers get a session with `match.session`, which is committed
+after they finished, or rolled back when they raised an exception. Coroutine
+commands get an AsyncSession with `match.async_session` when the
+`async_database` setting is set. Writes which do not need to be read back
+right away, such as logging every message, are better handed to
+`match.save`, which adds them on a background thread, many at once in one
+transaction.
+
+Engines are created once per process for every database URL, with the
+options in the `database_options` setting, so offloaded commands, also in
+other processes, use a pool of connections as well.
+"""
+import atexit
+import collections
+import logging
+import queue
+import threading
+import time
+
+from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
+try:
+    from sqlalchemy.orm import declarative_base
+except ImportError:
+    from sqlalchemy.ext.declarative import declarative_base
+
 Session = sessionmaker()
 Base = declarative_base()
+
+logger = logging.getLogger(__name__)
+
+engines = {}
+async_engines = {}
+write_behinds = {}
+lock = threading.Lock()
+
+
+def get_engine(settings):
+    url = settings.database
+
+    with lock:
+        engine = engines.get(url)
+
+        if engine is None:
+            engine = engines[url] = create_engine(
+                url, **settings.database_options)
+
+    return engine
+
+
+def get_async_engine(settings):
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = settings.async_database
+
+    with lock:
+        engine = async_engines.get(url)
+
+        if engine is None:
+            engine = async_engines[url] = create_async_engine(
+                url, **settings.database_options)
+
+    return engine
+
+
+def write_behind(settings):
+    """Return the WriteBehind of the database in the settings."""
+    url = settings.database
+    engine = get_engine(settings)
+
+    with lock:
+        writer = write_behinds.get(url)
+
+        if writer is None:
+            writer = write_behinds[url] = WriteBehind(
+                engine, settings.database_batch_size,
+                settings.database_batch_delay)
+
+    return writer
+
+
+class Scope(object):
+    """The sessions of a single match."""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.sync = None
+        self.asynchronous = None
+
+    @property
+    def session(self):
+        if self.sync is None:
+            self.sync = Session(bind=get_engine(self.settings))
+
+        return self.sync
+
+    @property
+    def async_session(self):
+        from sqlalchemy.ext.asyncio import AsyncSession
+
+        if self.asynchronous is None:
+            self.asynchronous = AsyncSession(
+                get_async_engine(self.settings), expire_on_commit=False)
+
+        return self.asynchronous
+
+    def finish(self, error=False):
+        session, self.sync = self.sync, None
+
+        if session is None:
+            return
+
+        try:
+            if error:
+                session.rollback()
+            else:
+                session.commit()
+        finally:
+            session.close()
+
+    async def finish_async(self, error=False):
+        session, self.asynchronous = self.asynchronous, None
+
+        try:
+            if session is not None:
+                try:
+                    if error:
+                        await session.rollback()
+                    else:
+                        await session.commit()
+                finally:
+                    await session.close()
+        finally:
+            self.finish(error)
+
+
+class WriteBehind(object):
+    """Writes instances and rows in batches, from a background thread.
+
+    The first write waits at most delay seconds for others to join it, and
+    a batch holds at most batch_size writes, which are committed in one
+    transaction. Rows for the same table are inserted with a single
+    executemany. When a batch fails, its writes are tried one by one, so
+    only the bad ones are lost, which is logged.
+    """
+
+    def __init__(self, engine, batch_size=500, delay=1.0):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.delay = delay
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+
+    def add(self, *instances):
+        """Add new ORM instances, which must not be in another session."""
+        for instance in instances:
+            self.put((None, instance))
+
+    def insert(self, table, **values):
+        """Insert a row into a table, or the table of a model."""
+        self.put((getattr(table, '__table__', table), values))
+
+    def put(self, item):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run)
+                    self.thread.daemon = True
+                    self.thread.start()
+                    atexit.register(self.close)
+
+        self.queue.put(item)
+
+    def flush(self):
+        """Wait until everything added so far is written."""
+        self.queue.join()
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def run(self):
+        stop = False
+
+        while not stop:
+            item = self.queue.get()
+
+            if item is None:
+                self.queue.task_done()
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.delay
+
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(
+                        timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+                if item is None:
+                    self.queue.task_done()
+                    stop = True
+                    break
+
+                batch.append(item)
+
+            self.write(batch)
+
+            for _ in batch:
+                self.queue.task_done()
+
+    def write(self, batch):
+        try:
+            self.commit(batch)
+            self.written += len(batch)
+            return
+        except Exception:
+            if len(batch) == 1:
+                self.failed += 1
+                logger.exception('Could not write to the database')
+                return
+
+        for item in batch:
+            self.write([item])
+
+    def commit(self, batch):
+        session = Session(bind=self.engine)
+        rows = collections.OrderedDict()
+
+        try:
+            for table, item in batch:
+                if table is None:
+                    session.add(item)
+                else:
+                    rows.setdefault(table, []).append(item)
+
+            for table, values in rows.items():
+                session.execute(table.insert(), values)
+
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
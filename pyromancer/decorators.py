@@ -1,3 +1,4 @@
+import inspect
 import re
 
 from pyromancer import utils
@@ -5,6 +6,25 @@ from pyromancer.exceptions import CommandException
 from pyromancer.objects import Match, Timer
 
 
+def get_input(line, settings, raw=False, use_prefix=True):
+    """Return the text of a line which patterns are matched against.
+
+    None is returned when a prefix is required but the line does not start
+    with it.
+    """
+    input = line.full_msg if not raw else line.raw
+
+    if use_prefix and settings.command_prefix:
+        if not input.startswith(settings.command_prefix):
+            return
+
+        # todo: add support for tuple of prefixes; this line currently
+        # prohibits that support.
+        input = input[len(settings.command_prefix):]
+
+    return input
+
+
 class command(object):
 
     def __init__(self, patterns=None, *args, **kwargs):
@@ -24,9 +44,20 @@ class command(object):
         self.command = kwargs.get('command')
         self.admins_only = kwargs.get('admins', False)
 
+        self.offload = kwargs.get('offload')
+        self.executor = kwargs.get(
+            'executor', 'thread' if self.offload else None)
+        self.max_concurrency = kwargs.get('max_concurrency')
+        self.timeout = kwargs.get('timeout')
+
         if self.code is not None and not isinstance(self.code, int):
             raise CommandException('The code argument must be an integer.')
 
+        if self.executor not in (None, 'thread', 'process'):
+            raise CommandException(
+                'The executor argument must be either "thread" or '
+                '"process".')
+
         if self.code or self.command:
             self.raw = True
 
@@ -45,18 +76,27 @@ class command(object):
         m = self.matches(line, settings)
 
         if m:
-            match = Match(m, line, connection, settings)
-            result = self.function(match)
+            line.resolve()
+            self.call(Match(m, line, connection, settings), timers)
 
-            if result is not None:
-                self.send_messages(result, match, timers)
+    def call(self, match, timers):
+        self.respond(self.function(match), match, timers)
+
+    def respond(self, result, match, timers):
+        if inspect.iscoroutine(result):
+            result.close()
+            raise CommandException(
+                'Coroutine function {} can only be used as a command with '
+                'the AsyncPyromancer.'.format(self.function.__name__))
+
+        if result is not None:
+            self.send_messages(result, match, timers)
 
     def matches(self, line, settings):
         if not line.usermsg and not self.raw:
             return
 
-        if self.admins_only and hasattr(line, 'sender') and line.sender.auth \
-                not in settings.admins:
+        if not self.allowed(line, settings):
             return
 
         if self.code and getattr(line, 'code', None) == self.code:
@@ -65,18 +105,21 @@ class command(object):
         if self.command and getattr(line, 'command', None) == self.command:
             return True
 
-        input = line.full_msg if not self.raw else line.raw
+        input = get_input(line, settings, self.raw, self.use_prefix)
+
+        if input is not None:
+            return self.search(input)
 
-        if self.use_prefix and settings.command_prefix:
-            if not input.startswith(settings.command_prefix):
-                return
+    def allowed(self, line, settings):
+        return not (self.admins_only and line.sender is not None and
+                    line.sender.auth not in settings.admins)
 
-            # todo: add support for tuple of prefixes; this line currently
-            # prohibits that support.
-            input = input[len(settings.command_prefix):]
+    def search(self, input, indexes=None):
+        patterns = self.patterns if indexes is None else \
+            [self.patterns[i] for i in indexes]
 
-        for pattern in self.patterns:
-            m = re.search(pattern, input)
+        for pattern in patterns:
+            m = pattern.search(input)
 
             if m:
                 return m
@@ -84,6 +127,9 @@ class command(object):
     def send_messages(self, result, match, timers):
         for r in utils.process_messages(result):
             if isinstance(r, Timer):
+                if r.connection is None:
+                    r.connection = match.connection
+
                 timers.append(r)
             else:
                 match.msg(r[0], *r[1], **r[2])
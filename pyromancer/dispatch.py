@@ -0,0 +1,245 @@
+import heapq
+import re
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+from pyromancer.decorators import get_input
+
+# Characters which match non-ASCII characters when ignoring case, so simply
+# lowering the input is not enough to compare them.
+UNSAFE_IGNORECASE = set('iIkKsS')
+
+
+class CommandIndex(object):
+    """Lookup table of the commands which can possibly match a line.
+
+    Commands for a code or an IRC command are looked up directly, so lines
+    only reach the commands which are interested in them. Commands with
+    patterns are kept apart: all of them are tried on messages from users,
+    and the raw ones on all other lines as well. The commands are always
+    returned in the order in which they were found.
+    """
+
+    def __init__(self, functions):
+        self.codes = {}
+        self.commands = {}
+        self.patterns = []
+        self.raw_patterns = []
+        self.cache = {}
+
+        for order, function in enumerate(functions):
+            entry = (order, function.command)
+
+            if entry[1].code:
+                self.codes.setdefault(entry[1].code, []).append(entry)
+
+            if entry[1].command:
+                self.commands.setdefault(entry[1].command, []).append(entry)
+
+            if entry[1].patterns:
+                self.patterns.append(entry)
+
+                if entry[1].raw:
+                    self.raw_patterns.append(entry)
+
+        self.pattern_commands = [c for order, c in self.patterns]
+        self.by_order = dict(self.patterns)
+
+        # Group the pattern commands on the input they are matched against,
+        # so the input is only prepared once for each group.
+        groups = {}
+        for order, command in self.patterns:
+            key = (command.raw, command.use_prefix)
+            groups.setdefault(key, []).append((order, command))
+
+        self.pattern_sets = [(raw, use_prefix, PatternSet(entries)) for
+                             (raw, use_prefix), entries in groups.items()]
+
+    def candidates(self, line):
+        if line.usermsg:
+            return self.pattern_commands
+
+        key = (getattr(line, 'code', None), getattr(line, 'command', None))
+
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+
+        merged = heapq.merge(self.codes.get(key[0], []),
+                             self.commands.get(key[1], []),
+                             self.raw_patterns, key=lambda e: e[0])
+
+        candidates, last = [], None
+        for order, command in merged:
+            if order != last:
+                candidates.append(command)
+                last = order
+
+        self.cache[key] = candidates
+        return candidates
+
+    def match(self, line, settings, misses=False):
+        """Yield the pattern commands and their matches for a user message.
+
+        This gives the same results as calling matches on every pattern
+        command, but only runs the patterns which can possibly match. With
+        misses, the commands whose patterns were run without a match are
+        yielded as well, with None as match.
+        """
+        hits = []
+
+        for raw, use_prefix, pattern_set in self.pattern_sets:
+            input = get_input(line, settings, raw, use_prefix)
+
+            if input is not None:
+                hits.extend((key, input) for key in
+                            pattern_set.candidates(input))
+
+        hits.sort(key=lambda hit: hit[0])
+
+        i = 0
+        while i < len(hits):
+            order = hits[i][0][0]
+            input = hits[i][1]
+            indexes = []
+
+            while i < len(hits) and hits[i][0][0] == order:
+                indexes.append(hits[i][0][1])
+                i += 1
+
+            command = self.by_order[order]
+
+            if not command.allowed(line, settings):
+                continue
+
+            m = command.search(input, indexes)
+
+            if m or misses:
+                yield command, m
+
+
+class PatternSet(object):
+    """Preselects the patterns which can match an input.
+
+    For every pattern, the literal text it starts with is extracted. When the
+    pattern is anchored at the start, the patterns are stored in a trie, so
+    walking the input once gives all patterns whose literal is a prefix of
+    the input. Other patterns are only tried when their literal occurs in
+    the input, and patterns without any literal are always tried.
+    """
+
+    def __init__(self, entries):
+        self.trie = {}
+        self.itrie = {}
+        self.substrings = []
+        self.always = []
+
+        for order, command in entries:
+            for index, analysis in enumerate(pattern_keys(command)):
+                key = (order, index)
+                anchored, literal, ignorecase = analysis
+
+                if not literal:
+                    self.always.append(key)
+                elif anchored:
+                    node = self.itrie if ignorecase else self.trie
+
+                    for char in literal:
+                        node = node.setdefault(char, {})
+
+                    node.setdefault('', []).append(key)
+                else:
+                    self.substrings.append((literal, ignorecase, key))
+
+    def candidates(self, input):
+        hits = list(self.always)
+        lowered = input.lower()
+
+        for trie, text in ((self.trie, input), (self.itrie, lowered)):
+            node = trie
+
+            for char in text:
+                node = node.get(char)
+
+                if node is None:
+                    break
+
+                hits.extend(node.get('', ()))
+
+        for literal, ignorecase, key in self.substrings:
+            if literal in (lowered if ignorecase else input):
+                hits.append(key)
+
+        return hits
+
+
+def pattern_keys(command):
+    """Return the analysis of every pattern of a command.
+
+    Commands from a manifest bring it along, so their patterns do not have
+    to be compiled until they are used. Otherwise, it is kept on the command,
+    so building the index again after a reload only analyzes new commands.
+    """
+    keys = getattr(command, 'pattern_keys', None)
+
+    if keys is None:
+        keys = command.pattern_keys = [analyze(pattern) for pattern in
+                                       command.patterns]
+
+    return keys
+
+
+def analyze(pattern):
+    """Find the literal text a compiled pattern starts with.
+
+    Returns a tuple of whether the pattern is anchored at the start of the
+    input, the literal text (lowered if the pattern ignores case) and
+    whether case is ignored. The literal is empty when it cannot be
+    determined safely.
+    """
+    ignorecase = bool(pattern.flags & re.IGNORECASE)
+
+    if not isinstance(pattern.pattern, str):
+        return False, '', ignorecase
+
+    try:
+        items = list(sre_parse.parse(pattern.pattern, pattern.flags))
+    except Exception:
+        return False, '', ignorecase
+
+    anchored = False
+    if items and items[0] in ((sre_parse.AT, sre_parse.AT_BEGINNING),
+                              (sre_parse.AT, sre_parse.AT_BEGINNING_STRING)):
+        # With MULTILINE, ^ also matches after every newline.
+        anchored = (items[0][1] is sre_parse.AT_BEGINNING_STRING or
+                    not pattern.flags & re.MULTILINE)
+        items = items[1:]
+
+    literal = ''.join(leading_literal(items))
+
+    if ignorecase:
+        if UNSAFE_IGNORECASE & set(literal) or not literal.isascii():
+            literal = ''
+
+        literal = literal.lower()
+
+    return anchored, literal, ignorecase
+
+
+def leading_literal(items):
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            yield chr(av)
+        elif op is sre_parse.SUBPATTERN and not av[1] and not av[2]:
+            sub = list(av[3])
+            for char in leading_literal(sub):
+                yield char
+
+            if not all(o is sre_parse.LITERAL for o, a in sub):
+                return
+        else:
+            return
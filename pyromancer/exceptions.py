@@ -1,2 +1,10 @@
 class CommandException(Exception):
     pass
+
+
+class TimerException(Exception):
+    pass
+
+
+class SettingsException(Exception):
+    pass
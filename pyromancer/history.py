@@ -0,0 +1,294 @@
+"""Searching the messages in the message log.
+
+When the `message_log` setting is the path of a SQLite database, the text of
+the logged messages is also added to a full text index, in the same
+transaction as the messages themselves. Commands and timers search it with
+`match.history`, by words and "quoted phrases", sender nick, target, network
+and time, newest first, without scanning the whole log.
+
+The index is an FTS5 table when SQLite supports it. Otherwise, the words of
+the messages are indexed in memory, in every process which searches, and the
+messages which were added since are indexed before every search.
+
+Every thread gets its own connection to the database, so searching does not
+wait for the messages being written. A search still takes a while when many
+messages match, so commands should be offloaded, and coroutines should use
+`search_async` and `seen_async`.
+"""
+import array
+import asyncio
+import datetime
+import functools
+import re
+import sqlite3
+import threading
+
+from pyromancer.messagelog import FIELDS, INSERT, Record, SQLiteStore
+
+SCHEMA = '''
+CREATE INDEX IF NOT EXISTS messages_sender
+    ON messages (sender COLLATE NOCASE, time);
+CREATE INDEX IF NOT EXISTS messages_time ON messages (time);
+'''
+
+FTS_SCHEMA = '''
+CREATE VIRTUAL TABLE messages_fts USING fts5(
+    text, content='messages', content_rowid='id');
+INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+'''
+
+COLUMNS = ', '.join('messages.' + field for field in FIELDS)
+
+# Messages fetched at once when checking the matches of the word index.
+CHUNK_SIZE = 500
+
+TERMS = re.compile(r'"([^"]*)"|(\S+)')
+WORDS = re.compile(r'\w+')
+
+histories = {}
+lock = threading.Lock()
+
+
+def get_history(settings):
+    """Return the History of the message log in the settings."""
+    path = settings.message_log
+
+    if isinstance(path, History):
+        return path
+
+    if not isinstance(path, str):
+        raise ValueError('The message_log setting is not the path of a '
+                         'SQLite database')
+
+    with lock:
+        history = histories.get(path)
+
+        if history is None:
+            history = histories[path] = History(path)
+
+    return history
+
+
+def words(text):
+    return WORDS.findall(text.lower())
+
+
+def terms(query):
+    """Split a query into the words of its terms and its quoted phrases."""
+    found = []
+
+    for phrase, word in TERMS.findall(query):
+        term = words(phrase or word)
+
+        if term:
+            found.append(term)
+
+    return found
+
+
+def timestamp(value):
+    """Return a timestamp for a timestamp, a datetime, or a timedelta ago."""
+    if isinstance(value, datetime.timedelta):
+        value = datetime.datetime.now() - value
+
+    if isinstance(value, datetime.datetime):
+        value = value.timestamp()
+
+    return value
+
+
+class WordIndex(object):
+    """The ids of the messages containing each word, in memory."""
+
+    def __init__(self):
+        self.postings = {}
+        self.last = 0
+
+    def add(self, id, text):
+        for word in set(words(text)):
+            try:
+                self.postings[word].append(id)
+            except KeyError:
+                self.postings[word] = array.array('q', [id])
+
+        self.last = id
+
+    def candidates(self, words):
+        """Yield the ids of the messages containing all words, newest
+        first."""
+        postings = sorted((self.postings.get(word, ()) for word in
+                           set(words)), key=len)
+
+        if not postings or not postings[0]:
+            return
+
+        others = [set(p) for p in postings[1:]]
+
+        for id in reversed(postings[0]):
+            if all(id in other for other in others):
+                yield id
+
+
+class History(SQLiteStore):
+    """A SQLiteStore with a full text index, which can be searched."""
+
+    def __init__(self, path, fts=None):
+        SQLiteStore.__init__(self, path)
+        self.fts = fts
+        self.index = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def connect(self):
+        connection = SQLiteStore.connect(self)
+        connection.executescript(SCHEMA)
+
+        if self.fts is None:
+            self.fts = fts5_available(connection)
+
+        if self.fts:
+            with self.lock:
+                if not connection.execute("SELECT 1 FROM sqlite_master WHERE "
+                                          "name = 'messages_fts'").fetchone():
+                    # Messages which were logged before are indexed as well.
+                    connection.executescript(FTS_SCHEMA)
+
+        return connection
+
+    def write(self, records):
+        if self.connection is None:
+            self.connection = self.connect()
+
+        with self.connection:
+            last = self.connection.execute(
+                'SELECT max(id) FROM messages').fetchone()[0] or 0
+            self.connection.executemany(INSERT, records)
+
+            if self.fts:
+                self.connection.execute(
+                    'INSERT INTO messages_fts (rowid, text) SELECT id, text '
+                    'FROM messages WHERE id > ? AND text IS NOT NULL',
+                    (last,))
+
+    def reader(self):
+        """Return the connection of the current thread for searching."""
+        try:
+            return self.local.connection
+        except AttributeError:
+            connection = self.local.connection = self.connect()
+            return connection
+
+    def search(self, query=None, nick=None, target=None, network=None,
+               since=None, until=None, verbs=None, limit=50):
+        """Return the latest messages which match all of the arguments.
+
+        The query holds words and "quoted phrases" which must all occur in
+        the text, in any case. The nick and target are compared without
+        case, and since and until are timestamps, datetimes, or timedeltas
+        before now.
+        """
+        where, args = [], []
+
+        for column, value, compare in (
+                ('sender', nick, '= ? COLLATE NOCASE'),
+                ('target', target, '= ? COLLATE NOCASE'),
+                ('network', network, '= ?'),
+                ('time', timestamp(since), '>= ?'),
+                ('time', timestamp(until), '< ?')):
+            if value is not None:
+                where.append('messages.{} {}'.format(column, compare))
+                args.append(value)
+
+        if verbs:
+            where.append('messages.verb IN ({})'.format(
+                ', '.join('?' * len(verbs))))
+            args.extend(verbs)
+
+        found = terms(query) if query else []
+        connection = self.reader()
+
+        if query and not found:
+            return []
+
+        if found and not self.fts:
+            return self.search_index(connection, found, where, args, limit)
+
+        if found:
+            where.insert(0, 'messages_fts MATCH ?')
+            args.insert(0, ' '.join('"{}"'.format(' '.join(term)) for
+                                    term in found))
+            sql = ('SELECT {} FROM messages_fts JOIN messages ON messages.id '
+                   '= messages_fts.rowid WHERE {} ORDER BY messages_fts.rowid '
+                   'DESC LIMIT ?')
+        else:
+            sql = 'SELECT {} FROM messages {} ORDER BY messages.time DESC ' \
+                'LIMIT ?'
+            where = ['WHERE ' + ' AND '.join(where)] if where else []
+
+        sql = sql.format(COLUMNS, ' AND '.join(where))
+        return [Record(*row) for row in connection.execute(sql,
+                                                           args + [limit])]
+
+    def search_index(self, connection, found, where, args, limit):
+        with self.lock:
+            if self.index is None:
+                self.index = WordIndex()
+
+            for id, text in connection.execute(
+                    'SELECT id, text FROM messages WHERE id > ? AND text IS '
+                    'NOT NULL ORDER BY id', (self.index.last,)):
+                self.index.add(id, text)
+
+            candidates = list(self.index.candidates(
+                [word for term in found for word in term]))
+
+        phrases = [term for term in found if len(term) > 1]
+        results = []
+
+        for start in range(0, len(candidates), CHUNK_SIZE):
+            chunk = candidates[start:start + CHUNK_SIZE]
+            sql = 'SELECT {} FROM messages WHERE {} ORDER BY id DESC'.format(
+                COLUMNS, ' AND '.join(['id IN ({})'.format(
+                    ', '.join('?' * len(chunk)))] + where))
+
+            for row in connection.execute(sql, chunk + args):
+                record = Record(*row)
+
+                if all(contains(words(record.text), phrase) for phrase in
+                       phrases):
+                    results.append(record)
+
+                    if len(results) == limit:
+                        return results
+
+        return results
+
+    def seen(self, nick, network=None):
+        """Return the last message of a nick, or None."""
+        found = self.search(nick=nick, network=network, limit=1)
+        return found[0] if found else None
+
+    async def search_async(self, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self.search, *args, **kwargs))
+
+    async def seen_async(self, nick, network=None):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.seen, nick, network)
+
+
+def contains(words, phrase):
+    size = len(phrase)
+    return any(words[i:i + size] == phrase for i in
+               range(len(words) - size + 1))
+
+
+def fts5_available(connection):
+    try:
+        connection.execute('CREATE VIRTUAL TABLE temp.fts5_check USING '
+                           'fts5(text)')
+    except sqlite3.OperationalError:
+        return False
+
+    connection.execute('DROP TABLE temp.fts5_check')
+    return True
@@ -0,0 +1,196 @@
+"""Cached list of the commands of the installed packages.
+
+Finding the commands imports every commands module of every package, and
+with them everything those modules import. With the `command_manifest`
+setting, the commands which were found are written to that file, with
+everything needed to decide whether a line could match them: their codes,
+IRC commands and patterns. The next time the bot starts, the commands are
+read from the file instead, and the module of a command is only imported
+once a line comes along which it could match.
+
+The manifest is rebuilt when any of the modules it was made from changed,
+when a commands module was added to one of the packages, or when the
+packages or their settings changed. Deleting the file rebuilds it as well.
+"""
+import importlib
+import importlib.util
+import inspect
+import json
+import os
+import sys
+
+from pyromancer import __version__, utils
+from pyromancer.dispatch import pattern_keys
+
+
+def find_commands(packages, path, ignored='disabled_commands'):
+    """Return the command functions of the packages, using the manifest.
+
+    The functions of a valid manifest are stand-ins, which import their
+    module when they are used.
+    """
+    key = manifest_key(packages)
+    manifest = read(path, key)
+
+    if manifest is not None:
+        return [LazyFunction(entry) for entry in manifest['commands']]
+
+    functions, manifest = build(packages, ignored)
+    manifest['key'] = key
+    write(path, manifest)
+    return functions
+
+
+def manifest_key(packages):
+    return {
+        'version': __version__,
+        'python': list(sys.version_info[:2]),
+        'packages': repr(packages),
+    }
+
+
+def build(packages, ignored):
+    """Find the commands by importing the modules, and describe them."""
+    functions = []
+    commands = []
+    files = {}
+    missing = []
+
+    for module_name, module, ignored_names in utils.find_modules(
+            packages, 'commands', ignored):
+        if module is None:
+            missing.append(module_name)
+            continue
+
+        if getattr(module, '__file__', None):
+            files[module.__file__] = file_stat(module.__file__)
+
+        for name, f in inspect.getmembers(module, inspect.isfunction):
+            if not hasattr(f, 'command') or \
+                    '{}.{}'.format(module_name, name) in ignored_names:
+                continue
+
+            functions.append(f)
+            commands.append(describe(module_name, name, f.command))
+
+    manifest = {
+        'files': files,
+        'missing': missing,
+        'commands': commands,
+    }
+
+    return functions, manifest
+
+
+def describe(module_name, name, command):
+    entry = {
+        'module': module_name,
+        'name': name,
+        'code': command.code,
+        'command': command.command,
+        'raw': command.raw,
+        'use_prefix': command.use_prefix,
+        'patterns': [[p.pattern, p.flags] for p in command.patterns],
+        'pattern_keys': pattern_keys(command),
+    }
+
+    # Bytes patterns do not fit in JSON, so these commands are imported
+    # right away.
+    if not all(isinstance(p.pattern, str) for p in command.patterns):
+        entry['patterns'] = entry['pattern_keys'] = []
+        entry['eager'] = True
+
+    return entry
+
+
+def file_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def read(path, key):
+    """Return the manifest in a file, or None when it is missing or stale."""
+    try:
+        with open(path, encoding='utf8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get('key') != key:
+        return None
+
+    for file, stat in manifest['files'].items():
+        if file_stat(file) != stat:
+            return None
+
+    for module_name in manifest['missing']:
+        try:
+            if importlib.util.find_spec(module_name) is not None:
+                return None
+        except ImportError:
+            pass
+
+    return manifest
+
+
+def write(path, manifest):
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+
+    with open(temporary, 'w', encoding='utf8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    os.replace(temporary, path)
+
+
+class LazyFunction(object):
+    """Stand-in for a command function whose module is not imported yet."""
+
+    def __init__(self, entry):
+        self.command = LazyCommand(entry)
+
+        if entry.get('eager'):
+            self.command.load()
+
+    def __call__(self, match):
+        return self.command.function(match)
+
+
+class LazyCommand(object):
+    """Stand-in for a command, with what the CommandIndex needs to know.
+
+    Anything else is taken from the real command, after importing its
+    module.
+    """
+
+    def __init__(self, entry):
+        self.module = entry['module']
+        self.name = entry['name']
+        self.code = entry['code']
+        self.command = entry['command']
+        self.raw = entry['raw']
+        self.use_prefix = entry['use_prefix']
+        self.target = None
+
+        # The patterns are only compiled by importing the module, as the
+        # index only needs to know their literal prefixes.
+        self.patterns = entry['patterns']
+        self.pattern_keys = [tuple(keys) for keys in entry['pattern_keys']]
+
+    def load(self):
+        if self.target is None:
+            module = importlib.import_module(self.module)
+            self.target = getattr(module, self.name).command
+            self.patterns = self.target.patterns
+            self.pattern_keys = None
+
+        return self.target
+
+    def __getattr__(self, item):
+        if item.startswith('__') or item == 'target':
+            raise AttributeError(item)
+
+        return getattr(self.load(), item)
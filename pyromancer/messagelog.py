@@ -0,0 +1,299 @@
+"""Logging of the messages the bot receives.
+
+Every received line with a verb in the `message_log_verbs` setting becomes a
+record of its time, network, verb, sender, target and text. The records are
+kept in a list, and handed to a background thread which writes them all at
+once, as soon as `message_log_batch_size` of them are waiting, or
+`message_log_delay` seconds after the first of them came in. Logging a line
+costs the event loop little more than appending to a list, and the store
+gets a few large writes instead of one per message.
+
+The `message_log` setting is the path of a SQLite database, whose messages
+table gets the records with a single executemany in one transaction per
+batch, or a store of its own: an object with a write method which takes a
+list of records, and a close method. The SegmentStore appends the records to
+files which are rotated when they grew large.
+"""
+import atexit
+import collections
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+# Verbs which are logged by default.
+VERBS = ('PRIVMSG', 'NOTICE', 'JOIN', 'PART', 'QUIT', 'NICK', 'KICK', 'TOPIC')
+
+FIELDS = ('time', 'network', 'verb', 'sender', 'target', 'text')
+
+Record = collections.namedtuple('Record', FIELDS)
+
+# Verbs whose first parameter is text, rather than a target.
+UNTARGETED = frozenset(['QUIT', 'NICK'])
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    network TEXT,
+    verb TEXT NOT NULL,
+    sender TEXT,
+    target TEXT,
+    text TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_target
+    ON messages (target COLLATE NOCASE, time);
+'''
+
+INSERT = 'INSERT INTO messages ({}) VALUES ({})'.format(
+    ', '.join(FIELDS), ', '.join('?' * len(FIELDS)))
+
+logger = logging.getLogger(__name__)
+
+
+def record(line, network):
+    """Return the record of a line received from a network."""
+    prefix = line.prefix
+    params = line.params
+    target = None
+
+    if params and line.verb not in UNTARGETED:
+        target, params = params[0], params[1:]
+
+    # Only lines with tags can have a server-time tag.
+    timestamp = line.datetime.timestamp() if line.data.startswith('@') else \
+        line.time
+
+    return Record(timestamp, network, line.verb,
+                  prefix.partition('!')[0] if prefix else None, target,
+                  ' '.join(params) if params else None)
+
+
+class MessageLog(object):
+    """Collects the records of received lines, and writes them in batches.
+
+    The loop adds lines, and calls check to write the records which waited
+    long enough, while a single thread writes the batches in order.
+    """
+
+    def __init__(self, store, verbs=VERBS, batch_size=1000, delay=5.0):
+        if isinstance(store, str):
+            store = SQLiteStore(store)
+
+        self.store = store
+        self.verbs = frozenset(verbs)
+        self.batch_size = batch_size
+        self.delay = delay
+        self.records = []
+        self.due = None
+        self.networks = {}
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+
+    def add(self, line, connection):
+        if line.verb not in self.verbs:
+            return
+
+        try:
+            network = self.networks[connection]
+        except KeyError:
+            settings = getattr(connection, 'settings', None)
+            network = self.networks[connection] = settings and (
+                getattr(settings, 'name', None) or settings.host)
+
+        records = self.records
+        records.append(record(line, network))
+
+        if len(records) == 1:
+            self.due = time.monotonic() + self.delay
+
+        if len(records) >= self.batch_size:
+            self.flush()
+
+    def timeout(self, now=None):
+        if not self.records:
+            return None
+
+        now = time.monotonic() if now is None else now
+        return max(0, self.due - now)
+
+    def check(self, now=None):
+        """Write the records when the first of them waited long enough."""
+        if not self.records:
+            return
+
+        now = time.monotonic() if now is None else now
+
+        if now >= self.due:
+            self.flush()
+
+    def flush(self):
+        """Hand the waiting records to the writer thread."""
+        records, self.records = self.records, []
+
+        if records:
+            self.put(records)
+
+    def put(self, batch):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run)
+                    self.thread.daemon = True
+                    self.thread.start()
+                    atexit.register(self.close)
+
+        self.queue.put(batch)
+
+    def join(self):
+        """Write the waiting records, and wait until everything is written."""
+        self.flush()
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+
+            try:
+                if batch is None:
+                    self.store.close()
+                    break
+
+                self.write(batch)
+            finally:
+                self.queue.task_done()
+
+    def write(self, batch):
+        try:
+            self.store.write(batch)
+            self.written += len(batch)
+        except Exception:
+            self.failed += len(batch)
+            logger.exception('Could not write %s messages to the log',
+                             len(batch))
+
+
+class SQLiteStore(object):
+    """Writes records to the messages table of a SQLite database.
+
+    The database uses write-ahead logging, so it can be read while it is
+    written to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(SCHEMA)
+        return connection
+
+    def write(self, records):
+        if self.connection is None:
+            self.connection = self.connect()
+
+        with self.connection:
+            self.connection.executemany(INSERT, records)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def records(self):
+        """Yield the records in the database, oldest first."""
+        connection = self.connect()
+
+        try:
+            for row in connection.execute('SELECT {} FROM messages ORDER BY '
+                                          'id'.format(', '.join(FIELDS))):
+                yield Record(*row)
+        finally:
+            connection.close()
+
+
+class SegmentStore(object):
+    """Appends records to segment files in a directory.
+
+    Every record is a JSON list on a line of its own. When a segment grew to
+    max_bytes, the next records go to a new one, so older segments never
+    change, and can be compressed, archived or removed.
+    """
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024,
+                 prefix='messages'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.pattern = re.compile(r'{}-(\d+)\.jsonl$'.format(
+            re.escape(prefix)))
+        self.file = None
+
+    def segments(self):
+        """Return the paths of the segments, oldest first."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+
+        numbered = sorted((int(m.group(1)), name) for m, name in
+                          ((self.pattern.match(name), name) for name in names)
+                          if m)
+        return [os.path.join(self.directory, name) for _, name in numbered]
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self.segments()
+        number = 0
+
+        if segments:
+            path = segments[-1]
+            number = int(self.pattern.search(path).group(1))
+
+            if os.path.getsize(path) >= self.max_bytes:
+                number += 1
+
+        self.file = open(os.path.join(self.directory, '{}-{:06d}.jsonl'.format(
+            self.prefix, number)), 'ab')
+
+    def write(self, records):
+        if self.file is None:
+            self.open()
+
+        self.file.write(''.join(
+            json.dumps(record, ensure_ascii=False, separators=(',', ':')) +
+            '\n' for record in records).encode('utf8'))
+        self.file.flush()
+
+        if self.file.tell() >= self.max_bytes:
+            self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def records(self):
+        """Yield the records in all segments, oldest first."""
+        for path in self.segments():
+            with open(path, encoding='utf8') as f:
+                for line in f:
+                    if line.endswith('\n'):
+                        yield Record(*json.loads(line))
@@ -0,0 +1,296 @@
+"""Counters and timings of commands, timers and connections.
+
+Every command and timer is counted under the module and name of its
+function: how often its patterns were tried and matched, how long it took
+to run, and how often it raised an exception. Next to that, the lines and
+bytes received, the bytes sent, the lines waiting to be sent and how late
+timers run are kept track of.
+
+The metrics can be read in three ways: with the `!stats` command from the
+commands of this package, as Prometheus text from a small HTTP server when
+the `metrics_port` setting is set, and by the functions in the
+`metrics_hooks` setting, which are called with the Metrics every
+`metrics_interval` seconds, like `log_metrics` below.
+"""
+import http.server
+import logging
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30,
+           float('inf'))
+
+logger = logging.getLogger(__name__)
+
+
+def handler_name(handler):
+    function = getattr(handler, 'function', None)
+
+    if function is None:
+        return 'message timer'
+
+    return '{}.{}'.format(function.__module__, function.__qualname__)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+        self.count += 1
+        self.sum += value
+
+    def add(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, fraction):
+        """The upper bound of the bucket holding the given fraction."""
+        if not self.count:
+            return 0
+
+        rank = fraction * self.count
+        total = 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+
+            if total >= rank:
+                return bound
+
+        return self.buckets[-1]
+
+    def cumulative(self):
+        total = 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+
+class HandlerMetrics(object):
+    __slots__ = ('attempts', 'hits', 'errors', 'time')
+
+    def __init__(self):
+        self.attempts = 0
+        self.hits = 0
+        self.errors = 0
+        self.time = Histogram()
+
+
+class Metrics(object):
+    """The metrics of a bot.
+
+    The statistics are kept per handler object, and only combined by the
+    name of the function when they are read, which keeps counting cheap.
+    Timers are copied for every connection, for example. They are keyed on
+    the id of the handler, as timers cannot be hashed.
+    """
+
+    def __init__(self, bot, hooks=(), interval=60):
+        self.bot = bot
+        self.handlers = {}
+        self.lines_in = 0
+        self.timer_lag = Histogram()
+        self.hooks = list(hooks)
+        self.interval = interval
+        self.next_report = time.monotonic() + interval
+
+    def stats(self, handler):
+        try:
+            return self.handlers[id(handler)][1]
+        except KeyError:
+            # The handler is kept, so its id is not reused, and for its name.
+            stats = HandlerMetrics()
+            self.handlers[id(handler)] = handler, stats
+            return stats
+
+    def attempt(self, handler, hit):
+        stats = self.stats(handler)
+        stats.attempts += 1
+
+        if hit:
+            stats.hits += 1
+
+    def ran(self, handler, seconds, error=False):
+        stats = self.stats(handler)
+        stats.time.observe(seconds)
+
+        if error:
+            stats.errors += 1
+
+    def by_name(self):
+        """Return the statistics of the handlers combined by name."""
+        combined = {}
+
+        for handler, stats in list(self.handlers.values()):
+            name = handler_name(handler)
+            total = combined.get(name)
+
+            if total is None:
+                total = combined[name] = HandlerMetrics()
+
+            total.attempts += stats.attempts
+            total.hits += stats.hits
+            total.errors += stats.errors
+            total.time.add(stats.time)
+
+        return combined
+
+    def networks(self):
+        """Yield the name and the traffic statistics of every connection."""
+        for connection in getattr(self.bot, 'connections', []):
+            settings = connection.settings
+            name = getattr(settings, 'name', None) or settings.host
+
+            yield name, {
+                'bytes_in': connection.bytes_in,
+                'bytes_out': connection.bytes_out,
+                'queue': len(connection.queue),
+            }
+
+    def snapshot(self):
+        handlers = {}
+
+        for name, stats in self.by_name().items():
+            handlers[name] = {
+                'attempts': stats.attempts,
+                'hits': stats.hits,
+                'errors': stats.errors,
+                'calls': stats.time.count,
+                'seconds': stats.time.sum,
+                'p50': stats.time.quantile(0.5),
+                'p99': stats.time.quantile(0.99),
+            }
+
+        return {
+            'handlers': handlers,
+            'lines_in': self.lines_in,
+            'networks': dict(self.networks()),
+            'timer_lag_p99': self.timer_lag.quantile(0.99),
+        }
+
+    def timeout(self, now=None):
+        if not self.hooks:
+            return None
+
+        now = time.monotonic() if now is None else now
+        return max(0, self.next_report - now)
+
+    def report(self, now=None):
+        """Call the hooks when they are due."""
+        now = time.monotonic() if now is None else now
+
+        if not self.hooks or now < self.next_report:
+            return
+
+        self.next_report = now + self.interval
+
+        for hook in self.hooks:
+            hook(self)
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text format."""
+        out = []
+
+        def metric(name, kind, help, samples):
+            out.append('# HELP pyromancer_{} {}'.format(name, help))
+            out.append('# TYPE pyromancer_{} {}'.format(name, kind))
+
+            for suffix, labels, value in samples:
+                labels = ','.join('{}="{}"'.format(k, escape(v))
+                                  for k, v in labels)
+                out.append('pyromancer_{}{}{} {}'.format(
+                    name, suffix, '{' + labels + '}' if labels else '',
+                    value))
+
+        def histogram(labels, h):
+            for bound, count in h.cumulative():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield '_bucket', labels + [('le', le)], count
+
+            yield '_sum', labels, h.sum
+            yield '_count', labels, h.count
+
+        handlers = sorted(self.by_name().items())
+        networks = sorted(self.networks())
+
+        for field in ('attempts', 'hits', 'errors'):
+            metric('handler_{}_total'.format(field), 'counter',
+                   'Handler {} by handler.'.format(field),
+                   [('', [('handler', name)], getattr(stats, field))
+                    for name, stats in handlers])
+
+        metric('handler_seconds', 'histogram', 'Time spent in handlers.',
+               [sample for name, stats in handlers for sample in
+                histogram([('handler', name)], stats.time)])
+        metric('lines_in_total', 'counter', 'Lines received.',
+               [('', [], self.lines_in)])
+
+        for field, kind, help in (
+                ('bytes_in', 'counter', 'Bytes received.'),
+                ('bytes_out', 'counter', 'Bytes sent.'),
+                ('queue', 'gauge', 'Lines waiting to be sent.')):
+            metric(field + ('_total' if kind == 'counter' else ''), kind,
+                   help, [('', [('network', name)], stats[field])
+                          for name, stats in networks])
+
+        metric('timer_lag_seconds', 'histogram',
+               'How late timers run.', list(histogram([], self.timer_lag)))
+        return '\n'.join(out) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve the Prometheus text on a port, from a separate thread."""
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = metrics.prometheus().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def log_metrics(metrics):
+    """Hook which logs the busiest handlers and the traffic."""
+    snapshot = metrics.snapshot()
+    handlers = sorted(snapshot['handlers'].items(),
+                      key=lambda item: item[1]['seconds'], reverse=True)
+
+    for name, stats in handlers[:10]:
+        logger.info('%s: %d hits of %d attempts, %d errors, %.3fs in total',
+                    name, stats['hits'], stats['attempts'], stats['errors'],
+                    stats['seconds'])
+
+    for name, stats in sorted(snapshot['networks'].items()):
+        logger.info('%s: %d bytes in, %d bytes out, %d lines queued', name,
+                    stats['bytes_in'], stats['bytes_out'], stats['queue'])
@@ -1,70 +1,368 @@
+import collections
+import copy
 import datetime
+import heapq
 import importlib
+import inspect
 import io
-import re
+import itertools
+import logging
 import select
+import selectors
 import socket
 import ssl
+import string
 import time
 
 from pyromancer import utils
+from pyromancer.exceptions import SettingsException, TimerException
+from pyromancer.metrics import Metrics
+from pyromancer.reloading import Reloader
+
+
+CASEMAPPINGS = {
+    'ascii': str.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+    'rfc1459': str.maketrans(string.ascii_uppercase + '[]\\~',
+                             string.ascii_lowercase + '{}|^'),
+    'strict-rfc1459': str.maketrans(string.ascii_uppercase + '[]\\',
+                                    string.ascii_lowercase + '{}|'),
+}
+
+
+# Seconds after which a timer for a datetime checks the wall clock again.
+WALL_CLOCK_CHECK = 60
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Bytes asked for by a single recv, which grows while a server sends a lot.
+MIN_READ_SIZE = 4096
+MAX_READ_SIZE = 65536
+
+# Bytes read from a connection in one cycle of the event loop.
+READ_LIMIT = 262144
+
+# Names of the methods of Settings and NetworkSettings, which settings must
+# not hide.
+RESERVED_SETTINGS = frozenset(['load', 'reload', 'resolve',
+                               'networks_settings'])
+
+logger = logging.getLogger(__name__)
 
 
 class Pyromancer(object):
+    message_log = None
+    workers = None
 
     def __init__(self, settings_path):
         self.settings = Settings(settings_path)
         self.setup_database()
         self.find_commands()
         self.find_timers()
+        self.reloader = Reloader(self.settings.packages)
+        self.metrics = Metrics(self, self.settings.metrics_hooks,
+                               self.settings.metrics_interval)
 
     def run(self):
         self.connect()
         self.listen()
 
     def connect(self):
-        self.connection = Connection(
-            self.settings.host, self.settings.port, self.settings.encoding,
-            self.settings.ssl)
+        self.connections = []
 
+        for settings in self.settings.networks_settings():
+            connection = Connection(settings.host, settings.port,
+                                    settings.encoding, settings.ssl)
+            self.register(connection, settings)
+
+        self.connection = self.connections[0]
+        self.schedule_timers()
+        self.start_workers()
+        self.start_metrics()
+        self.start_message_log()
+
+    def register(self, connection, settings):
         self.online = True
-        self.connect_time = datetime.datetime.now()
-        self.connection.write('NICK {}\n'.format(self.settings.nick))
-        self.connection.write('USER {0} {1} {1} :{2}\n'.format(
-            self.settings.nick, self.settings.host, self.settings.real_name))
-        self.connection.me.nick = self.settings.nick
+        connection.bot = self
+        connection.settings = settings
+        connection.buffer = LineBuffer(settings.encoding,
+                                       settings.fallback_encoding,
+                                       settings.max_line_length)
+        connection.queue = WriteQueue(settings.flood_rate,
+                                      settings.flood_burst)
+        connection.connect_time = datetime.datetime.now()
+
+        if settings.capabilities:
+            # The server waits with the registration until CAP END is sent,
+            # once the capabilities are negotiated.
+            connection.write('CAP LS 302', PRIORITY_HIGH)
+
+        connection.write('NICK {}\n'.format(settings.nick), PRIORITY_HIGH)
+        connection.write('USER {0} {1} {1} :{2}\n'.format(
+            settings.nick, settings.host, settings.real_name), PRIORITY_HIGH)
+        connection.me.nick = settings.nick
+        self.connections.append(connection)
+
+    def schedule_timers(self):
+        """Give every connection its own copy of the registered timers."""
+        self.timers = Scheduler(timer.bind(connection) for connection in
+                                self.connections for timer in self.timers)
+
+        if self.settings.reload_interval:
+            watch = Timer(datetime.timedelta(
+                seconds=self.settings.reload_interval), self.reload_changed)
+            self.timers.append(watch.bind(self.connections[0]))
+
+    def start_workers(self):
+        from pyromancer.workers import WorkerPool
+
+        self.workers = WorkerPool(self.settings.workers,
+                                  self.settings.worker_processes,
+                                  self.metrics, self.settings.shard_commands)
+        self.configure_workers()
+
+    def configure_workers(self):
+        """Let the worker processes find the current commands and settings."""
+        if self.workers is not None:
+            self.workers.configure(self.settings, self.commands,
+                                   [c.settings for c in self.connections])
+
+    def start_metrics(self):
+        if self.settings.metrics_port:
+            self.metrics.serve(self.settings.metrics_port)
+
+    def start_message_log(self):
+        if self.settings.message_log:
+            from pyromancer.history import get_history
+            from pyromancer.messagelog import MessageLog
+
+            store = self.settings.message_log
+
+            if isinstance(store, str):
+                store = get_history(self.settings)
+
+            self.message_log = MessageLog(
+                store, self.settings.message_log_verbs,
+                self.settings.message_log_batch_size,
+                self.settings.message_log_delay)
+
+    def fire(self, timer):
+        self.metrics.timer_lag.observe(max(0, time.monotonic() - timer.due))
+        connection = timer.connection
+        timer.fire(self.timers, connection, connection.settings, self.invoke)
 
     def listen(self):
         self.online = True
-        ticks = self.settings.ticks
+        selector = selectors.DefaultSelector()
+
+        for connection in self.connections:
+            selector.register(connection.socket, selectors.EVENT_READ,
+                              connection)
+
+        # Wake up when an offloaded command finishes.
+        selector.register(self.workers.receiver, selectors.EVENT_READ)
+
+        try:
+            while self.online:
+                # Block until a server sends something, a blocked write can
+                # continue, or the first timer or queued line is due.
+                for key, events in selector.select(self.timeout()):
+                    if key.data is not None and events & selectors.EVENT_READ:
+                        key.data.read()
+
+                for connection in list(self.connections):
+                    # The rest of a burst is handled in the next cycles, so
+                    # timers and other connections are not held up.
+                    limit = None if connection.closed else \
+                        connection.settings.lines_per_cycle
+
+                    lines = connection.buffer.lines(limit)
+                    self.metrics.lines_in += len(lines)
+
+                    for line in lines:
+                        self.process(line, connection)
+
+                    if connection.closed:
+                        selector.unregister(connection.socket)
+                        self.disconnect(connection)
+
+                self.workers.collect(self.timers)
+                self.timers.run(self.fire)
+                self.metrics.report()
+
+                if self.message_log is not None:
+                    self.message_log.check()
+
+                for connection in self.connections:
+                    connection.flush()
+
+                    # Only wait for writability while a write is blocked.
+                    events = selectors.EVENT_READ
+                    if connection.outgoing:
+                        events |= selectors.EVENT_WRITE
+
+                    if selector.get_key(connection.socket).events != events:
+                        selector.modify(connection.socket, events, connection)
+        finally:
+            selector.close()
+            self.workers.shutdown()
+
+            if self.message_log is not None:
+                self.message_log.close()
+
+    def disconnect(self, connection):
+        self.connections.remove(connection)
+
+        for timer in list(self.timers):
+            if timer.connection is connection:
+                self.timers.remove(timer)
+
+        if not self.connections:
+            self.online = False
+
+    def timeout(self):
+        """Seconds the event loop may sleep before a timer or line is due.
+
+        Returns None, which means sleeping until there is data to read or a
+        blocked write can continue, when no timers are registered and no
+        lines are waiting to be sent.
+        """
+        if any(c.buffer.has_lines() for c in self.connections):
+            return 0
+
+        # While a write is blocked, the socket is watched for writability
+        # instead, as queued lines cannot be sent before it drains.
+        timeouts = [c.queue.delay() for c in self.connections
+                    if len(c.queue) and not c.outgoing]
+
+        for timeout in (self.timers.timeout(), self.workers.timeout(),
+                        self.metrics.timeout(), self.message_log and
+                        self.message_log.timeout()):
+            if timeout is not None:
+                timeouts.append(timeout)
+
+        if not timeouts:
+            return None
+
+        return max(0, min(timeouts))
+
+    def process(self, line, connection):
+        line = Line(line, connection)
+
+        if line.verb == 'PING':
+            connection.write('PONG :{}'.format(line.params[0] if
+                                               line.params else ''),
+                             PRIORITY_HIGH)
+        elif line.verb == 'CAP':
+            connection.negotiate(line, connection.settings.capabilities)
+
+        if self.message_log is not None:
+            self.message_log.add(line, connection)
+
+        settings = connection.settings
+
+        if line.usermsg:
+            matches = self.index.match(line, settings, misses=True)
+        else:
+            matches = ((c, c.matches(line, settings)) for c in
+                       self.index.candidates(line))
+
+        for command, m in matches:
+            self.metrics.attempt(command, m)
+
+            if m:
+                line.resolve()
+                self.invoke(command, Match(m, line, connection, settings))
+
+    def invoke(self, handler, match):
+        """Call a matching command or a due timer."""
+        if self.workers is not None and self.workers.executor_of(handler):
+            self.workers.submit(handler, match)
+            return
+
+        start = time.perf_counter()
+        error = True
 
-        while self.online:
-            self.connection.read()
+        try:
+            handler.call(match, self.timers)
+            match.finish()
+            error = False
+        finally:
+            if error:
+                match.finish(error)
+
+            self.metrics.ran(handler, time.perf_counter() - start, error)
+
+    def reload_settings(self):
+        """Import the settings modules again, while staying connected.
+
+        The connections keep the overrides of their network, so adding or
+        removing networks needs a restart. Like the flood limit, settings
+        which are only read when connecting do not change either.
+        """
+        self.settings.reload()
+
+        for connection in getattr(self, 'connections', []):
+            if connection.settings is not self.settings:
+                connection.settings.resolve()
 
-            for line in self.connection.buffer.lines():
-                self.process(line)
+        self.configure_workers()
+
+    def reload_commands(self):
+        """Import the changed command and timer modules again, while staying
+        connected.
+
+        The commands and timers are found again afterwards. Timers of the
+        reloaded modules start over, and the other timers are left alone.
+        Returns the names of the reloaded modules, and the names and
+        exceptions of the modules which failed to reload.
+        """
+        reloaded, errors = self.reloader.reload()
+
+        if not reloaded:
+            return reloaded, errors
+
+        scheduler = self.timers
+        self.find_commands()
+        self.find_timers()
+        self.configure_workers()
+
+        if isinstance(scheduler, Scheduler):
+            changed = set(reloaded)
+
+            def reloaded_timer(timer):
+                return hasattr(timer.function, 'timer') and \
+                    timer.function.__module__ in changed
+
+            for timer in list(scheduler):
+                if reloaded_timer(timer):
+                    scheduler.remove(timer)
 
             for timer in self.timers:
-                timer.match(self.timers, self.connect_time, self.connection,
-                            self.settings)
+                if reloaded_timer(timer):
+                    for connection in self.connections:
+                        scheduler.append(timer.bind(connection))
+
+            self.timers = scheduler
 
-            time.sleep(1.0 / ticks)
+        return reloaded, errors
 
-    def process(self, line):
-        line = Line(line, self.connection)
+    def reload_changed(self, match):
+        """Timer which reloads the modules which changed."""
+        reloaded, errors = self.reload_commands()
 
-        if line[0] == 'PING':
-            self.connection.write('PONG {}\n'.format(line[1]))
+        if reloaded:
+            logger.info('Reloaded %s', ', '.join(reloaded))
 
-        for c in self.commands:
-            c.command.match(line, self.timers, self.connection, self.settings)
+        for name, e in errors:
+            logger.error('Could not reload %s: %s', name, e)
 
     def find_commands(self):
-        self.commands = []
+        from pyromancer.dispatch import CommandIndex
 
-        utils.find_functions(
-            self.settings.packages, self.commands, 'commands',
-            'disabled_commands', when=lambda f: hasattr(f, 'command'))
+        self.commands = find_commands(self.settings)
+        self.index = CommandIndex(self.commands)
 
     def find_timers(self):
         self.timers = []
@@ -75,11 +373,9 @@ class Pyromancer(object):
 
     def setup_database(self):
         if self.settings.database:
-            from sqlalchemy import create_engine
+            from pyromancer.database import Session, Base, get_engine
 
-            from pyromancer.database import Session, Base
-
-            engine = create_engine(self.settings.database)
+            engine = get_engine(self.settings)
             Session.configure(bind=engine)
 
             for package in self.settings.packages:
@@ -96,77 +392,339 @@ class Pyromancer(object):
             Base.metadata.create_all(bind=engine)
 
 
+def find_commands(settings):
+    """Return the command functions of the packages in the settings."""
+    if settings.command_manifest:
+        from pyromancer import manifest
+
+        return manifest.find_commands(settings.packages,
+                                      settings.command_manifest)
+
+    commands = []
+    utils.find_functions(settings.packages, commands, 'commands',
+                         'disabled_commands',
+                         when=lambda f: hasattr(f, 'command'))
+    return commands
+
+
+def settings_of(obj, reserved=()):
+    """Return the settings in a module or object.
+
+    Dunders and modules, such as the imports of a settings module, are not
+    settings. A setting with a reserved name raises a SettingsException.
+    """
+    values = {}
+
+    for name, value in vars(obj).items():
+        if name.startswith('__') or inspect.ismodule(value):
+            continue
+
+        if name in reserved:
+            raise SettingsException(
+                'The setting "{}" in {} has the name of an attribute of the '
+                'settings'.format(name, getattr(obj, '__name__', obj)))
+
+        values[name] = value
+
+    return values
+
+
 class Settings(object):
+    """The settings of the bot, from the settings modules of all packages.
+
+    The settings are looked up once, when they are loaded, and stored as
+    attributes, so reading a setting is a plain attribute lookup. The
+    settings of the first package which has a setting win, and the
+    defaults in pyromancer.settings come last. Call reload to import the
+    settings modules again.
+    """
 
     def __init__(self, path):
-        main_settings = importlib.import_module(path)
-        self.packages = getattr(main_settings, 'packages', [])
-        self.package_settings = {}
-        self.package_name, _ = path.split('.', 1)
+        self._path = path
+        self.load()
+
+    def load(self, reload=False):
+        main_settings = importlib.import_module(self._path)
 
-        if self.package_name not in self.packages:
-            self.packages.insert(0, self.package_name)
+        if reload:
+            main_settings = utils.reload_module(main_settings)
 
-        for package in self.packages:
+        packages = getattr(main_settings, 'packages', [])
+        package_settings = {}
+        package_name, _ = self._path.split('.', 1)
+
+        if package_name not in packages:
+            packages.insert(0, package_name)
+
+        for package in packages:
             if isinstance(package, tuple):
                 package = package[0]
 
-            if package == self.package_name:
+            if package == package_name:
                 module = main_settings
             else:
                 module = importlib.import_module('{}.settings'.format(package))
 
-            self.package_settings[package] = module
+                if reload:
+                    module = utils.reload_module(module)
 
-        self.global_settings = None
-        if 'pyromancer' not in self.packages:
-            self.global_settings = importlib.import_module(
-                'pyromancer.settings')
+            package_settings[package] = module
 
-    def __getattr__(self, item):
-        for package in self.packages:
-            if isinstance(package, tuple):
-                package = package[0]
+        global_settings = None
+        if 'pyromancer' not in packages:
+            global_settings = importlib.import_module('pyromancer.settings')
+
+            if reload:
+                global_settings = utils.reload_module(global_settings)
+
+        modules = [global_settings] + [
+            package_settings[p[0] if isinstance(p, tuple) else p]
+            for p in reversed(packages)]
+
+        values = {}
+        for module in modules:
+            if module is not None:
+                values.update(settings_of(module, RESERVED_SETTINGS))
+
+        # The attributes of the settings themselves start with an
+        # underscore, so they do not get in the way of any settings.
+        values.update(packages=packages, _path=self._path,
+                      _package_settings=package_settings,
+                      _package_name=package_name,
+                      _global_settings=global_settings)
+
+        self.__dict__.clear()
+        self.__dict__.update(values)
+
+    def reload(self):
+        """Import the settings modules again and use their settings."""
+        self.load(reload=True)
 
-            if hasattr(self.package_settings[package], item):
-                return getattr(self.package_settings[package], item)
+    def __reduce__(self):
+        # The settings modules cannot be pickled, so a process which gets
+        # the settings, such as a worker, imports them again.
+        return Settings, (self._path,)
 
-        if hasattr(self.global_settings, item):
-            return getattr(self.global_settings, item)
+    def networks_settings(self):
+        """Return the settings for each of the networks to connect to.
 
+        Every network in the networks setting is a dict which overrides any
+        of the other settings for that network only. Without any networks,
+        the bot connects to the single network of the main settings.
+        """
+        if not self.networks:
+            return [self]
+
+        return [NetworkSettings(self, network) for network in self.networks]
+
+    def __getattr__(self, item):
         raise AttributeError('No such setting "{}" found in any of the '
                              'installed packages'.format(item))
 
 
+class NetworkSettings(object):
+    """The settings of one network, which override the main settings.
+
+    Like the main settings, they are stored as attributes. Call resolve
+    after the main settings were reloaded.
+    """
+
+    def __init__(self, settings, overrides):
+        self._settings = settings
+        self._overrides = overrides
+        self.resolve()
+
+    def resolve(self):
+        values = settings_of(self._settings)
+
+        for name in self._overrides:
+            if name in RESERVED_SETTINGS:
+                raise SettingsException(
+                    'The setting "{}" of a network has the name of an '
+                    'attribute of the settings'.format(name))
+
+        values.update(self._overrides)
+        values.update(_settings=self._settings, _overrides=self._overrides)
+
+        self.__dict__.clear()
+        self.__dict__.update(values)
+
+    def __reduce__(self):
+        return NetworkSettings, (self._settings, self._overrides)
+
+    def __getattr__(self, item):
+        # Methods of the main settings, and settings which were added to it
+        # later on, such as in tests.
+        if item.startswith('__') or item == '_settings':
+            raise AttributeError(item)
+
+        return getattr(self._settings, item)
+
+
 class LineBuffer(object):
-    """Line buffer based on irc library's DecodingLineBuffer.
+    """Buffer which splits the data received from a server into lines.
 
-    See https://bitbucket.org/jaraco/irc
+    Data is read straight into a bytearray with read_from, or added with
+    feed. Only the data after the last complete line is searched for a line
+    end again, so a line which arrives in many pieces is not scanned over
+    and over. Lines longer than max_line_length are dropped, and lines which
+    are not valid in the encoding are decoded with the fallback encoding.
     """
-    line_sep_exp = re.compile(b'\r?\n')
 
-    def __init__(self, encoding='utf-8'):
-        self.buffer = b''
+    def __init__(self, encoding='utf-8', fallback_encoding='latin-1',
+                 max_line_length=None):
+        self.buffer = bytearray()
         self.encoding = encoding
+        self.fallback_encoding = fallback_encoding
+        self.max_line_length = max_line_length
+
+        # Offset from which to look for the next line end.
+        self.scanned = 0
+
+        # Whether the rest of a line which was too long is dropped.
+        self.discarding = False
 
     def feed(self, bytes):
         self.buffer += bytes
 
-    def lines(self):
-        lines = self.line_sep_exp.split(self.buffer)
-        # save the last, unfinished, possibly empty line
-        self.buffer = lines.pop()
+    def read_from(self, socket, bytes=4096):
+        """Receive data from a socket into the buffer.
+
+        Returns the number of bytes received, which is 0 when the socket
+        was closed.
+        """
+        buffer = self.buffer
+        length = len(buffer)
+        buffer.extend(bytearray(bytes))
+        received = 0
 
-        for line in lines:
-            yield line.decode(self.encoding, 'strict')
+        # The slice is released explicitly, since the traceback of an
+        # exception, such as SSLWantReadError, would keep it alive and the
+        # buffer could not be resized.
+        view = memoryview(buffer)
+        free = view[length:]
+
+        try:
+            received = socket.recv_into(free, bytes)
+        finally:
+            free.release()
+            view.release()
+            del buffer[length + received:]
+
+        return received
+
+    def lines(self, limit=None):
+        """Return the complete lines in the buffer, at most limit of them.
+
+        Lines over the limit are kept for the next call.
+        """
+        buffer = self.buffer
+        lines = []
+        start = 0
+        end = buffer.find(b'\n', self.scanned)
+
+        with memoryview(buffer) as view:
+            while end >= 0 and (limit is None or len(lines) < limit):
+                stop = end - 1 if end > start and buffer[end - 1] == 13 \
+                    else end
+
+                if self.discarding:
+                    self.discarding = False
+                elif self.max_line_length is None or \
+                        stop - start <= self.max_line_length:
+                    lines.append(self.decode(view[start:stop]))
+
+                start = end + 1
+                end = buffer.find(b'\n', start)
+
+        del buffer[:start]
+
+        if end >= 0:
+            self.scanned = 0
+            return lines
+
+        self.scanned = len(buffer)
+
+        if self.max_line_length is not None and \
+                len(buffer) > self.max_line_length:
+            # Do not keep collecting a line which will be dropped anyway.
+            del buffer[:]
+            self.scanned = 0
+            self.discarding = True
+
+        return lines
+
+    def has_lines(self):
+        return self.buffer.find(b'\n', self.scanned) >= 0
+
+    def decode(self, line):
+        try:
+            return str(line, self.encoding)
+        except UnicodeDecodeError:
+            return str(line, self.fallback_encoding, 'replace')
 
     def __iter__(self):
-        return self.lines()
+        return iter(self.lines())
 
     def __len__(self):
         return len(self.buffer)
 
 
+class WriteQueue(object):
+    """Lines waiting to be sent, with priorities and flood control.
+
+    Lines are taken from the lane with the highest priority first. A token
+    bucket limits the number of lines sent: it holds at most burst tokens,
+    gains rate tokens per second and every line takes a token. Lines with
+    a high priority, such as PONG replies, are never held back. A rate of
+    None disables the flood control.
+    """
+
+    def __init__(self, rate=None, burst=5):
+        self.lanes = [collections.deque() for _ in range(PRIORITY_LOW + 1)]
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    def put(self, data, priority=PRIORITY_NORMAL):
+        self.lanes[priority].append(data)
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) * self.rate)
+
+        self.updated = now
+
+    def take(self, now=None):
+        """Remove and return the lines which may be sent right now."""
+        self.refill(time.monotonic() if now is None else now)
+
+        lines = list(self.lanes[PRIORITY_HIGH])
+        self.lanes[PRIORITY_HIGH].clear()
+
+        for lane in self.lanes[PRIORITY_HIGH + 1:]:
+            while lane and (not self.rate or self.tokens >= 1):
+                lines.append(lane.popleft())
+
+                if self.rate:
+                    self.tokens -= 1
+
+        return lines
+
+    def delay(self, now=None):
+        """Seconds until the next queued line may be sent."""
+        if self.lanes[PRIORITY_HIGH] or not self.rate:
+            return 0
+
+        self.refill(time.monotonic() if now is None else now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+
 class Connection(object):
 
     def __init__(self, host, port, encoding='utf8', use_ssl=False):
@@ -177,7 +735,7 @@ class Connection(object):
         self.socket.setblocking(False)
 
         if use_ssl:
-            self.socket = ssl.wrap_socket(
+            self.socket = self.ssl_context().wrap_socket(
                 self.socket, do_handshake_on_connect=False)
 
             # We need to do the handshake manually, because we use a
@@ -194,46 +752,244 @@ class Connection(object):
 
         self.encoding = encoding
         self.buffer = LineBuffer(self.encoding)
-
+        self.read_size = MIN_READ_SIZE
+        self.queue = WriteQueue()
+        self.outgoing = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.closed = False
+        self.reset()
+
+    def reset(self):
+        """Forget all users, channels and server features."""
         self.me = User('')
+        self.user_map = {}
+        self.channel_map = {}
+        self.isupport = {}
+        self.caps = set()
+        self.available_caps = set()
+        self.whois_requested = set()
+        self.set_casemapping('rfc1459')
+
+    @staticmethod
+    def ssl_context():
+        # Like the old ssl.wrap_socket, the server certificate is not
+        # verified.
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        return context
 
     @property
     def users(self):
-        users = [self.me]
-        for chan in self.me.channels:
-            users.extend(chan.users)
-
-        return list(set(users))
+        return [self.me] + [u for u in self.user_map.values()
+                            if u is not self.me]
 
     @property
     def channels(self):
-        return self.me.channels
+        return list(self.channel_map.values())
+
+    def set_casemapping(self, casemapping):
+        """Change how nicks and channel names are compared.
+
+        The casemapping is usually sent by the server in the ISUPPORT
+        numeric, and is one of rfc1459 (the default), strict-rfc1459 and
+        ascii.
+        """
+        self.casemapping = casemapping
+        self.case_table = CASEMAPPINGS.get(casemapping,
+                                           CASEMAPPINGS['rfc1459'])
+
+        self.user_map = dict((self.lower(u.nick), u) for u in
+                             self.user_map.values())
+        self.channel_map = dict((self.lower(c.name), c) for c in
+                                self.channel_map.values())
+
+    def lower(self, name):
+        return name.translate(self.case_table)
+
+    def get_user(self, nick):
+        key = self.lower(nick)
+
+        if self.me.nick and key == self.lower(self.me.nick):
+            return self.me
+
+        return self.user_map.get(key)
+
+    def get_channel(self, name):
+        return self.channel_map.get(self.lower(name))
+
+    def rename(self, user, nick):
+        if user is not self.me:
+            self.user_map.pop(self.lower(user.nick), None)
+            self.user_map[self.lower(nick)] = user
+
+        user.nick = nick
+
+    def join(self, user, channel):
+        """Register that a user is in a channel."""
+        if user is self.me:
+            self.channel_map[self.lower(channel.name)] = channel
+        else:
+            self.user_map[self.lower(user.nick)] = user
+
+        channel.users.add(user)
+
+    def part(self, user, channel):
+        """Register that a user left a channel.
+
+        When the bot itself leaves, the channel and the users which are no
+        longer in any other known channel are forgotten.
+        """
+        channel.users.discard(user)
+
+        if user is self.me:
+            self.channel_map.pop(self.lower(channel.name), None)
+
+            for other in list(channel.users):
+                self.part(other, channel)
+        elif not self.channels_of(user):
+            self.user_map.pop(self.lower(user.nick), None)
+
+    def quit(self, user):
+        for channel in self.channels_of(user):
+            self.part(user, channel)
+
+    def channels_of(self, user):
+        """Return the known channels a user is in.
+
+        Membership is only kept on the channels, as a bot is usually in far
+        fewer channels than it knows users.
+        """
+        return [c for c in self.channel_map.values() if user in c.users]
+
+    def negotiate(self, line, capabilities):
+        """Request the wanted capabilities the server offers in a CAP line.
+
+        Once the server acknowledged or refused them, or offers none of
+        them, CAP END is sent, after which the server finishes the
+        registration.
+        """
+        params = line.params
+        subcommand = params[1] if len(params) > 1 else ''
+        caps = params[-1].split() if params else []
+
+        if subcommand == 'LS':
+            self.available_caps.update(c.split('=', 1)[0] for c in caps)
+
+            # A multiline reply has an asterisk before the last parameter.
+            if len(params) > 3 and params[2] == '*':
+                return
+
+            wanted = [c for c in capabilities if c in self.available_caps]
+
+            if wanted:
+                self.write('CAP REQ :{}'.format(' '.join(wanted)),
+                           PRIORITY_HIGH)
+            else:
+                self.write('CAP END', PRIORITY_HIGH)
+        elif subcommand == 'ACK':
+            for c in caps:
+                if c.startswith('-'):
+                    self.caps.discard(c[1:])
+                else:
+                    self.caps.add(c)
+
+            self.write('CAP END', PRIORITY_HIGH)
+        elif subcommand == 'NAK':
+            self.write('CAP END', PRIORITY_HIGH)
+        elif subcommand == 'DEL':
+            self.caps.difference_update(caps)
+
+    def write(self, data, priority=PRIORITY_NORMAL):
+        """Queue a line to be sent to the server.
+
+        Lines are sent when the event loop flushes the connection, in order
+        of priority and as fast as the flood limit allows.
+        """
+        self.queue.put('{}\n'.format(data).encode(self.encoding), priority)
+
+    def flush(self):
+        """Send as many queued lines as the socket and flood limit allow."""
+        if len(self.outgoing) < 4096:
+            self.outgoing += b''.join(self.queue.take())
 
-    def write(self, data):
-        self.socket.send('{}\n'.format(data).encode(self.encoding))
+        if not self.outgoing:
+            return
 
-    def read(self, bytes=4096):
         try:
-            self.buffer.feed(self.socket.recv(bytes))
-        except (io.BlockingIOError, ssl.SSLWantReadError):
-            pass
+            sent = self.socket.send(self.outgoing)
+        except (io.BlockingIOError, ssl.SSLWantWriteError,
+                ssl.SSLWantReadError):
+            return
+        except OSError:
+            # The server is gone. What it sent before is still read, after
+            # which the read finds out the connection is closed.
+            del self.outgoing[:]
+            return
+
+        del self.outgoing[:sent]
+        self.bytes_out += sent
+
+    def read(self, limit=READ_LIMIT):
+        """Receive data until the socket is drained.
+
+        Reading stops early when the buffer holds limit bytes which have
+        not been handled yet, so the rest of a burst waits in the socket.
+        """
+        while len(self.buffer) < limit:
+            size = self.read_size
+
+            try:
+                received = self.buffer.read_from(self.socket, size)
+            except (io.BlockingIOError, ssl.SSLWantReadError):
+                break
+            except OSError:
+                self.closed = True
+                return
+
+            self.bytes_in += received
+
+            if not received:
+                # The server closed the connection.
+                self.closed = True
+                return
+
+            self.adapt_read_size(received)
+
+            if received < size:
+                # The socket is most likely drained.
+                break
+
+        # An SSL socket may already hold decrypted data which the selector
+        # will not report as readable anymore, so collect that as well.
+        pending = getattr(self.socket, 'pending', None)
+        while pending is not None and pending():
+            self.bytes_in += self.buffer.read_from(self.socket, pending())
+
+    def adapt_read_size(self, received):
+        """Read more at once during a burst, and less again afterwards."""
+        if received >= self.read_size:
+            self.read_size = min(self.read_size * 2, MAX_READ_SIZE)
+        elif received < self.read_size // 4:
+            self.read_size = max(self.read_size // 2, MIN_READ_SIZE)
 
     def msg(self, target, msg):
         self.write('PRIVMSG {} :{}'.format(target,  msg))
 
 
 class User(object):
-    name = None
-    host = None
-    auth = None
+    __slots__ = ('nick', 'name', 'host', 'auth')
 
     def __init__(self, str):
         if '@' in str:
             self.nick, self.name, self.host = self.split_user_str(str)
         else:
             self.nick = str
+            self.name = None
+            self.host = None
 
-        self.channels = []
+        self.auth = None
 
     def __repr__(self):
         return '{0.nick}@{0.host}'.format(self) if self.nick else self.host
@@ -249,24 +1005,25 @@ class User(object):
         if isinstance(pool, Match):
             pool = pool.connection
 
-        if isinstance(pool, Connection):
-            pool = pool.users
-
         if '@' in user_str:
             nick, _, _ = cls.split_user_str(user_str)
         else:
             nick = user_str
 
+        if isinstance(pool, Connection):
+            return pool.get_user(nick)
+
         for user in pool:
             if user.nick == nick:
                 return user
 
 
 class Channel(object):
+    __slots__ = ('name', 'users')
 
     def __init__(self, name):
         self.name = name.lstrip(':')
-        self.users = []
+        self.users = set()
 
     def __repr__(self):
         return self.name
@@ -276,11 +1033,11 @@ class Channel(object):
         if isinstance(pool, Match):
             pool = pool.connection
 
-        if isinstance(pool, Connection):
-            pool = pool.channels
-
         name = name.lstrip(':')
 
+        if isinstance(pool, Connection):
+            return pool.get_channel(name)
+
         for chan in pool:
             if chan.name == name:
                 return chan
@@ -297,12 +1054,14 @@ class Match(object):
     Later on, it should provide some utility functions for messaging and other
     things a command may like to do.
     """
+    __slots__ = ('match', 'line', 'connection', 'settings', 'scope')
 
     def __init__(self, match, line, connection, settings=None):
         self.match = match
         self.line = line
         self.connection = connection
         self.settings = settings
+        self.scope = None
 
     def __getitem__(self, item):
         try:
@@ -352,22 +1111,95 @@ class Match(object):
 
         self.connection.msg(target, message)
 
-CODE_PATTERN = re.compile(r'\d{3}')
-COMMAND_PATTERN = re.compile(r'[A-Z]{4,5}')
+    @property
+    def session(self):
+        """Database session, which is committed when the command or timer
+        finished, or rolled back when it raised an exception."""
+        return self.database_scope().session
+
+    @property
+    def async_session(self):
+        """Like session, but an AsyncSession of the async_database, for
+        coroutine commands and timers."""
+        return self.database_scope().async_session
+
+    def database_scope(self):
+        if self.scope is None:
+            from pyromancer.database import Scope
+
+            self.scope = Scope(self.settings)
+
+        return self.scope
+
+    @property
+    def history(self):
+        """The History of the message log, to search received messages."""
+        from pyromancer.history import get_history
+
+        return get_history(self.settings)
+
+    def save(self, *instances):
+        """Add new instances of models to the database in the background,
+        along with other small writes in one transaction."""
+        from pyromancer.database import write_behind
+
+        write_behind(self.settings).add(*instances)
+
+    def finish(self, error=False):
+        """Commit or roll back the database sessions of the match."""
+        if self.scope is not None:
+            scope, self.scope = self.scope, None
+            scope.finish(error)
+
+    async def finish_async(self, error=False):
+        if self.scope is not None:
+            scope, self.scope = self.scope, None
+            await scope.finish_async(error)
+
+
+TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+
+def unescape_tag(value):
+    if '\\' not in value:
+        return value
+
+    chars = []
+    escaped = False
+
+    for char in value:
+        if escaped:
+            chars.append(TAG_ESCAPES.get(char, char))
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        else:
+            chars.append(char)
+
+    return ''.join(chars)
 
 
 class Line(object):
+    """A line received from the server.
+
+    Only the data and the time of arrival are stored when a line is created.
+    The line is split into its IRCv3 tags, prefix, command and parameters the
+    first time any of those are needed, and everything else, such as the
+    sender and the channel, is worked out on first access and then cached.
+    """
+    __slots__ = ('data', 'connection', 'time', '_tagstr', '_tags', '_prefix',
+                 '_verb', '_params', '_raw', '_parts', '_words', '_sender',
+                 '_channel', '_datetime')
 
     def __init__(self, data, connection):
-        self.raw = data.lstrip(':')
-        self.datetime = datetime.datetime.now()
+        self.data = data
         self.connection = connection
-        self.parse()
+        self.time = time.time()
 
     def __getitem__(self, item):
         try:
             if self.usermsg:
-                return self.full_msg.split(' ')[item]
+                return self.words[item]
             else:
                 return self.parts[item]
         except IndexError:
@@ -378,45 +1210,249 @@ class Line(object):
             self.raw
 
     def parse(self):
-        self.parts = self.raw.split()
-        self.privmsg = self.parts[1] == 'PRIVMSG'
-        self.notice = self.parts[1] == 'NOTICE'
-        self.usermsg = self.privmsg or self.notice
+        """Split the line into tags, prefix, command and parameters."""
+        data = self.data
+        tagstr = None
+
+        if data.startswith('@'):
+            tagstr, _, data = data[1:].partition(' ')
+            data = data.lstrip(' ')
+
+        self._raw = data.lstrip(':')
+        prefix = None
+
+        if data.startswith(':'):
+            prefix, _, data = data[1:].partition(' ')
+
+        data, trailing, text = data.partition(' :')
+        params = data.split()
 
+        if trailing:
+            params.append(text)
+
+        self._tagstr = tagstr
+        self._prefix = prefix
+        self._verb = params.pop(0) if params else ''
+        self._params = params
+
+    @property
+    def raw(self):
+        """The line without tags and without the leading colon."""
+        try:
+            return self._raw
+        except AttributeError:
+            self.parse()
+            return self._raw
+
+    @property
+    def prefix(self):
+        try:
+            return self._prefix
+        except AttributeError:
+            self.parse()
+            return self._prefix
+
+    @property
+    def verb(self):
+        """The IRC command or numeric of the line, such as PRIVMSG or 376."""
+        try:
+            return self._verb
+        except AttributeError:
+            self.parse()
+            return self._verb
+
+    @property
+    def params(self):
+        try:
+            return self._params
+        except AttributeError:
+            self.parse()
+            return self._params
+
+    @property
+    def tags(self):
+        """The IRCv3 message tags of the line, as a dict."""
+        try:
+            return self._tags
+        except AttributeError:
+            pass
+
+        if not hasattr(self, '_tagstr'):
+            self.parse()
+
+        tags = {}
+
+        if self._tagstr:
+            for tag in self._tagstr.split(';'):
+                key, _, value = tag.partition('=')
+                tags[key] = unescape_tag(value)
+
+        self._tags = tags
+        return tags
+
+    @property
+    def parts(self):
+        try:
+            return self._parts
+        except AttributeError:
+            self._parts = self.raw.split()
+            return self._parts
+
+    @property
+    def words(self):
+        try:
+            return self._words
+        except AttributeError:
+            self._words = self.full_msg.split(' ')
+            return self._words
+
+    @property
+    def privmsg(self):
+        return self.verb == 'PRIVMSG'
+
+    @property
+    def notice(self):
+        return self.verb == 'NOTICE'
+
+    @property
+    def usermsg(self):
+        return self.verb in ('PRIVMSG', 'NOTICE')
+
+    @property
+    def code(self):
+        verb = self.verb
+        return int(verb) if len(verb) == 3 and verb.isdigit() else None
+
+    @property
+    def command(self):
+        verb = self.verb
+
+        if verb.isalpha() and verb.isupper() and not self.usermsg:
+            return verb
+
+    @property
+    def target(self):
+        if self.usermsg and self.params:
+            return self.params[0]
+
+    @property
+    def pm(self):
+        target = self.target
+        return target is not None and not self.is_channel(target)
+
+    @property
+    def full_msg(self):
         if self.usermsg:
-            # ":Nick!Name@Host PRIVMSG #Chan :Hello world!"
-            self.target = self.parts[2]
-            self.pm = self.target[0] != '#'
-            self.full_msg = ' '.join(self.parts[3:])[1:]
-        elif CODE_PATTERN.match(self.parts[1]):
-            self.code = int(self.parts[1])
-        elif COMMAND_PATTERN.match(self.parts[1]):
-            self.command = self.parts[1]
+            return self.params[1] if len(self.params) > 1 else ''
+
+    @property
+    def datetime(self):
+        """When the line was sent, from the server-time tag if available."""
+        try:
+            return self._datetime
+        except AttributeError:
+            pass
+
+        timestamp = self.time
+        server_time = self.tags.get('time')
+
+        if server_time:
+            try:
+                timestamp = datetime.datetime.strptime(
+                    server_time.rstrip('Z'), '%Y-%m-%dT%H:%M:%S.%f').replace(
+                    tzinfo=datetime.timezone.utc).timestamp()
+            except ValueError:
+                pass
 
-        if self.usermsg or getattr(self, 'command', None):
-            self.sender = User.get(self.parts[0], self.connection)
+        self._datetime = datetime.datetime.fromtimestamp(timestamp)
+        return self._datetime
 
-            if not self.sender:
-                self.sender = User(self.parts[0])
+    @property
+    def sender(self):
+        try:
+            return self._sender
+        except AttributeError:
+            pass
 
-            self.channel = None
-            if not getattr(self, 'pm', False):
-                self.channel = Channel.get(self.parts[2], self.connection)
+        sender = None
 
-                if not self.channel:
-                    self.channel = Channel(self.parts[2])
+        if self.prefix and (self.usermsg or self.command):
+            if self.connection is not None:
+                sender = User.get(self.prefix, self.connection)
+
+            if not sender:
+                sender = User(self.prefix)
+
+        self._sender = sender
+        return sender
+
+    @property
+    def channel(self):
+        try:
+            return self._channel
+        except AttributeError:
+            pass
+
+        channel = None
+
+        if (self.usermsg or self.command) and self.params and \
+                self.is_channel(self.params[0]):
+            if self.connection is not None:
+                channel = Channel.get(self.params[0], self.connection)
+
+            if not channel:
+                channel = Channel(self.params[0])
+
+        self._channel = channel
+        return channel
+
+    def is_channel(self, name):
+        chantypes = '#&'
+        if self.connection is not None:
+            chantypes = self.connection.isupport.get('CHANTYPES', chantypes)
+
+        return name[:1] in chantypes
+
+    def resolve(self):
+        """Look up the sender and channel before any command changes them."""
+        self.sender
+        self.channel
 
 
 class Timer(object):
+    """A message or function which is scheduled to run later.
+
+    Timers scheduled with a timedelta run periodically on the monotonic
+    clock. With the default rate mode they run at a fixed rate, so they do
+    not drift, and with the delay mode the period starts after each run.
+    When a rate timer falls behind by one or more periods, the catchup
+    policy decides what happens: coalesce runs it once and continues with
+    the next period, skip drops the late run as well, and burst runs it
+    once for every missed period. Timers scheduled with a datetime run once
+    when the wall clock reaches it.
+    """
 
     def __init__(self, scheduled, msg_or_command=None, *args, **kwargs):
         self.scheduled = scheduled
         self.direct = kwargs.pop('direct', False)
         self.remaining = kwargs.pop('count', 0)
+        # Prefixed, as the other keyword arguments format the message.
+        self.mode = kwargs.pop('schedule_mode', 'rate')
+        self.catchup = kwargs.pop('schedule_catchup', 'coalesce')
         target = kwargs.pop('target', None)
 
+        if self.mode not in ('rate', 'delay'):
+            raise TimerException('The mode of a timer must be rate or delay.')
+
+        if self.catchup not in ('coalesce', 'skip', 'burst'):
+            raise TimerException('The catchup policy of a timer must be '
+                                 'coalesce, skip or burst.')
+
         self.msg_tuple = None
         self.function = None
+        self.connection = None
+        self.entry = None
+        self.due = None
 
         if callable(msg_or_command):
             self.function = msg_or_command
@@ -427,47 +1463,230 @@ class Timer(object):
     def __eq__(self, other):
         return (self.scheduled == other.scheduled and
                 self.function is other.function and
-                self.msg_tuple == other.msg_tuple)
+                self.msg_tuple == other.msg_tuple and
+                self.connection is other.connection)
 
-    def match(self, timers, connect_time, connection, settings):
-        if self.matches(connect_time):
-            self.last_time = datetime.datetime.now()
-            match = Match(None, None, connection, settings)
+    def bind(self, connection):
+        timer = copy.copy(self)
+        timer.connection = connection
+        timer.entry = None
+        timer.due = None
+        return timer
+
+    @property
+    def period(self):
+        if isinstance(self.scheduled, datetime.timedelta):
+            return self.scheduled.total_seconds()
+
+    def schedule(self, now):
+        """Set the monotonic time at which the timer is first due."""
+        if self.direct:
+            self.due = now
+        elif self.period is not None:
+            self.due = now + self.period
+        else:
+            self.due = now + self.wall_clock_left()
+
+    def wall_clock_left(self):
+        # The wall clock may be changed while waiting, so check it again
+        # at least every WALL_CLOCK_CHECK seconds.
+        left = (self.scheduled - datetime.datetime.now()).total_seconds()
+        return max(0, min(left, WALL_CLOCK_CHECK))
+
+    def ready(self, now):
+        """Whether the timer should run now that it is due.
+
+        A datetime timer is rescheduled when the wall clock is not there
+        yet, and late rate timers are skipped with the skip policy.
+        """
+        if self.direct:
+            return True
+
+        if self.period is None:
+            if datetime.datetime.now() < self.scheduled:
+                self.due = now + self.wall_clock_left()
+                return False
+
+            return True
+
+        if self.catchup == 'skip' and self.mode == 'rate' and \
+                now - self.due >= self.period:
+            self.reschedule(now)
+            return False
+
+        return True
+
+    def reschedule(self, now):
+        """Set the monotonic time at which the timer is due next."""
+        period = max(self.period, 0)
+
+        if self.mode == 'delay' or self.due is None:
+            self.due = now + period
+            return
 
-            if self.function is not None:
-                result = self.function(match)
+        self.due += period
 
-                if result is not None:
-                    self.send_messages(result, match, timers)
+        if self.due <= now and self.catchup != 'burst':
+            if period:
+                self.due += (int((now - self.due) // period) + 1) * period
+            else:
+                self.due = now
+
+    def match(self, timers, connect_time, connection, settings, invoke=None):
+        if self.matches(connect_time):
+            self.fire(timers, connection, settings, invoke)
 
-            if self.msg_tuple is not None:
-                self.send_messages(self.msg_tuple, match, timers)
+    def fire(self, timers, connection, settings, invoke=None):
+        self.direct = False
+        self.last_time = datetime.datetime.now()
+        match = Match(None, None, connection, settings)
 
-            if self.remaining > 0:
-                self.remaining -= 1
+        if invoke is None:
+            self.call(match, timers)
+        else:
+            invoke(self, match)
+
+        # A timer for a specific date and time only runs once.
+        if isinstance(self.scheduled, datetime.datetime):
+            timers.remove(self)
+        elif self.remaining > 0:
+            self.remaining -= 1
 
-                if self.remaining == 0:
-                    timers.remove(self)
+            if self.remaining == 0:
+                timers.remove(self)
 
     def matches(self, connect_time):
         if self.direct:
             self.direct = False
             return True
 
+        return datetime.datetime.now() >= self.next_time(connect_time)
+
+    def next_time(self, connect_time):
         if isinstance(self.scheduled, datetime.datetime):
-            next_time = self.scheduled
+            return self.scheduled
 
-        if isinstance(self.scheduled, datetime.timedelta):
-            if hasattr(self, 'last_time'):
-                next_time = self.last_time + self.scheduled
-            else:
-                next_time = connect_time + self.scheduled
+        if hasattr(self, 'last_time'):
+            return self.last_time + self.scheduled
+
+        return connect_time + self.scheduled
+
+    def seconds_left(self, connect_time):
+        if self.direct:
+            return 0
 
-        return datetime.datetime.now() >= next_time
+        delta = self.next_time(connect_time) - datetime.datetime.now()
+        return delta.total_seconds()
+
+    def call(self, match, timers):
+        result = None
+        if self.function is not None:
+            result = self.function(match)
+
+        self.respond(result, match, timers)
+
+    def respond(self, result, match, timers):
+        if inspect.iscoroutine(result):
+            result.close()
+            raise TimerException(
+                'Coroutine function {} can only be used as a timer with the '
+                'AsyncPyromancer.'.format(self.function.__name__))
+
+        if result is not None:
+            self.send_messages(result, match, timers)
+
+        if self.msg_tuple is not None:
+            self.send_messages(self.msg_tuple, match, timers)
 
     def send_messages(self, result, match, timers):
         for r in utils.process_messages(result, with_target=True):
             if isinstance(r, Timer):
+                if r.connection is None:
+                    r.connection = match.connection
+
                 timers.append(r)
             else:
                 match.msg(r[1], *r[2], target=r[0], **r[3])
+
+
+class Scheduler(object):
+    """Timers in a heap, ordered by the time they are due next.
+
+    Adding a timer takes O(log n) time and removing one takes O(1) time: it
+    is only marked as removed and skipped when it reaches the top of the
+    heap. Only the timers which are due are looked at when running them.
+    """
+
+    def __init__(self, timers=()):
+        self.heap = []
+        self.counter = itertools.count()
+        self.live = 0
+
+        for timer in timers:
+            self.append(timer)
+
+    def __len__(self):
+        return self.live
+
+    def __iter__(self):
+        return (entry[2] for entry in self.heap if entry[2] is not None)
+
+    def append(self, timer, now=None):
+        if timer.due is None:
+            timer.schedule(time.monotonic() if now is None else now)
+
+        timer.entry = [timer.due, next(self.counter), timer]
+        heapq.heappush(self.heap, timer.entry)
+        self.live += 1
+
+    def remove(self, timer):
+        if timer.entry is not None and timer.entry[2] is timer:
+            timer.entry[2] = None
+            timer.entry = None
+            self.live -= 1
+
+    def timeout(self, now=None):
+        """Seconds until the next timer is due, or None without timers."""
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+
+        if not self.heap:
+            return None
+
+        if now is None:
+            now = time.monotonic()
+
+        return max(0, self.heap[0][0] - now)
+
+    def run(self, fire, now=None):
+        """Call fire for every timer which is due, then reschedule them."""
+        clock = now is None
+        if clock:
+            now = time.monotonic()
+
+        pending = []
+
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            timer = entry[2]
+
+            if timer is None:
+                continue
+
+            if timer.ready(now):
+                fire(timer)
+
+                # The timer stays scheduled unless it removed itself.
+                if timer.entry is not entry:
+                    continue
+
+                # A run may take a while, which matters for the delay mode.
+                timer.reschedule(time.monotonic() if clock else now)
+
+            pending.append(timer)
+
+        # Rescheduled timers are added afterwards, so a timer which is due
+        # again right away does not keep this loop busy.
+        for timer in pending:
+            self.live -= 1
+            self.append(timer)
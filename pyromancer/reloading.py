@@ -0,0 +1,97 @@
+"""Reloading of changed command and timer modules.
+
+The Reloader remembers the files of the `commands` and `timers` modules of
+all packages, and of the modules in them. Modules which changed since are
+imported again, deepest first, after which the bot finds its commands and
+timers again. Modules which are not imported yet, such as the modules of a
+command manifest which did not match anything so far, are left alone.
+"""
+import importlib
+import os
+import sys
+
+from pyromancer import utils
+
+SUBMODULES = ('commands', 'timers')
+
+
+def file_stat(module):
+    path = getattr(module, '__file__', None)
+
+    if not path:
+        return None
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return stat.st_mtime_ns, stat.st_size
+
+
+class Reloader(object):
+
+    def __init__(self, packages):
+        self.prefixes = []
+
+        for package in packages:
+            if isinstance(package, tuple):
+                package = package[0]
+
+            self.prefixes.extend('{}.{}'.format(package, submodule) for
+                                 submodule in SUBMODULES)
+
+        self.stats = {}
+        self.changed()
+
+    def modules(self):
+        for name, module in list(sys.modules.items()):
+            if module is not None and any(
+                    name == p or name.startswith(p + '.')
+                    for p in self.prefixes):
+                yield name, module
+
+    def changed(self):
+        """Return the names of the modules which changed, deepest first.
+
+        Modules which are seen for the first time are assumed to be up to
+        date.
+        """
+        changed = []
+
+        for name, module in self.modules():
+            stat = file_stat(module)
+
+            if name not in self.stats:
+                self.stats[name] = stat
+            elif self.stats[name] != stat:
+                changed.append(name)
+
+        return sorted(changed, key=lambda name: (-name.count('.'), name))
+
+    def reload(self):
+        """Import the changed modules again.
+
+        Returns the names of the modules which were reloaded, and a list of
+        names and exceptions of the modules which failed to. A module which
+        failed is left as it was, and is tried again the next time.
+        """
+        reloaded = []
+        errors = []
+
+        # A changed module may import a module which was just added.
+        importlib.invalidate_caches()
+
+        for name in self.changed():
+            module = sys.modules[name]
+
+            try:
+                utils.reload_module(module)
+            except Exception as e:
+                errors.append((name, e))
+                continue
+
+            self.stats[name] = file_stat(module)
+            reloaded.append(name)
+
+        return reloaded, errors
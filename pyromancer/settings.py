@@ -4,9 +4,53 @@ encoding = 'utf8'
 nick = ''
 ident = nick
 real_name = nick
-ticks = 10
 packages = []
 command_prefix = None
 database = None
+# Arguments for SQLAlchemy's create_engine, such as pool_size and
+# max_overflow. Connections are checked before use, and replaced after an
+# hour, as servers tend to close idle connections.
+database_options = {'pool_pre_ping': True, 'pool_recycle': 3600}
+# Database URL with an async driver, for match.async_session.
+async_database = None
+# Writes from match.save are committed together, at most this many at once,
+# after waiting at most this many seconds for more to come in.
+database_batch_size = 500
+database_batch_delay = 1.0
+# Path of a SQLite database to log the received messages to, or a store such
+# as pyromancer.messagelog.SegmentStore('logs').
+message_log = None
+message_log_verbs = ['PRIVMSG', 'NOTICE', 'JOIN', 'PART', 'QUIT', 'NICK',
+                     'KICK', 'TOPIC']
+# Logged messages are written together when this many are waiting, or this
+# many seconds after the first of them came in.
+message_log_batch_size = 1000
+message_log_delay = 5.0
 ssl = False
 admins = []
+networks = []
+flood_rate = 0.5
+flood_burst = 5
+capabilities = ['account-notify', 'extended-join', 'multi-prefix']
+workers = 4
+worker_processes = None
+# Run the commands with patterns in worker_processes processes, which find
+# the commands themselves, so the bot only sends them the line and the match.
+# Coroutines and commands with offload=False keep running in the bot.
+shard_commands = False
+fallback_encoding = 'latin-1'
+# Longest line to accept, which is 8191 bytes of message tags and 512 bytes
+# for the rest of the line.
+max_line_length = 8703
+# Lines handled per connection before timers and other connections get a
+# turn.
+lines_per_cycle = 200
+metrics_hooks = []
+metrics_interval = 60
+metrics_port = None
+# File to cache the found commands in, so their modules are only imported
+# when they are needed.
+command_manifest = None
+# Seconds between checks for changed command and timer modules, which are
+# then reloaded, or None to only reload them with the reload command.
+reload_interval = None
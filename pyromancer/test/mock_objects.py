@@ -1,4 +1,4 @@
-from pyromancer.objects import Connection, User
+from pyromancer.objects import Connection, PRIORITY_NORMAL
 
 
 class MockObject(object):
@@ -12,9 +12,9 @@ class MockConnection(Connection):
 
     def __init__(self, *args, **kwargs):
         self.outbox = []
-        self.me = User('')
+        self.reset()
 
-    def write(self, data):
+    def write(self, data, priority=PRIORITY_NORMAL):
         self.outbox.append(data)
 
     @property
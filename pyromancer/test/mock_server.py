@@ -0,0 +1,548 @@
+"""IRC server on localhost for load and soak tests.
+
+The MockServer accepts any number of connections, over plain TCP or SSL,
+and handles the registration, CAP, JOIN, PART, WHO (with WHOX), WHOIS and
+PING commands of the bot well enough for the track commands. After the
+registration, every client is joined to a number of channels with a number
+of simulated users, who then start talking, joining, parting and changing
+nicks at a set rate, with an occasional netsplit. Every client gets its own
+copy of the channels and users, which is kept in `MockClient.channels`, so
+the users and channels tracked by the bot can be compared with it. The
+accounts it told the bot about are kept in `MockClient.reported`.
+
+Run `python -m pyromancer.test.mock_server --help` to soak test a bot with
+the track commands against the server, and report its memory use.
+"""
+import argparse
+import importlib
+import os
+import random
+import socket
+import ssl
+import struct
+import threading
+import time
+import tracemalloc
+
+from pyromancer import utils
+from pyromancer.dispatch import CommandIndex
+from pyromancer.metrics import Metrics
+from pyromancer.objects import NetworkSettings, Pyromancer
+
+SERVER = 'irc.example.org'
+CERTIFICATE = os.path.join(os.path.dirname(__file__), 'mock_server.pem')
+
+
+class MockServer(object):
+    """IRC server which runs in separate threads.
+
+    `rate` is the number of lines each client receives per second from the
+    simulated users, of which `churn` is the fraction of joins, parts and
+    nick changes, and the rest are messages. Every `netsplit` seconds, a
+    quarter of the users quit, and they return halfway until the next one.
+    """
+
+    def __init__(self, channels=3, users=50, rate=0, churn=0.1, netsplit=0,
+                 use_ssl=False, whox=True, seed=0):
+        self.channel_count = channels
+        self.user_count = users
+        self.rate = rate
+        self.churn = churn
+        self.netsplit = netsplit
+        self.use_ssl = use_ssl
+        self.whox = whox
+        self.seed = seed
+
+        self.clients = []
+        self.running = False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(5)
+        self.port = self.socket.getsockname()[1]
+
+        if self.use_ssl:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(CERTIFICATE)
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+
+        self.running = True
+        self.thread = threading.Thread(target=self.accept)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the traffic, and hang up on all clients after sending what
+        was generated so far."""
+        self.running = False
+        self.socket.close()
+
+        for client in list(self.clients):
+            client.hang_up()
+
+    def accept(self):
+        while self.running:
+            try:
+                sock, address = self.socket.accept()
+            except (OSError, ssl.SSLError):
+                continue
+
+            client = MockClient(self, sock, len(self.clients))
+            self.clients.append(client)
+            client.start()
+
+
+class MockClient(object):
+    """A connection to the MockServer, with its own channels and users."""
+
+    def __init__(self, server, sock, number):
+        self.server = server
+        self.socket = sock
+        self.random = random.Random(server.seed + number)
+        self.lock = threading.RLock()
+        self.received = []
+        self.nick = None
+        self.registered = False
+        self.negotiating = False
+        self.closed = False
+
+        # The channels, with the nicks in them, and the account of every
+        # user, or None.
+        self.channels = {}
+        self.accounts = {}
+        self.split = []
+        self.serial = 0
+
+        # The lines sent, the netsplits, and the accounts sent in WHO and
+        # WHOIS replies of the users who are still around.
+        self.sent = 0
+        self.splits = 0
+        self.reported = {}
+
+    def start(self):
+        self.reader = threading.Thread(target=self.read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def hang_up(self):
+        """Stop sending, but keep reading until the client closes, so the
+        client does not get a reset before it read everything."""
+        with self.lock:
+            if self.closed:
+                return
+
+            self.closed = True
+
+            try:
+                self.socket.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def reset(self):
+        """Drop the connection with a reset, like a crashed server."""
+        with self.lock:
+            self.closed = True
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                   struct.pack('ii', 1, 0))
+
+            # The reader closes the socket once it stops receiving, which
+            # sends the reset.
+            self.socket.shutdown(socket.SHUT_RD)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.socket.close()
+
+    def send(self, *lines):
+        data = ''.join('{}\r\n'.format(line) for line in lines).encode()
+
+        with self.lock:
+            if self.closed:
+                return
+
+            try:
+                self.socket.sendall(data)
+            except OSError:
+                self.closed = True
+                return
+
+            self.sent += len(lines)
+
+    def report(self, nicks):
+        if not self.closed:
+            self.reported.update((nick, self.accounts[nick]) for nick in nicks)
+
+    def numeric(self, code, *params):
+        return ':{} {:03d} {} {}'.format(SERVER, code, self.nick or '*',
+                                         ' '.join(params))
+
+    def read(self):
+        buffer = b''
+
+        while True:
+            try:
+                data = self.socket.recv(4096)
+            except OSError:
+                break
+
+            if not data:
+                break
+
+            if self.closed:
+                # Only drain what the client sends after the hang up.
+                continue
+
+            buffer += data
+            *lines, buffer = buffer.split(b'\n')
+
+            for line in lines:
+                line = line.rstrip(b'\r').decode('utf8', 'replace')
+                self.received.append(line)
+
+                with self.lock:
+                    self.handle(line)
+
+        self.close()
+
+    def handle(self, line):
+        verb, _, rest = line.partition(' ')
+        params, _, trailing = rest.partition(':')
+        params = params.split()
+
+        if trailing or rest.startswith(':'):
+            params.append(trailing)
+
+        verb = verb.upper()
+
+        if verb == 'CAP':
+            if params[:1] == ['LS']:
+                self.negotiating = True
+                self.send(':{} CAP * LS :'.format(SERVER))
+            elif params[:1] == ['END']:
+                self.negotiating = False
+                self.register()
+        elif verb == 'NICK':
+            self.nick = params[0]
+            self.register()
+        elif verb == 'USER':
+            self.register()
+        elif verb == 'PING':
+            self.send(':{} PONG {} :{}'.format(SERVER, SERVER, params[-1]))
+        elif verb == 'JOIN':
+            for name in params[0].split(','):
+                self.join_channel(name)
+        elif verb == 'PART':
+            self.send(':{} PART {}'.format(self.prefix(self.nick), params[0]))
+            self.channels.pop(params[0], None)
+        elif verb == 'WHO':
+            self.who(params[0], params[1] if len(params) > 1 else '')
+        elif verb == 'WHOIS':
+            self.whois(params[-1])
+
+    def register(self):
+        if self.registered or self.negotiating or not self.nick:
+            return
+
+        self.registered = True
+        isupport = 'CHANTYPES=# CASEMAPPING=rfc1459 PREFIX=(ov)@+'
+
+        if self.server.whox:
+            isupport += ' WHOX'
+
+        self.send(self.numeric(1, ':Welcome to the mock network'),
+                  self.numeric(5, isupport, ':are supported by this server'),
+                  self.numeric(375, ':- {} Message of the day -'.format(
+                      SERVER)),
+                  self.numeric(376, ':End of /MOTD command.'))
+
+        for i in range(self.server.channel_count):
+            self.join_channel('#channel{}'.format(i))
+
+        if self.server.rate:
+            thread = threading.Thread(target=self.generate)
+            thread.daemon = True
+            thread.start()
+
+    def prefix(self, nick):
+        return '{0}!~{0}@{0}.users.example.org'.format(nick)
+
+    def new_user(self):
+        self.serial += 1
+        nick = 'user{}'.format(self.serial)
+        self.accounts[nick] = 'account{}'.format(self.serial) \
+            if self.serial % 2 else None
+        return nick
+
+    def join_channel(self, name):
+        if name not in self.channels:
+            self.channels[name] = set(self.new_user() for _ in
+                                      range(self.server.user_count))
+
+        nicks = sorted(self.channels[name])
+        lines = [':{} JOIN {}'.format(self.prefix(self.nick), name)]
+
+        for i in range(0, len(nicks), 40):
+            lines.append(self.numeric(353, '=', name, ':{}'.format(
+                ' '.join(['@' + self.nick] + nicks[i:i + 40] if i == 0 else
+                         nicks[i:i + 40]))))
+
+        lines.append(self.numeric(366, name, ':End of /NAMES list.'))
+        self.send(*lines)
+
+    def who(self, name, fields):
+        lines = []
+        nicks = sorted(self.channels.get(name, ()))
+
+        for nick in nicks:
+            if fields.startswith('%'):
+                token = fields.partition(',')[2]
+                lines.append(self.numeric(
+                    354, token, '~' + nick, '{}.users.example.org'.format(
+                        nick), nick, 'H', self.accounts.get(nick) or '0'))
+            else:
+                lines.append(self.numeric(
+                    352, name, '~' + nick, '{}.users.example.org'.format(
+                        nick), SERVER, nick, 'H', ':0 {}'.format(nick)))
+
+        lines.append(self.numeric(315, name, ':End of /WHO list.'))
+        self.send(*lines)
+
+        if fields.startswith('%'):
+            self.report(nicks)
+
+    def whois(self, nick):
+        lines = []
+
+        if nick in self.accounts:
+            lines.append(self.numeric(
+                311, nick, '~' + nick, '{}.users.example.org'.format(nick),
+                '*', ':{}'.format(nick)))
+
+            if self.accounts[nick]:
+                lines.append(self.numeric(330, nick, self.accounts[nick],
+                                          ':is logged in as'))
+
+        lines.append(self.numeric(318, nick, ':End of /WHOIS list.'))
+        self.send(*lines)
+
+        if nick in self.accounts and any(nick in nicks for nicks in
+                                         self.channels.values()):
+            self.report([nick])
+
+    def generate(self):
+        """Send traffic from the simulated users until the server stops."""
+        start = last_split = time.monotonic()
+        sent = 0
+
+        while True:
+            time.sleep(0.01)
+            now = time.monotonic()
+
+            with self.lock:
+                # The state of the channels never runs ahead of what was
+                # sent, as the lines are sent while holding the lock.
+                if self.closed or not self.server.running:
+                    return
+
+                netsplit = self.server.netsplit
+
+                if netsplit and now - last_split >= netsplit:
+                    last_split = now
+                    self.quit_some()
+                elif self.split and now - last_split >= netsplit / 2:
+                    self.rejoin()
+
+                due = int((now - start) * self.server.rate) - sent
+                lines = [self.event() for _ in range(due)]
+                self.send(*[line for line in lines if line])
+                sent += due
+
+    def event(self):
+        channels = [name for name, nicks in self.channels.items() if nicks]
+
+        if not channels:
+            return
+
+        name = self.random.choice(channels)
+        nicks = self.channels[name]
+        kind = self.random.random()
+
+        if kind < self.server.churn / 3:
+            nick = self.new_user()
+            nicks.add(nick)
+            return ':{} JOIN {}'.format(self.prefix(nick), name)
+
+        nick = self.random.choice(sorted(nicks))
+
+        if kind < self.server.churn * 2 / 3:
+            nicks.discard(nick)
+
+            if not any(nick in other for other in self.channels.values()):
+                self.reported.pop(nick, None)
+
+            return ':{} PART {} :Leaving'.format(self.prefix(nick), name)
+
+        if kind < self.server.churn:
+            new = self.new_user()
+            self.accounts[new] = self.accounts.pop(nick)
+
+            for other in self.channels.values():
+                if nick in other:
+                    other.discard(nick)
+                    other.add(new)
+
+            if nick in self.reported:
+                self.reported[new] = self.reported.pop(nick)
+
+            return ':{} NICK :{}'.format(self.prefix(nick), new)
+
+        return ':{} PRIVMSG {} :Message number {} in {}'.format(
+            self.prefix(nick), name, self.random.randrange(10000), name)
+
+    def quit_some(self):
+        nicks = set()
+        for other in self.channels.values():
+            nicks.update(other)
+
+        nicks = sorted(nicks)
+        split = self.random.sample(nicks, len(nicks) // 4)
+        lines = []
+
+        for nick in split:
+            joined = [name for name, other in self.channels.items()
+                      if nick in other]
+
+            for name in joined:
+                self.channels[name].discard(nick)
+
+            self.split.append((nick, joined))
+            self.reported.pop(nick, None)
+            lines.append(':{} QUIT :*.net *.split'.format(self.prefix(nick)))
+
+        self.splits += 1
+        self.send(*lines)
+
+    def rejoin(self):
+        lines = []
+
+        for nick, joined in self.split:
+            for name in joined:
+                if name in self.channels:
+                    self.channels[name].add(nick)
+                    lines.append(':{} JOIN {}'.format(self.prefix(nick), name))
+
+        self.split = []
+        self.send(*lines)
+
+
+class BotSettings(NetworkSettings):
+    """The default settings, with some overridden."""
+
+    def __init__(self, **overrides):
+        NetworkSettings.__init__(
+            self, importlib.import_module('pyromancer.settings'), overrides)
+
+    def networks_settings(self):
+        return [self]
+
+
+def make_bot(server, **settings):
+    """Create a bot with the track commands which connects to a server."""
+    settings.setdefault('nick', 'Pyro')
+    settings.setdefault('real_name', 'Pyro')
+    settings.setdefault('flood_rate', None)
+
+    bot = Pyromancer.__new__(Pyromancer)
+    bot.settings = BotSettings(host='127.0.0.1', port=server.port,
+                               ssl=server.use_ssl, **settings)
+    bot.commands = []
+    utils.find_functions(['pyromancer'], bot.commands, 'commands',
+                         when=lambda f: hasattr(f, 'command'))
+    bot.index = CommandIndex(bot.commands)
+    bot.timers = []
+    bot.metrics = Metrics(bot)
+    return bot
+
+
+def tracked(connection):
+    """The channels and nicks a bot knows of, without the bot itself."""
+    return dict((channel.name, set(u.nick for u in channel.users
+                                   if u is not connection.me))
+                for channel in connection.channels)
+
+
+def accounts(connection):
+    """The accounts of the users a bot knows of, by nick."""
+    return dict((u.nick, u.auth) for u in connection.user_map.values()
+                if u is not connection.me)
+
+
+def soak(duration, interval, **options):
+    tracemalloc.start()
+
+    with MockServer(**options) as server:
+        bot = make_bot(server)
+        bot.connect()
+        connection = bot.connections[0]
+        timer = threading.Timer(duration, server.stop)
+        timer.start()
+
+        def report():
+            start = time.monotonic()
+
+            while server.running:
+                time.sleep(interval)
+                current, peak = tracemalloc.get_traced_memory()
+                print('{:>8.0f}s {:>10.1f} KiB {:>10.1f} KiB peak {:>6} users '
+                      '{:>8} lines'.format(
+                          time.monotonic() - start, current / 1024,
+                          peak / 1024, len(connection.user_map),
+                          bot.metrics.lines_in))
+
+        thread = threading.Thread(target=report)
+        thread.daemon = True
+        thread.start()
+
+        bot.listen()
+        timer.cancel()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pyromancer.test.mock_server',
+        description='Soak test a bot with the track commands against a '
+                    'local IRC server.')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='seconds to run')
+    parser.add_argument('--interval', type=float, default=10,
+                        help='seconds between memory reports')
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--users', type=int, default=200,
+                        help='users per channel')
+    parser.add_argument('--rate', type=float, default=500,
+                        help='lines per second')
+    parser.add_argument('--churn', type=float, default=0.1,
+                        help='fraction of joins, parts and nick changes')
+    parser.add_argument('--netsplit', type=float, default=30,
+                        help='seconds between netsplits, 0 for none')
+    parser.add_argument('--ssl', action='store_true')
+    parser.add_argument('--no-whox', action='store_true')
+    args = parser.parse_args(args)
+
+    soak(args.duration, args.interval, channels=args.channels,
+         users=args.users, rate=args.rate, churn=args.churn,
+         netsplit=args.netsplit, use_ssl=args.ssl, whox=not args.no_whox)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import asyncio
+import time
+
+from pyromancer.aio import AsyncPyromancer
+from pyromancer.decorators import command
+from pyromancer.dispatch import CommandIndex
+from pyromancer.metrics import Metrics
+from pyromancer.objects import NetworkSettings
+from pyromancer.test.mock_server import MockServer
+from pyromancer.test.mock_objects import MockObject
+
+
+@command(r'slow')
+async def slow(match):
+    await asyncio.sleep(0.2)
+    return 'Slow'
+
+
+@command(r'blocking')
+def blocking(match):
+    time.sleep(0.1)
+    return 'Blocking'
+
+
+@command(r'fast')
+async def fast(match):
+    return 'Fast'
+
+
+@command(r'offload ([\d.]+)', offload=True, max_concurrency=1)
+def offload(match):
+    time.sleep(float(match[1]))
+    return 'Offloaded {m[1]}'
+
+
+@command(r'network')
+def network(match):
+    return 'Network {}', match.connection.settings.name
+
+
+def mock_bot(port, commands, networks=None):
+    bot = AsyncPyromancer.__new__(AsyncPyromancer)
+    bot.settings = MockObject(host='127.0.0.1', port=port, encoding='utf8',
+                              ssl=False, nick='Pyro', real_name='Pyro',
+                              command_prefix='!', flood_rate=None,
+                              fallback_encoding='latin-1',
+                              max_line_length=None, lines_per_cycle=200,
+                              flood_burst=5,
+                              capabilities=[], workers=4,
+                              worker_processes=None, metrics_port=None,
+                              reload_interval=None, message_log=None,
+                              shard_commands=False)
+    bot.settings.networks_settings = lambda: [
+        NetworkSettings(bot.settings, n) for n in networks or [{}]]
+    bot.commands = commands
+    bot.index = CommandIndex(commands)
+    bot.timers = []
+    bot.metrics = Metrics(bot)
+    return bot
+
+
+def test_async_commands_run_concurrently():
+    replies = []
+
+    async def handle(reader, writer):
+        for cmd in ('slow', 'blocking', 'fast'):
+            writer.write(':John!JDoe@some.host PRIVMSG #Chan :!{}\r\n'.format(
+                cmd).encode())
+
+        while len(replies) < 3:
+            line = (await reader.readline()).decode().strip()
+
+            if line.startswith('PRIVMSG'):
+                replies.append(line)
+
+        writer.close()
+
+    async def scenario():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+
+        bot = mock_bot(port, [slow, blocking, fast])
+        await asyncio.wait_for(bot.main(), 5)
+
+        server.close()
+
+    asyncio.run(scenario())
+
+    assert replies == ['PRIVMSG #Chan :Fast', 'PRIVMSG #Chan :Blocking',
+                       'PRIVMSG #Chan :Slow']
+
+
+def test_async_multiple_networks():
+    replies = {}
+
+    def mock_server(name):
+        async def handle(reader, writer):
+            writer.write(b':John!JDoe@some.host PRIVMSG #Chan :!network\r\n')
+
+            while True:
+                line = (await reader.readline()).decode().strip()
+
+                if line.startswith('PRIVMSG'):
+                    replies[name] = line
+                    break
+
+            writer.close()
+
+        return asyncio.start_server(handle, '127.0.0.1', 0)
+
+    async def scenario():
+        servers = [await mock_server('A'), await mock_server('B')]
+        networks = [{'name': name,
+                     'port': server.sockets[0].getsockname()[1]}
+                    for name, server in zip('AB', servers)]
+
+        bot = mock_bot(None, [network], networks)
+        await asyncio.wait_for(bot.main(), 5)
+
+        for server in servers:
+            server.close()
+
+    asyncio.run(scenario())
+
+    assert replies == {'A': 'PRIVMSG #Chan :Network A',
+                       'B': 'PRIVMSG #Chan :Network B'}
+
+
+def test_async_network_reset_does_not_stop_other_networks():
+    async def until(condition):
+        for _ in range(500):
+            if condition():
+                return
+
+            await asyncio.sleep(0.01)
+
+        raise AssertionError('Timed out')
+
+    async def scenario(a, b):
+        bot = mock_bot(None, [network], [{'name': 'A', 'port': a.port},
+                                         {'name': 'B', 'port': b.port}])
+        main = asyncio.ensure_future(bot.main())
+        await until(lambda: all(server.clients and
+                                server.clients[0].registered
+                                for server in (a, b)))
+
+        a.clients[0].reset()
+        await until(lambda: len(bot.connections) == 1)
+        assert not main.done()
+
+        client = b.clients[0]
+        client.send(':John!JDoe@some.host PRIVMSG #Chan :!network')
+        await until(lambda: 'PRIVMSG #Chan :Network B' in client.received)
+
+        b.stop()
+        await asyncio.wait_for(main, 5)
+
+    with MockServer(channels=0) as a, MockServer(channels=0) as b:
+        asyncio.run(scenario(a, b))
+
+
+def test_async_offloaded_commands_keep_reply_order():
+    replies = []
+
+    async def handle(reader, writer):
+        for cmd in ('offload 0.1', 'fast', 'offload 0'):
+            writer.write(':John!JDoe@some.host PRIVMSG #Chan :!{}\r\n'.format(
+                cmd).encode())
+
+        while len(replies) < 3:
+            line = (await reader.readline()).decode().strip()
+
+            if line.startswith('PRIVMSG'):
+                replies.append(line)
+
+        writer.close()
+
+    async def scenario():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+
+        bot = mock_bot(port, [offload, fast])
+        await asyncio.wait_for(bot.main(), 5)
+
+        server.close()
+
+    asyncio.run(scenario())
+
+    assert replies == ['PRIVMSG #Chan :Fast', 'PRIVMSG #Chan :Offloaded 0.1',
+                       'PRIVMSG #Chan :Offloaded 0']
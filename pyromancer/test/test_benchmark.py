@@ -0,0 +1,32 @@
+from pyromancer import benchmark
+
+
+def test_generate_is_reproducible():
+    traffic = benchmark.generate(500, 10, 100, seed=1)
+
+    assert len(traffic) == 500
+    assert traffic == benchmark.generate(500, 10, 100, seed=1)
+    assert traffic[0] == ':Pyro!~Pyro@host-4.example.org JOIN #chan0'
+
+
+def test_benchmark_results():
+    results = benchmark.benchmark([0, 5], [10], 300)
+
+    assert [(r['commands'], r['channel_size']) for r in results] == \
+        [(0, 10), (5, 10)]
+
+    for r in results:
+        assert r['lines'] == 300
+        assert r['lines_per_second'] > 0
+        assert r['p50_us'] <= r['p99_us']
+
+
+def test_benchmark_replay(tmpdir, capsys):
+    log = tmpdir.join('traffic.log')
+    log.write('\n'.join(benchmark.generate(200, 1, 10)) + '\n')
+
+    benchmark.main(['--commands', '1', '--replay', str(log)])
+
+    header, row = capsys.readouterr().out.splitlines()
+    assert header.split()[:2] == ['commands', 'users']
+    assert row.split()[:2] == ['1', '-']
@@ -158,3 +158,14 @@ def test_command_matches_command(c):
     line = Line(':John!JDoe@some.host NICK Paul"', c)
     assert line.command == 'NICK'
     assert bool(instance.matches(line, settings)) is False
+
+
+def test_command_coroutine_requires_async_runtime():
+    async def coroutine_command(match):
+        return 'Hi'
+
+    instance = command(r'')
+    instance(coroutine_command)
+
+    with pytest.raises(CommandException):
+        instance.call(Match(None, None, None), [])
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+sqlalchemy = pytest.importorskip('sqlalchemy')
+
+from sqlalchemy import Column, Integer, String  # noqa: E402
+
+from pyromancer import database  # noqa: E402
+from pyromancer.decorators import command  # noqa: E402
+from pyromancer.metrics import Metrics  # noqa: E402
+from pyromancer.objects import Line, Match, Pyromancer  # noqa: E402
+from pyromancer.test.mock_objects import MockConnection, \
+    MockObject  # noqa: E402
+
+
+class Karma(database.Base):
+    __tablename__ = 'test_karma'
+
+    id = Column(Integer, primary_key=True)
+    nick = Column(String(50))
+
+
+@command(r'^karma (\w+)')
+def karma(match):
+    match.session.add(Karma(nick=match[1]))
+    return 'Karma for {m[1]}'
+
+
+@command(r'^broken (\w+)')
+def broken(match):
+    match.session.add(Karma(nick=match[1]))
+    raise ValueError('Broken')
+
+
+@pytest.fixture
+def settings(tmp_path):
+    settings = MockObject(
+        database='sqlite:///{}'.format(tmp_path / 'test.db'),
+        database_options={}, async_database=None, database_batch_size=50,
+        database_batch_delay=0.01, command_prefix='!', admins=[])
+    database.Base.metadata.create_all(database.get_engine(settings))
+    yield settings
+    database.get_engine(settings).dispose()
+
+
+def nicks(settings):
+    session = database.Session(bind=database.get_engine(settings))
+    nicks = sorted(k.nick for k in session.query(Karma))
+    session.close()
+    return nicks
+
+
+def test_match_session_is_committed_or_rolled_back(settings):
+    bot = Pyromancer.__new__(Pyromancer)
+    bot.timers = []
+    bot.metrics = Metrics(bot)
+    c = MockConnection()
+
+    for msg in ('!karma John', '!broken Jane'):
+        line = Line(':John!JDoe@some.host PRIVMSG #Chan :{}'.format(msg), c)
+        handler = karma if 'karma' in msg else broken
+        m = handler.command.matches(line, settings)
+
+        try:
+            bot.invoke(handler.command, Match(m, line, c, settings))
+        except ValueError:
+            pass
+
+    assert nicks(settings) == ['John']
+    assert c.outbox == ['PRIVMSG #Chan :Karma for John']
+
+
+def test_write_behind_batches_and_isolates_failures(settings):
+    writer = database.write_behind(settings)
+    match = Match(None, None, MockConnection(), settings)
+
+    for i in range(120):
+        match.save(Karma(nick='user{}'.format(i)))
+
+    writer.insert(Karma, id=1000, nick='row')
+    writer.insert(Karma, id=1000, nick='duplicate')
+    writer.flush()
+
+    assert len(nicks(settings)) == 121
+    assert writer.written == 121
+    assert writer.failed == 1
+
+
+def test_async_session(settings, tmp_path):
+    pytest.importorskip('aiosqlite')
+    pytest.importorskip('greenlet')
+    settings.async_database = 'sqlite+aiosqlite:///{}'.format(
+        tmp_path / 'test.db')
+
+    async def scenario():
+        match = Match(None, None, MockConnection(), settings)
+        match.async_session.add(Karma(nick='async'))
+        await match.finish_async()
+        await database.get_async_engine(settings).dispose()
+
+    asyncio.run(scenario())
+    assert nicks(settings) == ['async']
@@ -0,0 +1,72 @@
+import re
+
+from pyromancer.commands import track
+from pyromancer.decorators import command
+from pyromancer.dispatch import CommandIndex
+from pyromancer.objects import Line
+from pyromancer.test.decorators import mock_connection
+from pyromancer.test.mock_objects import MockObject
+
+
+@command(r'hi')
+def hi(match):
+    pass
+
+
+@command(r'End of', raw=True, prefix=False)
+def raw(match):
+    pass
+
+
+@command(code=376)
+def motd(match):
+    pass
+
+
+@mock_connection
+def test_command_index_candidates(c):
+    functions = [hi, track.join, raw, motd, track.part]
+    index = CommandIndex(functions)
+
+    line = Line(':John!JDoe@some.host PRIVMSG #Chan :!hi', c)
+    assert index.candidates(line) == [hi.command, raw.command]
+
+    line = Line(':John!JDoe@some.host JOIN #Chan', c)
+    assert index.candidates(line) == [track.join.command, raw.command]
+
+    line = Line(':irc.example.net 376 A :End of MOTD command', c)
+    assert index.candidates(line) == [raw.command, motd.command]
+
+    line = Line(':irc.example.net 375 A :- Message of the day', c)
+    assert index.candidates(line) == [raw.command]
+
+
+@mock_connection
+def test_command_index_match(c):
+    functions = []
+    for i, pattern in enumerate([
+            r'^hi$', r'hi (.*)', r'^(say|tell) (.*)', r'^say (\w+)',
+            r'(?i)^HELLO', r'(?i)^Sup', r'^cool', r'cool message$', r'.*',
+            re.compile(r'^\w+ world', re.MULTILINE)]):
+        for kwargs in ({}, {'prefix': False}, {'raw': True},
+                       {'raw': True, 'prefix': False}):
+            functions.append(command(pattern, **kwargs)(lambda m: m))
+
+    functions.append(motd)
+    index = CommandIndex(functions)
+
+    for settings in (MockObject(command_prefix='!'),
+                     MockObject(command_prefix=None)):
+        for msg in ('hi', '!hi', '!hi there', 'say hello, world',
+                    '!Say hello world', '!hello world', '!sUP', 'Some cool',
+                    'Some cool message', '!cool message', ''):
+            line = Line(':John!JDoe@some.host PRIVMSG #Chan :{}'.format(msg),
+                        c)
+
+            expected = [(f.command, f.command.matches(line, settings))
+                        for f in functions]
+            expected = [(cmd, m.group(0)) for cmd, m in expected if m]
+            result = [(cmd, m.group(0)) for cmd, m in
+                      index.match(line, settings)]
+
+            assert result == expected
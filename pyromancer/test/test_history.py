@@ -0,0 +1,90 @@
+import asyncio
+import datetime
+
+import pytest
+
+from pyromancer.history import History, get_history
+from pyromancer.messagelog import Record, SQLiteStore
+from pyromancer.objects import Line, Match
+from pyromancer.test.mock_objects import MockConnection, MockObject
+
+MESSAGES = [
+    ('PRIVMSG', 'John', '#Chan', 'The quick brown fox'),
+    ('PRIVMSG', 'Jane', '#Chan', 'A brown dog, quick as a fox'),
+    ('JOIN', 'Jack', '#Other', None),
+    ('PRIVMSG', 'jack', '#Other', 'Is the fox quick?'),
+    ('QUIT', 'John', None, 'Quick exit'),
+]
+
+
+def records(start=0):
+    return [Record(1000.0 + start + i, 'net', *message) for i, message in
+            enumerate(MESSAGES)]
+
+
+@pytest.fixture(params=[True, False], ids=['fts', 'index'])
+def history(request, tmp_path):
+    path = str(tmp_path / 'log.db')
+
+    # Messages which were logged before the index existed are found too.
+    store = SQLiteStore(path)
+    store.write(records()[:2])
+    store.close()
+
+    history = History(path, fts=request.param)
+    history.write(records()[2:])
+    yield history
+    history.close()
+
+
+def texts(found):
+    return [record.text for record in found]
+
+
+def test_search_history(history):
+    assert texts(history.search('fox QUICK')) == [
+        'Is the fox quick?', 'A brown dog, quick as a fox',
+        'The quick brown fox']
+    assert texts(history.search('"quick brown"')) == ['The quick brown fox']
+    assert texts(history.search('"brown quick"')) == []
+    assert texts(history.search('quick', limit=2)) == [
+        'Quick exit', 'Is the fox quick?']
+    assert texts(history.search('quick', verbs=['QUIT'])) == ['Quick exit']
+    assert texts(history.search('fox', target='#other')) == [
+        'Is the fox quick?']
+    assert texts(history.search('fox', nick='JOHN')) == [
+        'The quick brown fox']
+    assert texts(history.search('?!')) == []
+
+    assert [r.verb for r in history.search(nick='Jack')] == [
+        'PRIVMSG', 'JOIN']
+    assert texts(history.search(since=1001, until=1003)) == [
+        None, 'A brown dog, quick as a fox']
+
+    assert history.seen('JOHN').verb == 'QUIT'
+    assert history.seen('Jane', network='other') is None
+
+    # New messages are found right away.
+    history.write(records(10)[:1])
+    assert history.search('fox', since=datetime.datetime.fromtimestamp(
+        1005))[0].time == 1010.0
+
+
+def test_search_history_from_a_match(tmp_path):
+    settings = MockObject(message_log=str(tmp_path / 'log.db'))
+    history = get_history(settings)
+    history.write(records())
+
+    c = MockConnection()
+    line = Line(':John!JDoe@some.host PRIVMSG #Chan :!seen Jack', c)
+    match = Match(None, line, c, settings)
+    assert match.history is history
+
+    async def seen():
+        return await match.history.seen_async('jack')
+
+    assert asyncio.run(seen()).text == 'Is the fox quick?'
+    assert get_history(MockObject(message_log=history)) is history
+
+    with pytest.raises(ValueError):
+        get_history(MockObject(message_log=object()))
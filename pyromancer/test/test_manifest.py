@@ -0,0 +1,103 @@
+import json
+import sys
+
+import pytest
+
+from pyromancer import manifest
+from pyromancer.dispatch import CommandIndex
+from pyromancer.objects import Line
+from pyromancer.test.mock_objects import MockConnection, MockObject
+
+GREET = '''from pyromancer.decorators import command
+
+
+@command(r'^hello (\\w+)')
+def hello(match):
+    return 'Hello {m[1]}'
+
+
+@command(code=376)
+def motd(match):
+    pass
+
+
+@command(r'^bye')
+def bye(match):
+    pass
+'''
+
+
+@pytest.fixture
+def package(tmp_path, monkeypatch):
+    """A package with a commands module, which is not imported yet."""
+    commands = tmp_path / 'lazypkg' / 'commands'
+    commands.mkdir(parents=True)
+    (tmp_path / 'lazypkg' / '__init__.py').write_text('')
+    (commands / '__init__.py').write_text(
+        'from lazypkg.commands import greet  # noqa\n')
+    (commands / 'greet.py').write_text(GREET)
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    yield commands
+    forget('lazypkg')
+
+
+def forget(name):
+    for module in list(sys.modules):
+        if module.startswith(name):
+            del sys.modules[module]
+
+
+def test_manifest_imports_modules_on_first_match(package, tmp_path):
+    c = MockConnection()
+    path = str(tmp_path / 'manifest.json')
+    functions = manifest.find_commands(['lazypkg', ('nopkg', {})], path)
+
+    assert [f.__name__ for f in functions] == ['bye', 'hello', 'motd']
+
+    with open(path) as f:
+        entries = json.load(f)['commands']
+
+    assert entries[1]['patterns'] == [[r'^hello (\w+)', 32]]
+    assert entries[2]['code'] == 376
+
+    forget('lazypkg')
+    functions = manifest.find_commands(['lazypkg', ('nopkg', {})], path)
+    index = CommandIndex(functions)
+    settings = MockObject(command_prefix='!', admins=[])
+
+    assert all(isinstance(f, manifest.LazyFunction) for f in functions)
+    assert 'lazypkg.commands.greet' not in sys.modules
+
+    # Lines which none of the commands could match do not import anything.
+    line = Line(':John!JDoe@some.host PRIVMSG #Chan :!howdy', c)
+    assert list(index.match(line, settings)) == []
+    line = Line(':irc.example.net 375 A :- Message of the day', c)
+    assert index.candidates(line) == []
+    assert 'lazypkg.commands.greet' not in sys.modules
+
+    line = Line(':John!JDoe@some.host PRIVMSG #Chan :!hello John', c)
+    [(command, m)] = index.match(line, settings)
+    assert 'lazypkg.commands.greet' in sys.modules
+    assert m.group(1) == 'John'
+    assert command.function is sys.modules['lazypkg.commands.greet'].hello
+
+
+def test_manifest_is_rebuilt_when_stale(package, tmp_path):
+    path = str(tmp_path / 'manifest.json')
+    key = manifest.manifest_key(['lazypkg'])
+    manifest.find_commands(['lazypkg'], path)
+    assert manifest.read(path, key) is not None
+
+    # Other packages or settings.
+    assert manifest.read(path, manifest.manifest_key(
+        [('lazypkg', {'disabled_commands': ['greet.bye']})])) is None
+
+    # A changed module.
+    (package / 'greet.py').write_text(GREET + '\n\n# Changed\n')
+    assert manifest.read(path, key) is None
+
+    forget('lazypkg')
+    functions = manifest.find_commands(['lazypkg'], path)
+    assert not any(isinstance(f, manifest.LazyFunction) for f in functions)
+    assert manifest.read(path, key) is not None
@@ -0,0 +1,92 @@
+from pyromancer import benchmark
+from pyromancer.messagelog import MessageLog, Record, SegmentStore
+from pyromancer.objects import Line
+from pyromancer.test.mock_objects import MockConnection
+
+LINES = [
+    '@time=2024-01-02T03:04:05.000Z :John!JDoe@some.host PRIVMSG #Chan '
+    ':Hello there',
+    'PING :irc.example.net',
+    ':irc.example.net 376 Pyro :End of /MOTD command.',
+    ':Jane!JDoe@some.host JOIN #Chan',
+    ':Jane!JDoe@some.host KICK #Chan John :Bye',
+    ':Jane!JDoe@some.host QUIT :Gone',
+]
+
+
+class MemoryStore(object):
+
+    def __init__(self):
+        self.batches = []
+        self.closed = False
+
+    def write(self, records):
+        self.batches.append(records)
+
+    def close(self):
+        self.closed = True
+
+
+def test_message_log_writes_batches():
+    store = MemoryStore()
+    log = MessageLog(store, batch_size=3, delay=10)
+    bot = benchmark.make_bot(1)
+    bot.message_log = log
+    connection = benchmark.MemoryConnection(bot.settings)
+
+    for line in LINES:
+        bot.process(line, connection)
+
+    # The first three messages were written at once, the last one waits.
+    log.queue.join()
+    [batch] = store.batches
+    assert batch[0] == Record(1704164645.0, '', 'PRIVMSG', 'John', '#Chan',
+                              'Hello there')
+    assert [r[2:] for r in batch[1:]] == [
+        ('JOIN', 'Jane', '#Chan', None), ('KICK', 'Jane', '#Chan', 'John Bye')]
+
+    assert log.timeout(log.due - 4) == 4
+    log.check(log.due - 1)
+    log.queue.join()
+    assert len(store.batches) == 1
+
+    log.check(log.due)
+    log.queue.join()
+    assert store.batches[1][0][2:] == ('QUIT', 'Jane', None, 'Gone')
+    assert log.timeout() is None
+
+    log.close()
+    assert store.closed
+    assert log.written == 4
+
+
+def test_message_log_to_sqlite(tmp_path):
+    log = MessageLog(str(tmp_path / 'log.db'), verbs=['PRIVMSG'])
+    c = MockConnection()
+
+    for i in range(5):
+        log.add(Line(':John!JDoe@some.host PRIVMSG #Chan :{}'.format(i), c),
+                c)
+
+    log.close()
+    assert [r.text for r in log.store.records()] == list('01234')
+
+
+def test_segments_are_rotated(tmp_path):
+    store = SegmentStore(str(tmp_path / 'logs'), max_bytes=100)
+    records = [Record(float(i), 'net', 'PRIVMSG', 'John', '#Chan',
+                      'Message {}'.format(i)) for i in range(6)]
+
+    for i in range(0, 6, 2):
+        store.write(records[i:i + 2])
+
+    store.close()
+    assert len(store.segments()) == 2
+    assert list(store.records()) == records
+
+    # Writing continues in the last segment, which is not full yet.
+    store = SegmentStore(str(tmp_path / 'logs'), max_bytes=1000)
+    store.write(records[:1])
+    store.close()
+    assert len(store.segments()) == 2
+    assert list(store.records()) == records + records[:1]
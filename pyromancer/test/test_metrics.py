@@ -0,0 +1,136 @@
+import datetime
+
+from pyromancer import benchmark
+from pyromancer.commands import stats
+from pyromancer.decorators import command
+from pyromancer.metrics import Histogram, Metrics
+from pyromancer.objects import Line, Timer
+from pyromancer.test.decorators import mock_connection
+from pyromancer.test.mock_objects import MockObject
+
+
+@command(r'hello')
+def hello(match):
+    return 'Hello'
+
+
+def tick(match):
+    return '#Chan', 'Tick'
+
+
+def test_histogram():
+    histogram = Histogram((0.1, 1, float('inf')))
+
+    for value in (0.05, 0.05, 0.5, 2):
+        histogram.observe(value)
+
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.75) == 1
+    assert histogram.quantile(0.99) == float('inf')
+    assert list(histogram.cumulative()) == [(0.1, 2), (1, 3),
+                                            (float('inf'), 4)]
+
+
+def test_metrics_by_handler():
+    metrics = Metrics(None)
+    metrics.attempt(hello.command, None)
+    metrics.attempt(hello.command, True)
+    metrics.ran(hello.command, 0.002)
+    metrics.ran(hello.command, 0.02, error=True)
+
+    name = 'pyromancer.test.test_metrics.hello'
+    handler = metrics.snapshot()['handlers'][name]
+    assert handler['attempts'] == 2
+    assert handler['hits'] == 1
+    assert handler['errors'] == 1
+    assert handler['calls'] == 2
+    assert handler['p50'] == 0.005
+
+    text = metrics.prometheus()
+    assert 'pyromancer_handler_hits_total{{handler="{}"}} 1'.format(
+        name) in text
+    assert 'pyromancer_handler_seconds_bucket{{handler="{}",le="+Inf"}} ' \
+        '2'.format(name) in text
+
+
+def test_metrics_hooks():
+    reports = []
+    metrics = Metrics(None, [reports.append], interval=10)
+    start = metrics.next_report - 10
+
+    metrics.report(start + 5)
+    assert reports == []
+    assert metrics.timeout(start + 5) == 5
+
+    metrics.report(start + 10)
+    assert reports == [metrics]
+    assert metrics.timeout(start + 10) == 10
+
+    assert Metrics(None).timeout() is None
+
+
+def test_metrics_of_processed_lines():
+    bot = benchmark.make_bot(2)
+    connection = benchmark.MemoryConnection(bot.settings)
+    bot.connections = [connection]
+
+    for msg in ('!cmd1 test', '!cmd1 ?', 'Hello'):
+        bot.process(':John!JDoe@some.host PRIVMSG #Chan :{}'.format(msg),
+                    connection)
+
+    connection.flush()
+    handler = bot.metrics.snapshot()['handlers'][
+        'pyromancer.benchmark.make_command.<locals>.reply']
+    assert handler['attempts'] == 2
+    assert handler['hits'] == 1
+    assert handler['calls'] == 1
+
+
+def test_metrics_of_fired_timers():
+    bot = benchmark.make_bot(0)
+    connection = benchmark.MemoryConnection(bot.settings)
+    bot.connections = [connection]
+
+    for timer in (Timer(datetime.timedelta(seconds=1), tick, direct=True),
+                  Timer(datetime.timedelta(seconds=1), 'Tock', direct=True,
+                        target='#Chan')):
+        bot.timers.append(timer.bind(connection))
+
+    bot.timers.run(bot.fire)
+    assert connection.queue.take() == [b'PRIVMSG #Chan :Tick\n',
+                                       b'PRIVMSG #Chan :Tock\n']
+
+    handlers = bot.metrics.snapshot()['handlers']
+    assert handlers['pyromancer.test.test_metrics.tick']['calls'] == 1
+    assert handlers['message timer']['calls'] == 1
+
+
+@mock_connection
+def test_stats_command(c):
+    settings = MockObject(command_prefix='!', admins=['John'])
+    c.bot = MockObject(connections=[])
+    c.bot.metrics = Metrics(c.bot)
+    c.bot.metrics.attempt(hello.command, True)
+    c.bot.metrics.ran(hello.command, 0.002)
+
+    line = Line(':John!JDoe@some.host PRIVMSG #Chan :!stats', c)
+    line.sender.auth = 'John'
+    stats.stats.command.match(line, [], c, settings)
+    assert c.outbox == [
+        'PRIVMSG #Chan :pyromancer.test.test_metrics.hello: 1 hits of 1 '
+        'attempts, 0 errors, 2.0 ms in total, p99 under 5.0 ms',
+        'PRIVMSG #Chan :0 lines in, 0 bytes in, 0 bytes out, 0 lines queued, '
+        'timer lag p99 under 0 ms']
+
+
+@mock_connection
+def test_stats_command_needs_the_whole_message(c):
+    settings = MockObject(command_prefix=None, admins=['John'])
+
+    for msg in ('stats', 'stats hello', 'these stats look off',
+                'check the gamestats channel'):
+        line = Line(':John!JDoe@some.host PRIVMSG #Chan :{}'.format(msg), c)
+        line.sender.auth = 'John'
+        assert bool(stats.stats.command.matches(line, settings)) is \
+            msg.startswith('stats')
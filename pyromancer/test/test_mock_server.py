@@ -0,0 +1,67 @@
+import threading
+import time
+
+from pyromancer.test.mock_server import MockServer, accounts, make_bot, \
+    tracked
+
+
+def soak(server, done, timeout=30, **settings):
+    """Run a bot against the server until the server is done.
+
+    The server stops once done returns true for its client, after which
+    the bot reads what was sent before, and stops as well.
+    """
+    bot = make_bot(server, **settings)
+    bot.connect()
+    connection = bot.connections[0]
+
+    def watch():
+        end = time.monotonic() + timeout
+
+        while time.monotonic() < end and not (
+                server.clients and done(server.clients[0])):
+            time.sleep(0.01)
+
+        server.stop()
+
+    thread = threading.Thread(target=watch)
+    thread.start()
+    bot.listen()
+    thread.join()
+    return bot, connection
+
+
+def test_soak_tracks_users_and_channels():
+    with MockServer(channels=3, users=30, rate=2000, churn=0.3,
+                    netsplit=0.2) as server:
+        bot, connection = soak(server, lambda client: client.sent >= 2000 and
+                               client.splits >= 2)
+
+    client = server.clients[0]
+    assert client.sent >= 2000
+    assert bot.metrics.lines_in == client.sent
+    assert tracked(connection) == client.channels
+
+    # Every account the server sent is known, unless the user left since.
+    assert accounts(connection) == dict(
+        (nick, client.reported.get(nick)) for nick in accounts(connection))
+    assert any(accounts(connection).values())
+
+
+def test_ssl_registration_and_replies():
+    def answered(client):
+        nicks = client.channels.get('#channel0')
+        return nicks is not None and set(client.reported) >= nicks
+
+    with MockServer(channels=1, users=5, use_ssl=True, whox=False) as server:
+        bot, connection = soak(server, answered)
+
+    client = server.clients[0]
+    assert 'NICK Pyro' in client.received
+    assert 'WHO #channel0' in client.received
+    assert bot.metrics.lines_in == client.sent
+    assert tracked(connection) == client.channels
+
+    # Without WHOX, the accounts are asked for one by one.
+    assert connection.get_user('user1').auth == 'account1'
+    assert connection.get_user('user2').auth is None
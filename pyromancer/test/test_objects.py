@@ -1,9 +1,18 @@
+import collections
 import datetime
 import re
+import socket
+
+import pytest
 
 from pyromancer.decorators import timer
-from pyromancer.objects import User, Line, Match, Timer, Channel
+from pyromancer.dispatch import CommandIndex
+from pyromancer.exceptions import SettingsException, TimerException
+from pyromancer.objects import User, Line, Match, Timer, Channel, \
+    NetworkSettings, Settings, WriteQueue, Scheduler, LineBuffer, Connection, \
+    Pyromancer, MIN_READ_SIZE, MAX_READ_SIZE, PRIORITY_HIGH, PRIORITY_LOW
 from pyromancer.test.decorators import mock_connection
+from pyromancer.test.mock_objects import MockObject
 
 
 def test_user_str_parsing():
@@ -37,7 +46,7 @@ def test_channel_get_function(c):
     chan = Channel('#test')
     assert c.channels == []
 
-    c.me.channels.append(chan)
+    c.join(c.me, chan)
     assert c.channels == [chan]
 
     assert Channel.get('#test', c) is chan
@@ -47,6 +56,54 @@ def test_channel_get_function(c):
     assert Channel.get('#test', match) is chan
 
 
+@mock_connection
+def test_connection_casemapping(c):
+    c.me = User('Pyro')
+    chan = Channel('#Chan[1]')
+    user = User('Test[]^')
+    c.join(c.me, chan)
+    c.join(user, chan)
+
+    assert User.get('PYRO', c) is c.me
+    assert User.get('test{}~', c) is user
+    assert Channel.get('#chan{1}', c) is chan
+
+    c.set_casemapping('ascii')
+    assert User.get('TEST[]^', c) is user
+    assert User.get('test{}~', c) is None
+    assert Channel.get('#chan{1}', c) is None
+    assert Channel.get('#CHAN[1]', c) is chan
+
+
+@mock_connection
+def test_connection_registry(c):
+    c.me = User('Pyro')
+    chan1, chan2 = Channel('#Chan1'), Channel('#Chan2')
+    user1, user2 = User('User1'), User('User2')
+
+    c.join(c.me, chan1)
+    c.join(c.me, chan2)
+    c.join(user1, chan1)
+    c.join(user2, chan1)
+    c.join(user2, chan2)
+    assert c.users == [c.me, user1, user2]
+
+    c.rename(user1, 'User3')
+    assert User.get('User1', c) is None
+    assert User.get('User3', c) is user1
+
+    c.part(user2, chan1)
+    assert User.get('User2', c) is user2
+
+    c.part(c.me, chan2)
+    assert User.get('User2', c) is None
+    assert c.channels == [chan1]
+
+    c.quit(user1)
+    assert c.users == [c.me]
+    assert chan1.users == set([c.me])
+
+
 @mock_connection
 def test_line_parsing_with_privmsg(c):
     line_str = ':John!JDoe@some.shot PRIVMSG #Chan :Some cool message'
@@ -152,3 +209,403 @@ def test_messaging_from_timer(c):
 
     instance.send_messages(('User', 'Hello {}', 'world'), match, timers)
     assert c.last == 'PRIVMSG User :Hello world'
+
+
+def test_timer_seconds_left_function():
+    now = datetime.datetime.now()
+    connect_time = now - datetime.timedelta(seconds=4)
+
+    assert Timer(datetime.timedelta(seconds=5), direct=True).seconds_left(
+        connect_time) == 0
+    assert 0 < Timer(datetime.timedelta(seconds=5)).seconds_left(
+        connect_time) <= 1
+    assert Timer(datetime.timedelta(seconds=3)).seconds_left(
+        connect_time) < 0
+    assert Timer(now + datetime.timedelta(days=1)).seconds_left(
+        connect_time) > 86000
+
+
+def test_network_settings():
+    settings = MockObject(host='irc.example.net', nick='Pyro', networks=[])
+    network = NetworkSettings(settings, {'host': 'irc.example.org'})
+
+    assert network.host == 'irc.example.org'
+    assert network.nick == 'Pyro'
+
+
+def test_settings_are_resolved_once(tmp_path, monkeypatch):
+    for package, content in (
+            ('setbot', "packages = ['setplugin']\nnick = 'Pyro'\n"),
+            ('setplugin', "nick = 'Plugin'\nflood_rate = 2\n")):
+        (tmp_path / package).mkdir()
+        (tmp_path / package / '__init__.py').write_text('')
+        (tmp_path / package / 'settings.py').write_text(content)
+
+    monkeypatch.syspath_prepend(str(tmp_path))
+    settings = Settings('setbot.settings')
+    network = NetworkSettings(settings, {'nick': 'Other'})
+
+    # The settings of earlier packages win, and the defaults come last.
+    assert settings.nick == 'Pyro'
+    assert settings.flood_rate == 2
+    assert settings.encoding == 'utf8'
+    assert 'nick' in vars(settings)
+    assert network.nick == 'Other'
+
+    with pytest.raises(AttributeError) as e:
+        settings.no_such_setting
+    assert 'No such setting "no_such_setting"' in str(e.value)
+
+    (tmp_path / 'setplugin' / 'settings.py').write_text(
+        "nick = 'Plugin'\nencoding = 'latin-1'\n")
+    settings.reload()
+    network.resolve()
+
+    assert settings.flood_rate == 0.5
+    assert settings.encoding == 'latin-1'
+    assert network.encoding == 'latin-1'
+    assert settings.packages == ['setbot', 'setplugin']
+
+
+def test_settings_leave_out_imports_and_reserved_names(tmp_path,
+                                                       monkeypatch):
+    (tmp_path / 'helperbot').mkdir()
+    (tmp_path / 'helperbot' / '__init__.py').write_text('')
+    (tmp_path / 'helperbot' / 'settings.py').write_text(
+        "import os\nfrom collections import OrderedDict\n\n\n"
+        "def helper():\n    pass\n\n\nnick = 'Pyro'\npath = '/tmp'\n"
+        "settings = 'Mine'\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    settings = Settings('helperbot.settings')
+
+    assert settings.nick == 'Pyro'
+    assert 'os' not in vars(settings)
+    assert settings.OrderedDict is collections.OrderedDict
+    assert settings.helper() is None
+    assert settings.path == '/tmp'
+
+    network = NetworkSettings(settings, {'nick': 'Other'})
+    assert network.nick == 'Other'
+    assert network.path == '/tmp'
+    assert network.settings == 'Mine'
+    assert network.helper is settings.helper
+
+    (tmp_path / 'helperbot' / 'settings.py').write_text("reload = True\n")
+
+    with pytest.raises(SettingsException) as e:
+        settings.reload()
+    assert 'The setting "reload" in helperbot.settings' in str(e.value)
+
+    with pytest.raises(SettingsException):
+        NetworkSettings(MockObject(nick='Pyro'), {'resolve': None})
+
+
+@mock_connection
+def test_timer_binding(c):
+    timer = Timer(datetime.timedelta(seconds=3))
+    bound = timer.bind(c)
+
+    assert timer.connection is None
+    assert bound.connection is c
+    assert bound.scheduled == timer.scheduled
+    assert bound != timer
+
+
+@mock_connection
+def test_capability_negotiation(c):
+    c.settings = MockObject(capabilities=['account-notify', 'extended-join'])
+
+    # Registration finishes without any commands.
+    bot = Pyromancer.__new__(Pyromancer)
+    bot.index = CommandIndex([])
+
+    bot.process(':irc.example.net CAP * LS * :multi-prefix sasl=PLAIN', c)
+    assert c.outbox == []
+
+    bot.process(':irc.example.net CAP * LS :extended-join', c)
+    assert c.last == 'CAP REQ :extended-join'
+
+    bot.process(':irc.example.net CAP Pyro ACK :extended-join', c)
+    assert c.caps == set(['extended-join'])
+    assert c.last == 'CAP END'
+
+    bot.process(':irc.example.net CAP Pyro DEL :extended-join', c)
+    assert c.caps == set()
+
+    del c.outbox[:]
+    bot.process(':irc.example.net CAP Pyro NAK :extended-join', c)
+    assert c.outbox == ['CAP END']
+
+
+@mock_connection
+def test_line_parsing_with_tags(c):
+    line = Line('@time=2014-10-18T12:30:00.000Z;msgid=a\\sb\\:c;flag '
+                ':John!JDoe@some.host PRIVMSG #Chan :Some  cool :message', c)
+
+    assert line.tags == {'time': '2014-10-18T12:30:00.000Z',
+                         'msgid': 'a b;c', 'flag': ''}
+    assert line.prefix == 'John!JDoe@some.host'
+    assert line.verb == 'PRIVMSG'
+    assert line.params == ['#Chan', 'Some  cool :message']
+    assert line.raw == 'John!JDoe@some.host PRIVMSG #Chan :Some  cool :message'
+    assert line.full_msg == 'Some  cool :message'
+    assert line.sender.nick == 'John'
+    assert line.channel.name == '#Chan'
+    assert line.datetime == datetime.datetime.fromtimestamp(1413635400)
+
+
+@mock_connection
+def test_line_parsing_is_lazy(c):
+    line = Line(':John!JDoe@some.host PRIVMSG #Chan :Hi', c)
+
+    assert not hasattr(line, '_verb')
+
+    assert line.usermsg is True
+    assert not hasattr(line, '_sender')
+    assert not hasattr(line, '_parts')
+
+
+@mock_connection
+def test_line_parsing_without_prefix(c):
+    line = Line('PING :irc.example.net', c)
+
+    assert line.prefix is None
+    assert line.command == 'PING'
+    assert line.params == ['irc.example.net']
+    assert line.sender is None
+    assert line.channel is None
+    assert line[0] == 'PING'
+
+
+def test_write_queue_priorities_and_flood_control():
+    queue = WriteQueue(rate=0.5, burst=2)
+    now = queue.updated
+
+    queue.put(b'WHOIS A', PRIORITY_LOW)
+    queue.put(b'WHOIS B', PRIORITY_LOW)
+    queue.put(b'PRIVMSG #Chan :Hi')
+    queue.put(b'PRIVMSG #Chan :There')
+    queue.put(b'PONG :irc.example.net', PRIORITY_HIGH)
+
+    assert queue.take(now) == [b'PONG :irc.example.net', b'PRIVMSG #Chan :Hi',
+                               b'PRIVMSG #Chan :There']
+    assert len(queue) == 2
+    assert queue.delay(now) == 2
+
+    assert queue.take(now + 1) == []
+    assert queue.take(now + 2) == [b'WHOIS A']
+    assert queue.take(now + 10) == [b'WHOIS B']
+    assert queue.delay(now + 10) == 0
+
+
+def test_write_queue_without_flood_control():
+    queue = WriteQueue(rate=None)
+
+    for i in range(100):
+        queue.put(b'PRIVMSG #Chan :Hi')
+
+    assert len(queue.take()) == 100
+
+
+def test_no_timeout_while_write_is_blocked():
+    a, b = socket.socketpair()
+    b.setblocking(False)
+
+    connection = Connection.__new__(Connection)
+    connection.socket = b
+    connection.buffer = LineBuffer()
+    connection.queue = WriteQueue(rate=None)
+    connection.outgoing = bytearray()
+    connection.bytes_out = 0
+
+    bot = Pyromancer.__new__(Pyromancer)
+    bot.connections = [connection]
+    bot.timers = Scheduler()
+    bot.workers = bot.metrics = MockObject(timeout=lambda: None)
+
+    connection.queue.put(b'PRIVMSG #Chan :Hi')
+    assert bot.timeout() == 0
+
+    # Fill the socket until sending blocks.
+    while not connection.outgoing:
+        connection.queue.put(b'PRIVMSG #Chan :' + b'x' * 500)
+        connection.flush()
+
+    connection.queue.put(b'PONG :irc.example.net', PRIORITY_HIGH)
+    assert bot.timeout() is None
+
+    a.close()
+    b.close()
+
+
+def test_scheduler():
+    now = datetime.datetime.now()
+    connection = MockObject(connect_time=now, settings=None)
+    fired = []
+
+    def fire(timer):
+        fired.append(timer)
+        timer.fire(scheduler, connection, None)
+
+    once = Timer(now - datetime.timedelta(seconds=2)).bind(connection)
+    later = Timer(now + datetime.timedelta(days=1)).bind(connection)
+    twice = Timer(datetime.timedelta(seconds=3), count=2).bind(connection)
+    direct = Timer(datetime.timedelta(seconds=60), direct=True).bind(
+        connection)
+
+    start = 1000000.0
+    scheduler = Scheduler()
+    for timer in (once, later, twice, direct):
+        scheduler.append(timer, start)
+
+    assert len(scheduler) == 4
+    assert scheduler.timeout(start) == 0
+
+    scheduler.run(fire, start)
+    assert fired == [once, direct]
+    assert len(scheduler) == 3
+    assert scheduler.timeout(start) == 3
+
+    scheduler.remove(direct)
+    assert len(scheduler) == 2
+    assert list(scheduler) == [twice, later]
+
+    scheduler.run(fire, start + 3.1)
+    scheduler.run(fire, start + 6.2)
+    assert fired == [once, direct, twice, twice]
+
+    # The wall clock is checked again, but it is not time yet.
+    scheduler.run(fire, start + 60)
+    assert fired == [once, direct, twice, twice]
+    assert len(scheduler) == 1
+    assert scheduler.timeout(start + 60) == 60
+
+
+def test_timer_periodic_scheduling():
+    connection = MockObject(connect_time=datetime.datetime.now())
+    start = 1000000.0
+
+    def run(timer, times):
+        fired = []
+        scheduler = Scheduler()
+        scheduler.append(timer.bind(connection), start)
+
+        for now in times:
+            scheduler.run(lambda t: fired.append(now), start + now)
+
+        return fired
+
+    every_ten = datetime.timedelta(seconds=10)
+
+    # A fixed rate does not drift when the loop wakes up late.
+    assert run(Timer(every_ten), [10.5, 20.2, 30.5]) == [10.5, 20.2, 30.5]
+    delay = Timer(every_ten, schedule_mode='delay')
+    assert run(delay, [10.5, 20.2, 30.5]) == [10.5, 30.5]
+
+    # Falling behind by more than a period.
+    times = [35, 35, 35, 35, 40]
+    assert run(Timer(every_ten), times) == [35, 40]
+    assert run(Timer(every_ten, schedule_catchup='skip'), times) == [40]
+    burst = Timer(every_ten, schedule_catchup='burst')
+    assert run(burst, times) == [35, 35, 35, 40]
+
+    with pytest.raises(TimerException):
+        Timer(every_ten, schedule_mode='sometimes')
+
+    with pytest.raises(TimerException):
+        Timer(every_ten, schedule_catchup='never')
+
+    # Other keyword arguments are left to format the message.
+    timer = Timer(every_ten, 'In {mode} mode', target='#Chan', mode='quiet',
+                  catchup=True)
+    assert timer.mode == 'rate'
+    assert timer.msg_tuple[3] == {'mode': 'quiet', 'catchup': True}
+
+
+def test_line_buffer():
+    buffer = LineBuffer()
+    buffer.feed(b':server 001 Pyro :Wel')
+    assert buffer.lines() == []
+
+    buffer.feed(b'come\r\nPING :1\nPI')
+    assert buffer.lines() == [':server 001 Pyro :Welcome', 'PING :1']
+    assert len(buffer) == 2
+
+    # Bytes which are not valid UTF-8 are decoded with the fallback.
+    buffer.feed(b'NG :caf\xe9\r\n')
+    assert list(buffer) == ['PING :caf\xe9']
+    assert len(buffer) == 0
+
+
+def test_line_buffer_limit():
+    buffer = LineBuffer()
+    buffer.feed(b'1\r\n2\r\n3\r\n4')
+    assert buffer.lines(2) == ['1', '2']
+    assert buffer.has_lines()
+    assert buffer.lines(2) == ['3']
+    assert not buffer.has_lines()
+
+    buffer.feed(b'\r\n')
+    assert buffer.lines(2) == ['4']
+
+
+def test_line_buffer_drops_long_lines():
+    buffer = LineBuffer(max_line_length=10)
+    buffer.feed(b'0123456789\r\n0123456789A\r\nshort\n')
+    assert buffer.lines() == ['0123456789', 'short']
+
+    # A line which is too long is dropped before its end arrives.
+    buffer.feed(b'0123456789ABCDEF')
+    assert buffer.lines() == []
+    assert len(buffer) == 0
+
+    buffer.feed(b'GHIJ\r\nshort\r\n')
+    assert buffer.lines() == ['short']
+
+
+def test_line_buffer_read_from():
+    a, b = socket.socketpair()
+    buffer = LineBuffer()
+
+    a.sendall(b'PING :1\r\nPING')
+    assert buffer.read_from(b) == 13
+    a.close()
+    assert buffer.read_from(b) == 0
+    b.close()
+
+    assert buffer.lines() == ['PING :1']
+    assert bytes(buffer.buffer) == b'PING'
+
+
+def test_connection_read_drains_socket():
+    a, b = socket.socketpair()
+    b.setblocking(False)
+
+    connection = Connection.__new__(Connection)
+    connection.socket = b
+    connection.buffer = LineBuffer()
+    connection.read_size = MIN_READ_SIZE
+    connection.bytes_in = 0
+    connection.closed = False
+
+    a.sendall(b'PING :1\r\n' * 10000)
+    connection.read()
+
+    assert len(connection.buffer) == 90000
+    assert connection.bytes_in == 90000
+    assert connection.read_size == MAX_READ_SIZE
+
+    # Nothing more is read while enough data waits to be handled.
+    a.sendall(b'PING :2\r\n')
+    connection.read(limit=90000)
+    assert len(connection.buffer) == 90000
+
+    assert len(connection.buffer.lines()) == 10000
+    connection.read()
+    assert connection.buffer.lines() == ['PING :2']
+    assert connection.read_size == MAX_READ_SIZE // 2
+
+    a.close()
+    connection.read()
+    assert connection.closed
+    b.close()
@@ -0,0 +1,142 @@
+import datetime
+import sys
+
+import pytest
+
+from pyromancer.commands import reload
+from pyromancer.objects import Line, Pyromancer, Scheduler
+from pyromancer.reloading import Reloader
+from pyromancer.test.mock_objects import MockConnection, MockObject
+
+COMMANDS = '''from pyromancer.decorators import command
+
+
+@command(r'^version')
+def version(match):
+    return 'Version {}'
+'''
+
+TIMERS = '''import datetime
+
+from pyromancer.decorators import timer
+
+
+@timer(datetime.timedelta(seconds=60))
+def tick(match):
+    return '#Chan', 'Tick {}'
+'''
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    package = tmp_path / 'hotpkg'
+    package.mkdir()
+    (package / '__init__.py').write_text('')
+    (package / 'commands.py').write_text(COMMANDS.format(1))
+    (package / 'timers.py').write_text(TIMERS.format(1))
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    bot = Pyromancer.__new__(Pyromancer)
+    bot.settings = MockObject(packages=['hotpkg'], command_manifest=None,
+                              reload_interval=None, command_prefix='!',
+                              admins=['admin'])
+    bot.find_commands()
+    bot.find_timers()
+    bot.reloader = Reloader(bot.settings.packages)
+
+    connection = MockConnection()
+    connection.bot = bot
+    connection.settings = bot.settings
+    bot.connections = [connection]
+    bot.connection = connection
+    bot.schedule_timers()
+
+    yield bot
+
+    for name in list(sys.modules):
+        if name.startswith('hotpkg'):
+            del sys.modules[name]
+
+
+def reply(bot, msg):
+    connection = bot.connection
+    line = Line(':John!JDoe@some.host PRIVMSG #Chan :{}'.format(msg),
+                connection)
+
+    for command, m in bot.index.match(line, bot.settings):
+        command.match(line, bot.timers, connection, bot.settings)
+
+    return connection.outbox.pop()
+
+
+def test_reload_changed_modules(bot, tmp_path):
+    package = tmp_path / 'hotpkg'
+    timer = next(iter(bot.timers))
+    assert reply(bot, '!version') == 'PRIVMSG #Chan :Version 1'
+    assert bot.reload_commands() == ([], [])
+
+    (package / 'commands.py').write_text(
+        COMMANDS.format(22) + "\n\n@command(r'^new')\ndef new(match):\n"
+                              "    return 'New'\n")
+    assert bot.reload_commands() == (['hotpkg.commands'], [])
+    assert reply(bot, '!version') == 'PRIVMSG #Chan :Version 22'
+    assert reply(bot, '!new') == 'PRIVMSG #Chan :New'
+
+    # The timers of modules which did not change keep their schedule.
+    assert list(bot.timers) == [timer]
+    assert isinstance(bot.timers, Scheduler)
+
+    (package / 'timers.py').write_text(TIMERS.format(22))
+    assert bot.reload_commands() == (['hotpkg.timers'], [])
+    [new] = list(bot.timers)
+    assert new is not timer
+    assert new.connection is bot.connection
+    assert new.period == 60
+
+
+def test_reload_keeps_modules_with_errors(bot, tmp_path):
+    (tmp_path / 'hotpkg' / 'commands.py').write_text(
+        COMMANDS.format(2) + '\nraise ValueError("Broken")\n')
+
+    reloaded, errors = bot.reload_commands()
+    assert reloaded == []
+    assert [(name, str(e)) for name, e in errors] == [
+        ('hotpkg.commands', 'Broken')]
+    assert reply(bot, '!version') == 'PRIVMSG #Chan :Version 1'
+
+    # It is tried again, until it works.
+    assert len(bot.reload_commands()[1]) == 1
+    (tmp_path / 'hotpkg' / 'commands.py').write_text(COMMANDS.format(3))
+    assert bot.reload_commands() == (['hotpkg.commands'], [])
+
+
+def test_reload_command(bot, tmp_path):
+    connection = bot.connection
+    line = Line(':John!JDoe@some.host PRIVMSG #Chan :!reload', connection)
+    line.sender.auth = 'admin'
+
+    reload.reload.command.match(line, bot.timers, connection, bot.settings)
+    assert connection.outbox == ['PRIVMSG #Chan :Nothing changed']
+
+    (tmp_path / 'hotpkg' / 'commands.py').write_text(COMMANDS.format(4))
+    reload.reload.command.match(line, bot.timers, connection, bot.settings)
+    assert connection.last == 'PRIVMSG #Chan :Reloaded hotpkg.commands'
+
+
+def test_reload_command_needs_the_whole_message(bot):
+    for prefix, msg in ((None, 'I will reload the page later'),
+                        ('!', '!reloaded ok'), ('!', '!reload'),
+                        (None, 'reload')):
+        bot.settings.command_prefix = prefix
+        line = Line(':John!JDoe@some.host PRIVMSG #Chan :{}'.format(msg),
+                    bot.connection)
+        line.sender.auth = 'admin'
+        assert bool(reload.reload.command.matches(line, bot.settings)) is \
+            msg.endswith('reload')
+
+def test_reload_interval_schedules_a_watch(bot):
+    bot.settings.reload_interval = 5
+    bot.schedule_timers()
+
+    [watch] = [t for t in bot.timers if t.function == bot.reload_changed]
+    assert watch.scheduled == datetime.timedelta(seconds=5)
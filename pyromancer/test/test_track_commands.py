@@ -18,11 +18,10 @@ def test_join_command(c):
     assert line.sender is c.me
 
     match(line)
-    assert len(c.me.channels) == 1
-    assert c.me.channels[0] is line.channel
-    assert c.last == 'WHOIS Pyro'
+    assert c.channels_of(c.me) == [line.channel]
+    assert c.last == 'WHO #Chan'
 
-    channel = c.me.channels[0]
+    channel = c.channels[0]
     line = Line(':User1!Hello@world JOIN #Chan', c)
     assert line.command == 'JOIN'
     assert line.channel == channel
@@ -30,5 +29,108 @@ def test_join_command(c):
     match(line)
 
     assert c.last == 'WHOIS User1'
-    assert channel.users == [c.me, line.sender]
-    assert line.sender.channels == [channel]
+    assert channel.users == set([c.me, line.sender])
+    assert c.channels_of(line.sender) == [channel]
+
+
+@mock_connection
+def test_names_and_isupport_commands(c):
+    settings = MockObject(command_prefix='!')
+    c.me = User('Pyro')
+
+    def match(function, line):
+        line = Line(line, c)
+        assert function.command.matches(line, settings) is True
+        function.command.match(line, [], c, settings)
+
+    match(track.isupport, ':irc.example.net 005 Pyro CHANTYPES=# '
+                          'CASEMAPPING=ascii :are supported by this server')
+    assert c.casemapping == 'ascii'
+    assert c.isupport['CHANTYPES'] == '#'
+
+    match(track.join, ':Pyro!Hello@world JOIN :#Chan')
+    match(track.names, ':irc.example.net 353 Pyro = #Chan :Pyro @Op +Voice')
+    channel = c.channels[0]
+    assert set(u.nick for u in channel.users) == set(['Pyro', 'Op', 'Voice'])
+    assert c.last == 'WHO #Chan'
+
+    op = User.get('Op', c)
+    match(track.nick, ':Op!Hello@world NICK :Oper')
+    assert User.get('Oper', c) is op
+
+    match(track.kick, ':Oper!Hello@world KICK #Chan Voice :Bye')
+    assert User.get('Voice', c) is None
+    assert set(u.nick for u in channel.users) == set(['Pyro', 'Oper'])
+
+
+@mock_connection
+def test_roster_sync_with_whox(c):
+    settings = MockObject(command_prefix='!')
+    c.me = User('Pyro')
+    c.isupport['WHOX'] = ''
+    c.caps.update(['extended-join', 'account-notify'])
+
+    def match(function, line):
+        line = Line(line, c)
+        assert function.command.matches(line, settings) is True
+        function.command.match(line, [], c, settings)
+
+    match(track.join, ':Pyro!Hello@world JOIN #Chan * :Real name')
+    assert c.last == 'WHO #Chan %tuhnfa,152'
+
+    match(track.names, ':irc.example.net 353 Pyro = #Chan :Pyro @Op User')
+    match(track.whox, ':irc.example.net 354 Pyro 152 op some.host Op H@ OpAcc')
+    match(track.whox, ':irc.example.net 354 Pyro 152 user other.host User H 0')
+    assert User.get('Op', c).auth == 'OpAcc'
+    assert User.get('Op', c).host == 'some.host'
+    assert User.get('User', c).auth is None
+
+    match(track.join, ':New!new@host JOIN #Chan NewAcc :Real name')
+    assert User.get('New', c).auth == 'NewAcc'
+
+    match(track.account, ':User!user@other.host ACCOUNT UserAcc')
+    assert User.get('User', c).auth == 'UserAcc'
+    assert not any(line.startswith('WHOIS') for line in c.outbox)
+
+
+@mock_connection
+def test_roster_sync_without_whox(c):
+    settings = MockObject(command_prefix='!')
+    c.me = User('Pyro')
+
+    def match(function, line):
+        line = Line(line, c)
+        assert function.command.matches(line, settings) is True
+        function.command.match(line, [], c, settings)
+
+    match(track.join, ':Pyro!Hello@world JOIN #Chan')
+    match(track.names, ':irc.example.net 353 Pyro = #Chan :Pyro @Op User')
+    match(track.who, ':irc.example.net 352 Pyro #Chan op some.host '
+                     'irc.example.net Op H@ :0 Real name')
+    assert User.get('Op', c).host == 'some.host'
+
+    match(track.who_end, ':irc.example.net 315 Pyro #Chan :End of /WHO list.')
+    match(track.join, ':Op!op@some.host JOIN #Chan')
+    assert sorted(c.outbox) == ['WHO #Chan', 'WHOIS Op', 'WHOIS User']
+
+
+@mock_connection
+def test_roster_sync_with_extended_join_without_whox(c):
+    settings = MockObject(command_prefix='!')
+    c.me = User('Pyro')
+    c.caps.add('extended-join')
+
+    def match(function, line):
+        line = Line(line, c)
+        assert function.command.matches(line, settings) is True
+        function.command.match(line, [], c, settings)
+
+    # The accounts of the users who were in the channel already are asked
+    # for, those of users who join are sent along.
+    match(track.join, ':Pyro!Hello@world JOIN #Chan * :Real name')
+    match(track.names, ':irc.example.net 353 Pyro = #Chan :Pyro @Op')
+    match(track.who_end, ':irc.example.net 315 Pyro #Chan :End of /WHO list.')
+    match(track.join, ':New!new@host JOIN #Chan NewAcc :Real name')
+
+    assert c.outbox == ['WHO #Chan', 'WHOIS Op']
+    assert User.get('New', c).auth == 'NewAcc'
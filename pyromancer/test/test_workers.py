@@ -0,0 +1,281 @@
+import datetime
+import os
+import pickle
+import re
+import selectors
+import sys
+import threading
+import time
+
+import pytest
+
+from pyromancer.decorators import command
+from pyromancer.exceptions import CommandException
+from pyromancer.metrics import Metrics
+from pyromancer.objects import Line, Match, Pyromancer, Settings, Timer, \
+    User
+from pyromancer.test.decorators import mock_connection
+from pyromancer.test.mock_objects import MockConnection, MockObject
+from pyromancer.workers import MatchGroups, WorkerPool, prepare
+
+release = threading.Event()
+settings = MockObject(command_prefix=None, admins=[])
+
+
+@command(r'slow ([\d.]+)', offload=True)
+def slow(match):
+    time.sleep(float(match[1]))
+    match.msg('Started {}', match[1])
+    return 'Slept {m[1]}'
+
+
+@command(r'blocked', offload=True, max_concurrency=1)
+def blocked(match):
+    release.wait(1)
+    return 'Released'
+
+
+@command(r'late', offload=True, timeout=0.05)
+def late(match):
+    time.sleep(0.2)
+    return 'Too late'
+
+
+@command(r'quick', offload=True, timeout=0.05)
+def quick(match):
+    return 'Quick'
+
+
+@command(r'broken', offload=True)
+def broken(match):
+    raise ValueError('Broken')
+
+
+@command(r'square (?P<number>\d+)', executor='process')
+def square(match):
+    return 'Square is {}', int(match['number']) ** 2
+
+
+SHARD_SETTINGS = '''packages = ['shardpkg']
+nick = 'Pyro'
+command_prefix = '!'
+shard_commands = True
+worker_processes = 2
+networks = [{'name': 'Net'}]
+'''
+
+SHARD_COMMANDS = '''import os
+
+from pyromancer.decorators import command
+
+
+@command(r'^square (?P<number>\\d+)')
+def square(match):
+    return 'Square of {} is {}', match['number'], int(match['number']) ** 2
+
+
+@command(r'^where')
+def where(match):
+    match.msg('{} {}', match.settings.name, match.line.sender.auth)
+    return str(os.getpid())
+
+
+@command(r'^here', offload=False)
+def here(match):
+    return str(os.getpid())
+'''
+
+
+def run(pool, connection, count, seconds=2):
+    """Collect replies until the connection got a number of lines."""
+    selector = selectors.DefaultSelector()
+    selector.register(pool.receiver, selectors.EVENT_READ)
+    end = time.monotonic() + seconds
+
+    while len(connection.outbox) < count and time.monotonic() < end:
+        timeout = pool.timeout()
+        selector.select(0.5 if timeout is None else timeout)
+        pool.collect([])
+
+    selector.close()
+
+
+def submit(pool, handler, connection, msg, target='#Chan'):
+    line = Line(':John!JDoe@some.host PRIVMSG {} :{}'.format(target, msg),
+                connection)
+    m = handler.command.matches(line, settings)
+    pool.submit(handler.command, Match(m, line, connection, settings))
+
+
+def test_command_executor_must_be_valid():
+    with pytest.raises(CommandException):
+        command(r'', executor='fiber')
+
+    assert command(r'', offload=True).executor == 'thread'
+    assert command(r'').executor is None
+
+
+@mock_connection
+def test_worker_pool_keeps_reply_order_per_target(c):
+    pool = WorkerPool(4)
+    submit(pool, slow, c, 'slow 0.2')
+    submit(pool, slow, c, 'slow 0')
+    submit(pool, slow, c, 'slow 0', target='#Other')
+    run(pool, c, 6)
+    pool.shutdown()
+
+    # The reply to the other channel does not wait for the slow command.
+    assert c.outbox[:2] == ['PRIVMSG #Other :Started 0',
+                            'PRIVMSG #Other :Slept 0']
+    assert c.outbox[2:] == [
+        'PRIVMSG #Chan :Started 0.2',
+        'PRIVMSG #Chan :Slept 0.2',
+        'PRIVMSG #Chan :Started 0',
+        'PRIVMSG #Chan :Slept 0',
+    ]
+
+
+@mock_connection
+def test_worker_pool_limits_concurrency(c):
+    release.clear()
+    pool = WorkerPool(4)
+
+    for target in ('#a', '#b', '#c'):
+        submit(pool, blocked, c, 'blocked', target=target)
+
+    time.sleep(0.05)
+    assert pool.running[blocked.command] == 1
+    assert len(pool.waiting[blocked.command]) == 2
+
+    release.set()
+    run(pool, c, 3)
+    pool.shutdown()
+
+    assert len(c.outbox) == 3
+    assert pool.running[blocked.command] == 0
+
+
+@mock_connection
+def test_worker_pool_drops_late_replies(c):
+    pool = WorkerPool(4)
+    submit(pool, late, c, 'late')
+    submit(pool, slow, c, 'slow 0')
+    run(pool, c, 2)
+
+    assert c.outbox == ['PRIVMSG #Chan :Started 0', 'PRIVMSG #Chan :Slept 0']
+
+    # The late command still takes up its slot until it finishes.
+    assert pool.running[late.command] == 1
+    time.sleep(0.3)
+    pool.collect([])
+    pool.shutdown()
+
+    assert pool.running[late.command] == 0
+    assert len(c.outbox) == 2
+
+
+def test_worker_pool_delivers_replies_collected_late(caplog):
+    c = MockConnection()
+    pool = WorkerPool(4)
+    submit(pool, quick, c, 'quick')
+    submit(pool, broken, c, 'broken')
+    submit(pool, slow, c, 'slow 0')
+
+    # The commands finish in time, but are collected after the deadline.
+    time.sleep(0.2)
+    pool.collect([])
+    pool.shutdown()
+
+    assert c.outbox == ['PRIVMSG #Chan :Quick', 'PRIVMSG #Chan :Started 0',
+                        'PRIVMSG #Chan :Slept 0']
+    assert 'Exception in offloaded command' in caplog.text
+    assert 'ValueError: Broken' in caplog.text
+
+
+@mock_connection
+def test_worker_pool_process_executor(c):
+    pool = WorkerPool(4, 1)
+    submit(pool, square, c, 'square 12')
+    run(pool, c, 1, seconds=10)
+    pool.shutdown()
+
+    assert c.outbox == ['PRIVMSG #Chan :Square is 144']
+
+
+@mock_connection
+def test_prepare_match_for_process(c):
+    line = Line(':John!JDoe@some.host PRIVMSG #Chan :7 times', c)
+    m = re.search(r'(?P<count>\d+) (\w+)', line.full_msg)
+    match = pickle.loads(pickle.dumps(prepare(Match(m, line, c), True)))
+
+    assert isinstance(match.match, MatchGroups)
+    assert match[0] == '7 times'
+    assert match['count'] == '7'
+    assert match[2] == 'times'
+    assert match[3] == ''
+    assert match.line.sender.nick == 'John'
+
+    match.msg('Hello')
+    assert match.connection.lines == [('PRIVMSG #Chan :Hello', 1)]
+
+
+def test_shard_executors_only_remember_commands():
+    @command(r'hello')
+    def hello(match):
+        return 'Hello'
+
+    pool = WorkerPool(1, shard=True)
+    pool.keys = {id(hello.command): 0}
+
+    try:
+        assert pool.executor_of(hello.command) == 'process'
+
+        for _ in range(3):
+            timer = Timer(datetime.timedelta(seconds=1), 'Tick')
+            assert pool.executor_of(timer) is None
+
+        assert pool.executors == {id(hello.command): 'process'}
+    finally:
+        pool.shutdown()
+
+
+def test_sharded_commands_run_in_processes(tmp_path, monkeypatch):
+    package = tmp_path / 'shardpkg'
+    package.mkdir()
+    (package / '__init__.py').write_text('')
+    (package / 'settings.py').write_text(SHARD_SETTINGS)
+    (package / 'commands.py').write_text(SHARD_COMMANDS)
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    bot = Pyromancer.__new__(Pyromancer)
+    bot.settings = Settings('shardpkg.settings')
+    bot.find_commands()
+    bot.timers = []
+    bot.metrics = Metrics(bot)
+
+    c = MockConnection()
+    c.settings = bot.settings.networks_settings()[0]
+    user = c.user_map['john'] = User('John!JDoe@some.host')
+    user.auth = 'John'
+    bot.connections = [c]
+    bot.start_workers()
+
+    try:
+        for msg in ('square 12', 'where', 'here'):
+            bot.process(':John!JDoe@some.host PRIVMSG #Chan :!' + msg, c)
+
+        # Only the command which is not offloaded replied right away.
+        assert c.outbox == ['PRIVMSG #Chan :{}'.format(os.getpid())]
+        run(bot.workers, c, 4, seconds=30)
+    finally:
+        bot.workers.shutdown()
+
+        for module in ('shardpkg', 'shardpkg.settings', 'shardpkg.commands'):
+            sys.modules.pop(module, None)
+
+    assert c.outbox[1:3] == ['PRIVMSG #Chan :Square of 12 is 144',
+                             'PRIVMSG #Chan :Net John']
+    assert c.outbox[3] != c.outbox[0]
+    square_metrics = bot.metrics.by_name()['shardpkg.commands.square']
+    assert square_metrics.time.count == 1
+    assert square_metrics.errors == 0
@@ -4,8 +4,13 @@ import inspect
 from types import GeneratorType
 
 
-def find_functions(packages, into, submodule, ignored=None,
-                   when=lambda f: True, ret=lambda f: f):
+def find_modules(packages, submodule, ignored=None):
+    """Yield the given submodule of every package and the modules in it.
+
+    Modules in the ignored setting of a package are skipped, and the list of
+    ignored names is yielded along with every module. Submodules which do
+    not exist are yielded with None as module.
+    """
     for package in packages:
         if isinstance(package, tuple):
             package_settings = package[1]
@@ -28,6 +33,7 @@ def find_functions(packages, into, submodule, ignored=None,
         try:
             module = importlib.import_module(module_name)
         except ImportError:
+            yield module_name, None, ignored
             continue
 
         modules = [('', module,)]
@@ -37,10 +43,40 @@ def find_functions(packages, into, submodule, ignored=None,
             if module.__name__ in ignored:
                 continue
 
-            functions = inspect.getmembers(module, inspect.isfunction)
-            into.extend(
-                ret(f) for fn, f in functions if
-                when(f) and '{}.{}'.format(module.__name__, fn) not in ignored)
+            yield module.__name__, module, ignored
+
+
+def find_functions(packages, into, submodule, ignored=None,
+                   when=lambda f: True, ret=lambda f: f):
+    for module_name, module, ignored_names in find_modules(
+            packages, submodule, ignored):
+        if module is None:
+            continue
+
+        functions = inspect.getmembers(module, inspect.isfunction)
+        into.extend(
+            ret(f) for fn, f in functions if
+            when(f) and '{}.{}'.format(module_name, fn) not in ignored_names)
+
+
+def reload_module(module):
+    """Import a module again, without the names it no longer defines.
+
+    On an error, such as a syntax error, the module is left as it was.
+    """
+    namespace = vars(module)
+    old = dict(namespace)
+
+    for name in list(namespace):
+        if not name.startswith('__'):
+            del namespace[name]
+
+    try:
+        return importlib.reload(module)
+    except Exception:
+        namespace.clear()
+        namespace.update(old)
+        raise
 
 
 def process_messages(result, with_target=False):
@@ -0,0 +1,446 @@
+"""Worker pool for commands which block.
+
+Commands with `offload=True` or an `executor` run in a thread or process
+pool instead of on the event loop, so a slow command does not keep the bot
+from answering PINGs. The lines a command sends and the messages it returns
+are collected in the worker, and sent by the event loop once every earlier
+offloaded command for the same target has replied.
+
+With the `shard_commands` setting, commands with patterns run in the worker
+processes as well, unless they are coroutines or have `offload=False`. The
+processes find the commands and load the settings themselves when they
+start, so a command is sent to a process as a small tuple of its position in
+the commands, the network, the line and the match groups.
+"""
+import collections
+import concurrent.futures
+import functools
+import inspect
+import io
+import logging
+import multiprocessing
+import socket
+import time
+from types import GeneratorType
+
+from pyromancer.exceptions import CommandException
+from pyromancer.objects import Connection, Line, Match, NetworkSettings, \
+    PRIORITY_NORMAL, Settings, find_commands
+
+# The settings, the commands and the settings of every network of a worker
+# process, when it was started by a configured WorkerPool.
+shard = None
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox(Connection):
+    """Stand-in for the connection of a command running in a worker.
+
+    Written lines are kept until the event loop sends them. Everything else
+    is read from the real connection, which should be treated as read-only
+    from a worker. In a process, the real connection is not available.
+    """
+
+    def __init__(self, connection=None):
+        self.connection = connection
+        self.lines = []
+
+    def __getattr__(self, item):
+        connection = self.__dict__.get('connection')
+
+        if connection is None:
+            raise AttributeError(item)
+
+        return getattr(connection, item)
+
+    def __getstate__(self):
+        return {'connection': None, 'lines': self.lines}
+
+    def write(self, data, priority=PRIORITY_NORMAL):
+        self.lines.append((data, priority))
+
+
+class MatchGroups(object):
+    """Copy of the groups of a regular expression match, which can be sent
+    to another process."""
+
+    def __init__(self, m):
+        self._groups = (m.group(0),) + m.groups()
+        self._groupdict = m.groupdict()
+
+    def group(self, item=0):
+        try:
+            if isinstance(item, str):
+                return self._groupdict[item]
+
+            return self._groups[item]
+        except KeyError:
+            raise IndexError('no such group')
+
+    def groups(self):
+        return self._groups[1:]
+
+    def groupdict(self):
+        return dict(self._groupdict)
+
+    @classmethod
+    def restore(cls, groups, groupdict):
+        match_groups = cls.__new__(cls)
+        match_groups._groups = groups
+        match_groups._groupdict = groupdict
+        return match_groups
+
+
+def reply_key(match):
+    """The connection and the target a command replies to by default."""
+    line = match.line
+    target = line.target
+
+    if line.pm and line.sender is not None:
+        target = line.sender.nick
+
+    connection = match.connection
+    return connection, connection.lower(target) if target else None
+
+
+def prepare(match, process=False):
+    """Return a copy of a match to hand to a worker.
+
+    For a process, the match groups, the line and the connection are
+    replaced by copies which can be pickled.
+    """
+    m, line = match.match, match.line
+
+    if process:
+        if not isinstance(m, bool):
+            m = MatchGroups(m)
+
+        line = Line(line.data, None)
+        line.time = match.line.time
+
+    return Match(m, line, Outbox(None if process else match.connection),
+                 match.settings)
+
+
+def call_offloaded(function, match):
+    error = True
+
+    try:
+        result = function(match)
+
+        # Generators are exhausted in the worker, also because they cannot
+        # be sent back from a process.
+        if isinstance(result, GeneratorType):
+            result = list(result)
+
+        match.finish()
+        error = False
+    finally:
+        if error:
+            match.finish(error)
+
+    return result, match.connection.lines
+
+
+def function_name(function):
+    return '{}.{}'.format(function.__module__, function.__qualname__)
+
+
+def snapshot(handler, match, index, network):
+    """Return what a worker process needs to know to run a command."""
+    m, line = match.match, match.line
+
+    if not isinstance(m, bool):
+        m = (m.group(0),) + m.groups(), m.groupdict()
+
+    sender = line.sender
+    return (index, function_name(handler.function), network, line.data,
+            line.time, m, sender.auth if sender is not None else None)
+
+
+def start_shard(settings, networks):
+    global shard
+
+    shard = settings, find_commands(settings), [
+        settings if overrides is None else
+        NetworkSettings(settings, overrides) for overrides in networks]
+
+
+def call_shard(snapshot):
+    index, name, network, data, received, m, auth = snapshot
+    settings, functions, networks = shard
+    function = functions[index].command.function
+
+    if function_name(function) != name:
+        raise CommandException(
+            'Command {} of the bot is {} in the worker process'.format(
+                name, function_name(function)))
+
+    if not isinstance(m, bool):
+        m = MatchGroups.restore(*m)
+
+    line = Line(data, None)
+    line.time = received
+
+    if auth is not None:
+        line.sender.auth = auth
+
+    return call_offloaded(function, Match(m, line, Outbox(),
+                                          networks[network]))
+
+
+def replay(lines, connection):
+    for data, priority in lines:
+        connection.write(data, priority)
+
+
+class Job(object):
+    __slots__ = ('handler', 'match', 'key', 'future', 'deadline', 'finished',
+                 'completed', 'late', 'started', 'took')
+
+    def __init__(self, handler, match):
+        self.handler = handler
+        self.match = match
+        self.key = reply_key(match)
+        self.future = None
+        self.deadline = None
+        self.finished = False
+        self.completed = None
+        self.late = False
+        self.started = None
+        self.took = None
+
+    def expired(self, now):
+        return self.deadline is not None and now >= self.deadline
+
+
+class WorkerPool(object):
+    """Runs offloaded commands for the Pyromancer.
+
+    Commands are started in the order they matched, at most
+    `max_concurrency` at a time per command. When a worker finishes, the
+    event loop is woken up through a socket pair, and collects the results
+    in the order the commands were started for each reply target. A command
+    which runs longer than its timeout is skipped; whatever it sends or
+    returns afterwards is dropped. It still counts towards the concurrency
+    limit until it actually finishes, as a running thread cannot be stopped.
+    """
+
+    def __init__(self, workers=None, processes=None, metrics=None,
+                 shard=False):
+        self.metrics = metrics
+        self.threads = concurrent.futures.ThreadPoolExecutor(workers)
+        self.processes = None
+        self.process_count = processes
+
+        self.shard = shard
+        self.settings = None
+        self.networks = []
+        self.keys = {}
+        self.network_keys = {}
+        self.executors = {}
+
+        self.running = collections.Counter()
+        self.waiting = collections.defaultdict(collections.deque)
+        self.replies = collections.OrderedDict()
+        self.finished = collections.deque()
+
+        self.receiver, self.sender = socket.socketpair()
+        self.receiver.setblocking(False)
+        self.sender.setblocking(False)
+
+    def __len__(self):
+        return sum(len(jobs) for jobs in self.replies.values())
+
+    def configure(self, settings, functions, networks):
+        """Let the worker processes find the commands themselves.
+
+        The processes are started again on the next command, so they use
+        the current commands and settings. Commands which are still running
+        finish in the old processes.
+        """
+        # Other settings, such as in tests, cannot be loaded by a process.
+        if not isinstance(settings, Settings):
+            return
+
+        self.settings = settings
+        self.networks = [getattr(n, '_overrides', None) if n is not settings
+                         else None for n in networks]
+
+        # Keyed on the ids, as timers cannot be hashed.
+        self.keys = dict((id(f.command), index) for index, f in
+                         enumerate(functions))
+        self.network_keys = dict((id(n), index) for index, n in
+                                 enumerate(networks))
+        self.executors = {}
+
+        if self.processes is not None:
+            self.processes.shutdown(wait=False)
+            self.processes = None
+
+    def executor_of(self, handler):
+        """Return 'thread' or 'process' when a handler runs in a worker."""
+        executor = getattr(handler, 'executor', None)
+
+        if executor or not self.shard:
+            return executor
+
+        # Only the commands are remembered, as timers come and go and their
+        # ids can be used again.
+        if id(handler) not in self.keys:
+            return executor
+
+        try:
+            return self.executors[id(handler)]
+        except KeyError:
+            pass
+
+        if handler.patterns and handler.offload is not False and \
+                not inspect.iscoroutinefunction(handler.function):
+            executor = 'process'
+
+        self.executors[id(handler)] = executor
+        return executor
+
+    def executor(self, handler):
+        if self.executor_of(handler) == 'process':
+            if self.processes is None:
+                options = {}
+
+                if self.settings is not None:
+                    options = dict(initializer=start_shard,
+                                   initargs=(self.settings, self.networks))
+
+                # Forked workers would inherit the sockets of the bot.
+                self.processes = concurrent.futures.ProcessPoolExecutor(
+                    self.process_count, multiprocessing.get_context('spawn'),
+                    **options)
+
+            return self.processes
+
+        return self.threads
+
+    def task(self, handler, match):
+        """Return the function and arguments which run a command in a
+        worker."""
+        process = self.executor_of(handler) == 'process'
+        index = self.keys.get(id(handler))
+        network = self.network_keys.get(id(match.settings))
+
+        if process and self.settings is not None and index is not None and \
+                network is not None:
+            return call_shard, (snapshot(handler, match, index, network),)
+
+        return call_offloaded, (handler.function, prepare(match, process))
+
+    def submit(self, handler, match):
+        job = Job(handler, match)
+        self.replies.setdefault(job.key, collections.deque()).append(job)
+
+        limit = handler.max_concurrency
+        if limit and self.running[handler] >= limit:
+            self.waiting[handler].append(job)
+        else:
+            self.start(job)
+
+    def start(self, job, now=None):
+        handler = job.handler
+        self.running[handler] += 1
+
+        if handler.timeout is not None:
+            job.deadline = (time.monotonic() if now is None else now) + \
+                handler.timeout
+
+        function, args = self.task(handler, job.match)
+        job.started = time.perf_counter()
+        job.future = self.executor(handler).submit(function, *args)
+        job.future.add_done_callback(functools.partial(self.done, job))
+
+    def done(self, job, future):
+        # Called from the worker thread, or from the thread which collects
+        # the results of a process pool.
+        job.took = time.perf_counter() - job.started
+        job.completed = time.monotonic()
+        self.finished.append(job)
+
+        try:
+            self.sender.send(b'\0')
+        except (io.BlockingIOError, OSError):
+            pass
+
+    def timeout(self, now=None):
+        """Seconds until the first running command times out, if any."""
+        now = time.monotonic() if now is None else now
+        deadlines = [job.deadline for jobs in self.replies.values()
+                     for job in jobs if not job.finished and
+                     job.deadline is not None and job.deadline > now]
+
+        if not deadlines:
+            return None
+
+        return min(deadlines) - now
+
+    def collect(self, timers, now=None):
+        """Send the replies of finished commands, from the event loop."""
+        try:
+            while self.receiver.recv(4096):
+                pass
+        except (io.BlockingIOError, OSError):
+            pass
+
+        now = time.monotonic() if now is None else now
+
+        while self.finished:
+            job = self.finished.popleft()
+            job.finished = True
+
+            # The loop may collect a job well after it finished in time.
+            job.late = job.expired(job.completed)
+            self.running[job.handler] -= 1
+
+            if self.metrics is not None:
+                self.metrics.ran(job.handler, job.took,
+                                 job.future.exception() is not None)
+
+            waiting = self.waiting[job.handler]
+            if waiting:
+                self.start(waiting.popleft(), now)
+
+        for key in list(self.replies):
+            jobs = self.replies[key]
+
+            while jobs and (jobs[0].finished or jobs[0].expired(now)):
+                if not jobs[0].finished and jobs[0].completed is not None:
+                    # It finished after the results were collected, and is
+                    # collected in the next cycle.
+                    break
+
+                job = jobs.popleft()
+
+                if job.finished and not job.late:
+                    self.deliver(job, timers)
+
+            if not jobs:
+                del self.replies[key]
+
+    def deliver(self, job, timers):
+        try:
+            result, lines = job.future.result()
+        except Exception:
+            logger.exception('Exception in offloaded command %s',
+                             function_name(job.handler.function))
+            return
+
+        replay(lines, job.match.connection)
+        job.handler.respond(result, job.match, timers)
+
+    def shutdown(self):
+        # Do not wait for commands which may never finish.
+        self.threads.shutdown(wait=False)
+
+        if self.processes is not None:
+            self.processes.shutdown(wait=False)
+
+        self.receiver.close()
+        self.sender.close()
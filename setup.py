@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 
 import pyromancer
 
@@ -11,23 +11,24 @@ setup(
     name='Pyromancer',
     version=pyromancer.__version__,
     packages=['pyromancer', 'pyromancer.commands', 'pyromancer.test'],
+    package_data={'pyromancer.test': ['mock_server.pem']},
     description='Simple framework for creating IRC bots',
     long_description=long_description,
     author='Gwildor Sok',
     author_email='gwildorsok@gmail.com',
     url='https://github.com/Gwildor/Pyromancer',
     install_requires=[],
+    python_requires='>=3.7',
     classifiers=[
         'Intended Audience :: Developers',
         'Intended Audience :: Information Technology',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.0',
-        'Programming Language :: Python :: 3.1',
-        'Programming Language :: Python :: 3.2',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Communications',
         'Topic :: Communications :: Chat',
         'Topic :: Communications :: Chat :: Internet Relay Chat',